@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from openai import APITimeoutError
+
+from benchmarks.fake_server import FakeOpenAIServer
+from benchmarks.server_load import _stats
+from tandem.clients import ClientRegistry
+
+
+def run_calls(make_chat, make_embeddings, calls: int, concurrency: int) -> dict:
+    results = {"sync": [], "async": [], "errors": []}
+
+    def call(idx: int):
+        # a new model per call, like the get_*_chain functions build them
+        start = time.perf_counter()
+        try:
+            make_embeddings().embed_query(f"topic {idx}")
+            make_chat().invoke(f"message {idx}")
+        except Exception as e:
+            results["errors"].append(f"{type(e).__name__}: {e}")
+            return
+        results["sync"].append(time.perf_counter() - start)
+
+    async def acall(idx: int, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await make_embeddings().aembed_query(f"async topic {idx}")
+                await make_chat().ainvoke(f"async message {idx}")
+            except Exception as e:
+                results["errors"].append(f"{type(e).__name__}: {e}")
+                return
+            results["async"].append(time.perf_counter() - start)
+
+    async def run_async():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(acall(idx, semaphore) for idx in range(calls)))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(calls)))
+    asyncio.run(run_async())
+    results["wall"] = time.perf_counter() - start
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the shared, rate limited clients with per-model clients "
+                                                 "against a local fake OpenAI server that throttles")
+    parser.add_argument("--calls", type=int, default=100, help="embedding and chat call pairs, sync and async each")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--throttle-rate", type=float, default=0.2, help="fraction of requests answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="fraction of requests answered with 503")
+    parser.add_argument("--requests-per-minute", type=float, help="limit of the shared clients")
+    parser.add_argument("--first-byte-delay", type=float, default=0.02)
+    parser.add_argument("--tokens-per-second", type=float, default=2000.0)
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="seconds per request in both variants, a request that takes longer fails the run")
+    args = parser.parse_args()
+
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    # tiktoken fetches its encodings over the network, the fake server takes plain strings.
+    # without a timeout a langchain model waits for a stalled response forever
+    variants = {
+        "per-model": (lambda: ChatOpenAI(timeout=args.timeout),
+                      lambda: OpenAIEmbeddings(timeout=args.timeout, check_embedding_ctx_length=False)),
+    }
+    registry = ClientRegistry(requests_per_minute=args.requests_per_minute, timeout=httpx.Timeout(args.timeout))
+    variants["shared"] = (lambda: registry.chat_model(),
+                          lambda: registry.embeddings(check_embedding_ctx_length=False))
+
+    timeouts = 0
+    for name, (make_chat, make_embeddings) in variants.items():
+        # the same seed injects the same failures into both runs
+        with FakeOpenAIServer(first_byte_delay=args.first_byte_delay, tokens_per_second=args.tokens_per_second,
+                              throttle_rate=args.throttle_rate, error_rate=args.error_rate) as server:
+            os.environ["OPENAI_BASE_URL"] = server.base_url
+            os.environ["OPENAI_API_BASE"] = server.base_url
+            results = run_calls(make_chat, make_embeddings, args.calls, args.concurrency)
+        print(f"{name}: {results['wall']:.1f} s, {len(results['errors'])} failed calls, "
+              f"{server.requests.get('connections', 0)} connections, {server.requests.get('throttled', 0)} throttled, "
+              f"{server.requests.get('failed', 0)} failed requests")
+        print(_stats("sync call", results["sync"]))
+        print(_stats("async call", results["async"]))
+        for error in sorted(set(results["errors"]))[:5]:
+            print(f"error: {error}")
+        timeouts += sum(error.startswith(APITimeoutError.__name__) for error in results["errors"])
+    print(f"shared clients: {registry.stats()}")
+    if timeouts:
+        sys.exit(f"{timeouts} calls timed out after {args.timeout:g} s")
+
+
+if __name__ == '__main__':
+    main()
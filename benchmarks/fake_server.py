@@ -0,0 +1,211 @@
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+
+
+_DEFAULT_REPLY = """你好！我們去旅行吧，你最喜歡去哪裡玩？我上次坐火車去了花蓮，海邊的風景很美。
+---
+Hello! Let's talk about traveling, where do you like to go the most? Last time I took the train to Hualien, the scenery at the sea was beautiful."""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super(_Handler, self).setup()
+        # one handler per connection, keep-alive requests are handled in a loop
+        self.server.fake.count("connections")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server: FakeOpenAIServer = self.server.fake
+        server.count(self.path)
+        failure = server.injected_failure()
+        if failure is not None:
+            self._send_failure(*failure)
+        elif self.path.endswith("/audio/speech"):
+            self._speech(body)
+        elif self.path.endswith("/chat/completions"):
+            self._chat(body)
+        elif self.path.endswith("/embeddings"):
+            self._embeddings(body)
+        else:
+            self.send_error(404)
+
+    def _send_json(self, data: dict):
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_failure(self, status: int, error_type: str, retry_after: Optional[float]):
+        payload = json.dumps({"error": {"message": f"injected {error_type}", "type": error_type}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if retry_after is not None:
+            self.send_header("retry-after-ms", str(int(retry_after * 1000)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _begin_chunked(self, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _speech(self, body: dict):
+        server: FakeOpenAIServer = self.server.fake
+        time.sleep(server.first_byte_delay)
+        self._begin_chunked("audio/mpeg")
+        # audio length grows with the input like a real voice would
+        remaining = server.bytes_per_char * len(body.get("input", ""))
+        while remaining > 0:
+            chunk = b"\xff" * min(server.chunk_size, remaining)
+            remaining -= len(chunk)
+            self._write_chunk(chunk)
+            time.sleep(server.chunk_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chat(self, body: dict):
+        server: FakeOpenAIServer = self.server.fake
+        reply = server.reply
+        # two characters per token is close to what the tokenizer does for Chinese
+        tokens = [reply[i:i + 2] for i in range(0, len(reply), 2)]
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in body.get("messages", [])) // 2
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "gpt-3.5-turbo"),
+                "system_fingerprint": None}
+        time.sleep(server.first_byte_delay)
+
+        if not body.get("stream"):
+            time.sleep(len(tokens) / server.tokens_per_second)
+            self._send_json({**base, "object": "chat.completion", "usage": usage, "choices": [{
+                "index": 0, "finish_reason": "stop", "logprobs": None,
+                "message": {"role": "assistant", "content": reply},
+            }]})
+            return
+
+        self._begin_chunked("text/event-stream")
+
+        def event(data: dict):
+            self._write_chunk(f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', **data})}\n\n".encode())
+
+        event({"choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+        for token in tokens:
+            time.sleep(1 / server.tokens_per_second)
+            event({"choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+        event({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            event({"choices": [], "usage": usage})
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _embeddings(self, body: dict):
+        server: FakeOpenAIServer = self.server.fake
+        inputs = body["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        time.sleep(server.first_byte_delay)
+        data = []
+        for idx, item in enumerate(inputs):
+            vector = server.embedding(json.dumps(item, ensure_ascii=False))
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": idx, "embedding": embedding})
+        self._send_json({"object": "list", "model": body.get("model"), "data": data,
+                         "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+
+class FakeOpenAIServer:
+    # a local stand-in for the OpenAI API, responses are streamed with artificial delays
+    def __init__(self, first_byte_delay: float = 0.2, chunk_delay: float = 0.05, chunk_size: int = 4096,
+                 bytes_per_char: int = 1200, tokens_per_second: float = 50.0, reply: str = _DEFAULT_REPLY,
+                 embedding_dims: int = 1536, throttle_rate: float = 0.0, error_rate: float = 0.0,
+                 retry_after: Optional[float] = 0.05, seed: int = 0, port: int = 0):
+        self.first_byte_delay = first_byte_delay
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.bytes_per_char = bytes_per_char
+        self.tokens_per_second = tokens_per_second
+        self.reply = reply
+        self.embedding_dims = embedding_dims
+        # fractions of requests answered with a 429 or a 503 instead, to exercise the client retries
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self.requests: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def count(self, path: str):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def injected_failure(self) -> Optional[tuple[int, str, Optional[float]]]:
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            self.count("throttled")
+            return 429, "rate_limit_exceeded", self.retry_after
+        if draw < self.throttle_rate + self.error_rate:
+            self.count("failed")
+            return 503, "server_error", None
+        return None
+
+    def embedding(self, text: str) -> np.ndarray:
+        # the same text always gets the same unit vector
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.embedding_dims).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI API for offline runs of the app")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--first-byte-delay", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    args = parser.parse_args()
+    with FakeOpenAIServer(first_byte_delay=args.first_byte_delay, tokens_per_second=args.tokens_per_second,
+                          throttle_rate=args.throttle_rate, error_rate=args.error_rate, port=args.port) as server:
+        print(f"OPENAI_BASE_URL={server.base_url} OPENAI_API_BASE={server.base_url}")
+        server._thread.join()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+_ROOT = Path(__file__).parent.parent
+_CHROMA_PATH = f"{_ROOT}/.chroma/3000-traditional-hanzi"
+_INDEX_PATH = f"{_ROOT}/.index/3000-traditional-hanzi"
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def query_vectors(count: int, seed: int = 0) -> np.ndarray:
+    # perturbed rows of the index stand in for topic embeddings so the benchmark runs offline
+    matrix = np.load(f"{_INDEX_PATH}/embeddings.npy", mmap_mode="r")
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(matrix), size=count)
+    return np.asarray(matrix[rows]) + rng.normal(0, 0.01, size=(count, matrix.shape[1])).astype(np.float32)
+
+
+def run_backend(backend: str, queries: int, k: int) -> dict:
+    vectors = query_vectors(queries)
+    rss_before = rss_mb()
+
+    start = time.perf_counter()
+    if backend == "numpy":
+        from tandem.vector_index import NumpyVectorIndex
+        index = NumpyVectorIndex(_INDEX_PATH)
+
+        def search(batch):
+            return index.search(batch, k)
+    else:
+        from langchain_community.vectorstores import Chroma
+        db = Chroma(persist_directory=_CHROMA_PATH)
+
+        def search(batch):
+            return [db.similarity_search_by_vector(vector.tolist(), k=k) for vector in batch]
+    search(vectors[:1])
+    open_seconds = time.perf_counter() - start
+
+    latencies = []
+    for vector in vectors:
+        start = time.perf_counter()
+        search(vector[None, :])
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    search(vectors)
+    batch_seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "backend": backend,
+        "queries": queries,
+        "k": k,
+        "open_ms": open_seconds * 1000,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+        "batch_ms": batch_seconds * 1000,
+        "rss_mb": rss_mb() - rss_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Chroma and NumPy retrieval backends")
+    parser.add_argument("--backend", choices=("chroma", "numpy"))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=30)
+    args = parser.parse_args()
+
+    if args.backend:
+        print(json.dumps(run_backend(args.backend, args.queries, args.k)))
+        return
+
+    # every backend runs in a fresh interpreter so the RSS numbers do not include the other one
+    for backend in ("chroma", "numpy"):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.retrieval", "--backend", backend,
+             "--queries", str(args.queries), "-k", str(args.k)],
+            cwd=_ROOT, check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{backend:>6}: open {result['open_ms']:8.1f} ms  p50 {result['p50_ms']:7.3f} ms  "
+              f"p99 {result['p99_ms']:7.3f} ms  batch({args.queries}) {result['batch_ms']:8.1f} ms  "
+              f"rss +{result['rss_mb']:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.fake_server import FakeOpenAIServer
+from tandem.llm_cache import configure_response_cache
+
+
+_CHARACTER_LIST = "旅(lǚ) - travel, journey, trip\n火(huǒ) - fire\n車(chē) - car, vehicle\n海(hǎi) - sea, ocean"
+_MESSAGES = ["你好！我們聊聊旅行吧。", "我喜歡坐火車去旅行。", "你去過花蓮嗎？", "海邊的風景怎麼樣？"]
+
+
+def _percentile(seconds: list[float], fraction: float) -> float:
+    seconds = sorted(seconds)
+    return seconds[min(int(fraction * len(seconds)), len(seconds) - 1)] * 1000
+
+
+def _stats(name: str, seconds: list[float]) -> str:
+    if not seconds:
+        return f"{name:<14} no samples"
+    return (f"{name:<14} p50 {statistics.median(seconds) * 1000:8.1f} ms  p99 {_percentile(seconds, 0.99):8.1f} ms  "
+            f"max {max(seconds) * 1000:8.1f} ms  n={len(seconds)}")
+
+
+async def run_session(http: aiohttp.ClientSession, base_url: str, turns: int, topic: str, results: dict):
+    start = time.perf_counter()
+    body = {"topic": topic} if topic else {"character_list": _CHARACTER_LIST}
+    async with http.post(f"{base_url}/sessions", json=body) as response:
+        response.raise_for_status()
+        session = await response.json()
+    results["create"].append(time.perf_counter() - start)
+
+    async with http.ws_connect(f"{base_url}/sessions/{session['id']}/ws") as ws:
+        for turn in range(turns):
+            turn_start = time.perf_counter()
+            first_chunk = None
+            await ws.send_json({"message": _MESSAGES[turn % len(_MESSAGES)]})
+            async for frame in ws:
+                data = frame.json()
+                if data["type"] == "chunk" and first_chunk is None:
+                    first_chunk = time.perf_counter() - turn_start
+                elif data["type"] == "error":
+                    results["errors"].append(data["error"])
+                    break
+                elif data["type"] == "done":
+                    results["first_chunk"].append(first_chunk)
+                    results["turn"].append(time.perf_counter() - turn_start)
+                    break
+    async with http.delete(f"{base_url}/sessions/{session['id']}"):
+        pass
+
+
+async def run_load(args: argparse.Namespace, server: FakeOpenAIServer) -> dict:
+    from tandem.server import build_parser, make_app
+
+    server_args = build_parser().parse_args(["--retrieval", "lexical", "--direct-selection"]
+                                            + ([] if args.topic else ["--no-preload-index"]))
+    runner = web.AppRunner(make_app(server_args))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+    results = {"create": [], "first_chunk": [], "turn": [], "errors": []}
+    start = time.perf_counter()
+    # the default connector limit of 100 would queue the sessions in the client instead of the server
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+        await asyncio.gather(*(run_session(http, base_url, args.turns, args.topic, results)
+                               for _ in range(args.sessions)))
+    results["wall"] = time.perf_counter() - start
+    await runner.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the session server against a local fake OpenAI server")
+    parser.add_argument("--sessions", type=int, default=50, help="concurrent sessions")
+    parser.add_argument("--turns", type=int, default=3, help="messages per session")
+    parser.add_argument("--topic", help="create sessions by topic, which includes the character retrieval")
+    parser.add_argument("--first-byte-delay", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    args = parser.parse_args()
+
+    with FakeOpenAIServer(first_byte_delay=args.first_byte_delay, tokens_per_second=args.tokens_per_second) as server:
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ["OPENAI_API_BASE"] = server.base_url
+        # the fake replies repeat, cached summaries would never reach the server
+        configure_response_cache(enabled=False)
+        results = asyncio.run(run_load(args, server))
+
+    print(f"{args.sessions} sessions x {args.turns} turns in {results['wall']:.1f} s, "
+          f"{len(results['errors'])} errors, fake server requests {server.requests}")
+    for name in ("create", "first_chunk", "turn"):
+        print(_stats(name, results[name]))
+    for error in sorted(set(results["errors"])):
+        print(f"error: {error}")
+
+
+if __name__ == '__main__':
+    main()
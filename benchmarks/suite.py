@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fake_server import FakeOpenAIServer
+from tandem.llm_cache import configure_response_cache
+
+
+_ROOT = Path(__file__).parent.parent
+_DEFAULT_BASELINE = _ROOT / "benchmarks" / "baseline.json"
+_TOPICS = ["traveling", "cooking dinner", "the weather", "going to school", "sports", "shopping for clothes",
+           "visiting a doctor", "family", "music", "working in an office"]
+
+
+def _percentiles(seconds: list[float], prefix: str) -> dict:
+    seconds = sorted(seconds)
+    return {
+        f"{prefix}_p50_ms": statistics.median(seconds) * 1000,
+        f"{prefix}_p95_ms": seconds[int(0.95 * (len(seconds) - 1))] * 1000,
+    }
+
+
+def bench_character_list(workdir: Path, rounds: int) -> dict:
+    from tandem.char_retrieval_chain import CharacterRetriever, _DEFAULT_CHARACTER_PATH, load_character_documents
+    from tandem.clients import get_clients
+    from tandem.vector_index import build_vector_index
+
+    # tiktoken fetches its encodings over the network, the fake server takes plain strings
+    embeddings = get_clients().embeddings(check_embedding_ctx_length=False)
+    index_path = workdir / "vector-index"
+    start = time.perf_counter()
+    build_vector_index(load_character_documents(_DEFAULT_CHARACTER_PATH), embeddings, str(index_path))
+    results = {"build_vector_index_ms": (time.perf_counter() - start) * 1000}
+
+    for mode, llm_selection in (("lexical", False), ("vector", False), ("hybrid", False), ("hybrid", True)):
+        name = mode if llm_selection else f"{mode}_direct"
+        retriever = CharacterRetriever(cache_dir=None, backend="numpy", mode=mode, llm_selection=llm_selection,
+                                       vector_index_path=str(index_path),
+                                       lexical_index_path=str(workdir / f"lexical-{name}.json.gz"))
+        retriever.embeddings = embeddings
+        start = time.perf_counter()
+        retriever.get_character_list(_TOPICS[0])
+        results[f"{name}_first_ms"] = (time.perf_counter() - start) * 1000
+
+        latencies = []
+        for round_idx in range(rounds):
+            for topic in _TOPICS[1:]:
+                # a new topic every call, a repeated one would be served by the topic cache
+                start = time.perf_counter()
+                retriever.get_character_list(f"{topic} {round_idx}")
+                latencies.append(time.perf_counter() - start)
+        results.update(_percentiles(latencies, name))
+    return results
+
+
+def bench_tandem_chain(workdir: Path, rounds: int) -> dict:
+    from tandem.conversation_chain import get_tandem_partner
+    from langchain_core.messages import HumanMessage
+
+    results = {}
+    messages = [HumanMessage(content="你好！我們聊聊旅行吧。")]
+    for name, local_conversion in (("local", True), ("llm_conversion", False)):
+        chain = get_tandem_partner("旅(lǚ) - travel, journey, trip", local_conversion=local_conversion)
+        # the first call also opens the connection
+        chain.invoke({"chat_history": messages})
+        first_chunk = []
+        total = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            first = None
+            for _chunk in chain.stream({"chat_history": messages}):
+                if first is None:
+                    first = time.perf_counter() - start
+            first_chunk.append(first)
+            total.append(time.perf_counter() - start)
+        results.update(_percentiles(first_chunk, f"{name}_first_chunk"))
+        results.update(_percentiles(total, f"{name}_total"))
+    return results
+
+
+def bench_chat_view(workdir: Path, rounds: int, message_count: int = 5000) -> dict:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    sys.path.insert(0, str(_ROOT / "tandem"))
+    from PySide6.QtWidgets import QApplication
+    from chat_history.chat_history_widget import ChatHistoryWidget
+    from chat_history.history_model import HistoryModel
+    from tandem.tandem_partner import TandemPartner
+
+    app = QApplication.instance() or QApplication([])
+    tandem = TandemPartner("Lang", "旅(lǚ) - travel, journey, trip", prefetch_speech=False)
+    # summaries would add fake server round trips to every appended turn
+    tandem.history_window.summarizer = None
+    model = HistoryModel(tandem)
+    widget = ChatHistoryWidget(model)
+    widget.resize(800, 600)
+    widget.show()
+    app.processEvents()
+    viewport = widget.listview.viewport()
+    scroll_bar = widget.listview.verticalScrollBar()
+
+    start = time.perf_counter()
+    for i in range(message_count // 2):
+        model.add_dummy_message("Student", f"Benchmark message {i}")
+    app.processEvents()
+    results = {"messages": message_count, "load_ms": (time.perf_counter() - start) * 1000}
+
+    append_times = []
+    for i in range(20 * rounds):
+        start = time.perf_counter()
+        model.add_dummy_message("Student", f"Appended message {i}")
+        app.processEvents()
+        viewport.repaint()
+        append_times.append(time.perf_counter() - start)
+    results.update(_percentiles(append_times, "append_frame"))
+
+    # let the batched layout finish so the whole history can be scrolled
+    previous_maximum = -1
+    while scroll_bar.maximum() != previous_maximum:
+        previous_maximum = scroll_bar.maximum()
+        for _ in range(10):
+            app.processEvents()
+    scroll_times = []
+    step = max(scroll_bar.maximum() // (100 * rounds), 1)
+    for value in range(scroll_bar.maximum(), 0, -step):
+        start = time.perf_counter()
+        scroll_bar.setValue(value)
+        viewport.repaint()
+        scroll_times.append(time.perf_counter() - start)
+    results.update(_percentiles(scroll_times, "scroll_frame"))
+
+    widget.close()
+    tandem.shutdown()
+    return results
+
+
+def bench_character_db(workdir: Path, rounds: int) -> dict:
+    try:
+        import chromadb  # noqa: F401
+    except ImportError:
+        return {"skipped": "chromadb is not installed"}
+    from tandem.char_retrieval_chain import _DEFAULT_CHARACTER_PATH, generate_character_db
+
+    persist_directory = str(workdir / "chroma")
+    full = generate_character_db(_DEFAULT_CHARACTER_PATH, persist_directory=persist_directory)
+    # nothing changed, the second run only compares content hashes
+    incremental = generate_character_db(_DEFAULT_CHARACTER_PATH, persist_directory=persist_directory)
+    return {"full_build_ms": full.seconds * 1000, "incremental_ms": incremental.seconds * 1000}
+
+
+BENCHMARKS = {
+    "character_list": bench_character_list,
+    "tandem_chain": bench_tandem_chain,
+    "chat_view": bench_chat_view,
+    "character_db": bench_character_db,
+}
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_ms: float = 1.0) -> list[str]:
+    regressions = []
+    for benchmark, metrics in results["benchmarks"].items():
+        baseline_metrics = baseline.get("benchmarks", {}).get(benchmark, {})
+        for metric, value in metrics.items():
+            # all timings are lower-is-better, counts and notes are not compared
+            if not metric.endswith("_ms") or metric not in baseline_metrics:
+                continue
+            reference = baseline_metrics[metric]
+            change = (value - reference) / reference if reference else 0.0
+            flag = ""
+            # sub-millisecond timings jitter by more than the tolerance between runs
+            if change > tolerance and value - reference > min_delta_ms:
+                flag = "  REGRESSION"
+                regressions.append(f"{benchmark}.{metric}")
+            print(f"  {benchmark}.{metric:<32} {reference:10.2f} -> {value:10.2f} ms  {change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline benchmarks against a local fake OpenAI server")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=str(_DEFAULT_BASELINE), help="results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="smaller slowdowns are never regressions")
+    parser.add_argument("--first-byte-delay", type=float, default=0.05)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    args = parser.parse_args()
+
+    server_config = {"first_byte_delay": args.first_byte_delay, "tokens_per_second": args.tokens_per_second}
+    results = {"python": platform.python_version(), "machine": platform.machine(), "server": server_config,
+               "benchmarks": {}}
+    with FakeOpenAIServer(**server_config) as server, tempfile.TemporaryDirectory() as tmp:
+        # every client in the app reads its endpoint from the environment
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ["OPENAI_API_BASE"] = server.base_url
+        # every round has to reach the server, cached conversions would measure the cache
+        configure_response_cache(enabled=False)
+        for name in args.only or BENCHMARKS:
+            workdir = Path(tmp) / name
+            workdir.mkdir()
+            start = time.perf_counter()
+            try:
+                results["benchmarks"][name] = BENCHMARKS[name](workdir, args.rounds)
+            except Exception as e:
+                results["benchmarks"][name] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"{name}: {time.perf_counter() - start:.1f} s {json.dumps(results['benchmarks'][name])}")
+        results["requests"] = server.requests
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    regressions = []
+    if Path(args.baseline).exists() and not args.save_baseline:
+        print(f"compared with {args.baseline}:")
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance,
+                              args.min_delta_ms)
+    elif not args.save_baseline:
+        print(f"no baseline at {args.baseline}, nothing compared")
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(results, indent=2))
+        print(f"saved baseline to {args.baseline}")
+    if regressions:
+        sys.exit(f"{len(regressions)} regressions: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import statistics
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+from openai import OpenAI
+
+from benchmarks.fake_server import FakeOpenAIServer
+from tandem.speech import AudioCache, SpeechSynthesizer
+
+
+_REPLIES = [
+    "你好！要不要聊聊關於旅行的話題？",
+    "我去年夏天去了台灣，在台北待了一個星期，每天都去夜市吃東西。",
+    "旅行的時候，你比較喜歡自己安排行程，還是跟旅行團一起走？我覺得自己安排比較自由，可是也比較累。",
+]
+
+
+def write_then_play(client: OpenAI, text: str, output_path: Path) -> tuple[float, float]:
+    # the previous path, playback could only start once the whole file was written
+    start = time.perf_counter()
+    response = client.audio.speech.create(model="tts-1", voice="nova", input=text, response_format="mp3")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        response.stream_to_file(output_path)
+    seconds = time.perf_counter() - start
+    return seconds, seconds
+
+
+def streamed(synthesizer: SpeechSynthesizer, text: str) -> tuple[float, float]:
+    start = time.perf_counter()
+    device = synthesizer.stream(text)
+    device.waitForReadyRead(-1)
+    first_audio = time.perf_counter() - start
+    synthesizer.request(text).result()
+    return first_audio, time.perf_counter() - start
+
+
+def _stats(seconds: list[float]) -> str:
+    return f"p50 {statistics.median(seconds) * 1000:7.1f} ms  max {max(seconds) * 1000:7.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare time to first audio of write-then-play and streamed speech")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--first-byte-delay", type=float, default=0.2)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with FakeOpenAIServer(first_byte_delay=args.first_byte_delay, chunk_delay=args.chunk_delay) as server, \
+            tempfile.TemporaryDirectory() as tmp:
+        client = OpenAI(base_url=server.base_url, api_key="benchmark")
+        results = {"write-then-play": ([], []), "streamed": ([], [])}
+        for round_idx in range(args.rounds):
+            # a fresh cache every round, a cache hit would measure the disk instead of synthesis
+            synthesizer = SpeechSynthesizer(client, AudioCache(f"{tmp}/cache-{round_idx}"))
+            for reply_idx, text in enumerate(_REPLIES):
+                for name, (first, total) in (
+                        ("write-then-play", write_then_play(client, text, Path(tmp) / f"{round_idx}-{reply_idx}.mp3")),
+                        ("streamed", streamed(synthesizer, text))):
+                    results[name][0].append(first)
+                    results[name][1].append(total)
+            synthesizer.shutdown()
+
+    for name, (first, total) in results.items():
+        print(f"{name:>15}: first audio {_stats(first)}  complete {_stats(total)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import sys
+
+from tandem.script_converter import get_default_converter
+
+# phrases the local conversion got wrong before, with the expected characters and pinyin
+_CASES = [
+    ("我们的话题", "我們的話題", "Wǒmen de huàtí"),
+    ("关于停车的话题", "關於停車的話題", "Guān yú tíng chē de huàtí"),
+    ("头发干了", "頭髮乾了", "Tóufa gān le"),
+    ("你有时间的话就来吧。", "你有時間的話就來吧。", "Nǐ yǒu shí jiān dehuà jiù lái ba."),
+    ("他干了什么？", "他幹了什麼？", "Tā gàn le shénme?"),
+    ("我们去银行吧！", "我們去銀行吧！", "Wǒmen qù yínháng ba!"),
+]
+
+if __name__ == '__main__':
+    converter = get_default_converter()
+    failed = 0
+    for simplified, traditional, pinyin in _CASES:
+        converted = converter.to_traditional(simplified)
+        converted_pinyin = converter.to_pinyin(converted)
+        if (converted, converted_pinyin) != (traditional, pinyin):
+            failed += 1
+            print(f"{simplified}: expected {traditional} {pinyin}, got {converted} {converted_pinyin}")
+    print(f"{len(_CASES) - failed} of {len(_CASES)} conversions correct")
+    sys.exit(1 if failed else 0)
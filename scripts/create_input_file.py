@@ -1,12 +1,23 @@
-with open("3000-traditional-hanzi.tsv", encoding="utf8") as srcf, open("3000-traditional-hanzi-output.tsv", mode="w", encoding="utf8") as outf:
-    for line in srcf:
-        try:
-            line_list = line.split("\t")
-            character = line_list[0]
-            pinyin = line_list[4]
-            meaning = line_list[6]
-            vocabulary = line_list[7]
-            vocabulary_pinyin = line_list[8]
-            outf.write(f"{character}\t{pinyin}\t{meaning}\t{vocabulary}\t{vocabulary_pinyin}\n")
-        except:
-            print(line)
+import argparse
+import sys
+from pathlib import Path
+
+from tandem.dictionary import _DEFAULT_DICTIONARY_PATH, _DEFAULT_RAW_PATH, build_dictionary
+
+if __name__ == '__main__':
+    root = Path(__file__).parent.parent
+    parser = argparse.ArgumentParser(description="Validate the raw character export and write the character table "
+                                                 "and the binary character dictionary")
+    parser.add_argument("--raw", default=_DEFAULT_RAW_PATH)
+    parser.add_argument("--tsv", default=f"{root}/data/3000-traditional-hanzi.tsv",
+                        help="character table read by the retrieval and vocabulary modules")
+    parser.add_argument("--dictionary", default=_DEFAULT_DICTIONARY_PATH, help="memory-mapped lookup file")
+    args = parser.parse_args()
+
+    stats = build_dictionary(args.raw, args.dictionary, args.tsv)
+    for error in stats.errors:
+        print(f"{args.raw}:{error.line}: {error.reason}", file=sys.stderr)
+    print(f"wrote {stats.rows} characters to {args.tsv} and {args.dictionary} ({stats.seconds * 1000:.0f} ms), "
+          f"{len(stats.errors)} invalid rows skipped")
+    # the valid rows are written either way, the exit status tells a build that the export needs fixing
+    sys.exit(1 if stats.errors else 0)
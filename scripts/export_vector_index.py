@@ -0,0 +1,7 @@
+from tandem.vector_index import export_chroma_embeddings
+from pathlib import Path
+
+if __name__ == '__main__':
+    root = Path(__file__).parent.parent
+    rows = export_chroma_embeddings(f"{root}/.chroma/3000-traditional-hanzi", f"{root}/.index/3000-traditional-hanzi")
+    print(f"exported {rows} rows")
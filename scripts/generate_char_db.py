@@ -5,4 +5,6 @@ from pathlib import Path
 if __name__ == '__main__':
     load_dotenv(override=True)
     root = Path(__file__).parent.parent
-    generate_character_db(f"{root}/data/3000-traditional-hanzi.tsv", f"{root}/.chroma/3000-traditional-hanzi")
\ No newline at end of file
+    stats = generate_character_db(f"{root}/data/3000-traditional-hanzi.tsv", f"{root}/.chroma/3000-traditional-hanzi")
+    print(f"added: {stats.added}, changed: {stats.changed}, deleted: {stats.deleted}, skipped: {stats.skipped} "
+          f"({stats.seconds:.1f}s)")
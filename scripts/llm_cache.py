@@ -0,0 +1,28 @@
+import argparse
+
+from tandem.llm_cache import _DEFAULT_CACHE_PATH, ResponseCache
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect and prune the cache of deterministic LLM responses")
+    parser.add_argument("--path", default=_DEFAULT_CACHE_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="entries, stored size and hits per model")
+    prune = subparsers.add_parser("prune", help="remove responses not used recently")
+    prune.add_argument("--older-than-days", type=float, help="remove responses unused for this many days")
+    prune.add_argument("--max-entries", type=int, help="keep only this many of the most recently used responses")
+    subparsers.add_parser("clear", help="remove all responses")
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.path)
+    if args.command == "stats":
+        rows = cache.summary()
+        for model, entries, size, hits in rows:
+            print(f"{model or '(default model)'}: {entries} responses, {size / 1024:.1f} KiB, {hits} hits")
+        print(f"total: {sum(row[1] for row in rows)} responses, {sum(row[3] for row in rows)} hits")
+    elif args.command == "prune":
+        max_age_s = args.older_than_days * 24 * 3600 if args.older_than_days is not None else None
+        print(f"removed {cache.prune(max_age_s=max_age_s, max_entries=args.max_entries)} responses")
+    else:
+        cache.clear()
+        print(f"cleared {args.path}")
+    cache.close()
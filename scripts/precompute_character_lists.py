@@ -0,0 +1,43 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from tandem.char_retrieval_chain import _DEFAULT_DOC_PATH, get_character_lists
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Retrieve the character lists of many topics in one batch")
+    parser.add_argument("topics_file", nargs="?", help="file with one topic per line")
+    parser.add_argument("--topics", nargs="+", default=[], help="topics in addition to the topics file")
+    parser.add_argument("--output", required=True, help="json file mapping each topic to its character list")
+    parser.add_argument("--db-path", default=_DEFAULT_DOC_PATH)
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default="chroma")
+    parser.add_argument("--mode", choices=["vector", "lexical", "hybrid"], default="vector")
+    parser.add_argument("--direct-selection", action="store_true",
+                        help="use the top retrieved characters instead of letting the llm select them")
+    parser.add_argument("--concurrency", type=int, default=8, help="selection prompts in flight at once")
+    args = parser.parse_args()
+
+    topics = list(args.topics)
+    if args.topics_file:
+        with open(args.topics_file, encoding="utf-8") as f:
+            topics += [line.strip() for line in f if line.strip()]
+    if not topics:
+        parser.error("no topics given")
+
+    results = get_character_lists(topics, args.db_path, args.backend, args.mode, not args.direct_selection,
+                                  args.concurrency)
+    # an existing file keeps the lists of topics that failed this time
+    output = Path(args.output)
+    character_lists = json.loads(output.read_text(encoding="utf-8")) if output.exists() else {}
+    failed = 0
+    for result in results:
+        if result.error is None:
+            character_lists[result.topic] = result.character_list
+        else:
+            failed += 1
+            print(f"{result.topic}: {result.error}", file=sys.stderr)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(character_lists, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"wrote {len(results) - failed} of {len(results)} topics to {output}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,66 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+
+_DEFAULT_AUDIO_DIR = Path(__file__).parent.parent / ".cache" / "audio"
+
+
+class AudioCache:
+    def __init__(self, directory: str = str(_DEFAULT_AUDIO_DIR), max_bytes: int = 200 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str, voice: str, model: str, response_format: str = "mp3") -> str:
+        # the same text spoken by the same voice is the same audio, whichever session or row it came from
+        return hashlib.sha256("\0".join((model, voice, response_format, text)).encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.mp3"
+
+    def get(self, key: str) -> Optional[Path]:
+        path = self.path(key)
+        try:
+            # the modification time doubles as the last access time for LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def partial_path(self, key: str, writer: Optional[str] = None) -> Path:
+        # one partial file per writer, coroutines on one thread pass their own name
+        return self.path(key).with_suffix(f".{writer or threading.get_ident()}.part")
+
+    def commit(self, key: str, partial: Path) -> Path:
+        path = self.path(key)
+        # readers never see a half-written file
+        os.replace(partial, path)
+        self.evict()
+        return path
+
+    def put(self, key: str, data: bytes) -> Path:
+        partial = self.partial_path(key)
+        partial.write_bytes(data)
+        return self.commit(key, partial)
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for path in self.directory.glob("*.mp3"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            entries.sort()
+            while total > self.max_bytes and entries:
+                _, size, path = entries.pop(0)
+                path.unlink(missing_ok=True)
+                total -= size
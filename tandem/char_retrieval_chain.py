@@ -1,34 +1,36 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain_community.document_loaders import TextLoader
+from typing import NamedTuple, Optional
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 from langchain.prompts import ChatPromptTemplate
+from langchain.retrievers import EnsembleRetriever
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from tandem.clients import get_clients
+from tandem.llm_cache import CachedChatOpenAI, get_response_cache
+from tandem.tracing import STAGE_RETRIEVAL, get_tracer
 
 
 _DEFAULT_DOC_PATH = f"{Path(__file__).parent.parent}/.chroma/3000-traditional-hanzi"
+_DEFAULT_CACHE_DIR = f"{Path(__file__).parent.parent}/.cache"
+_DEFAULT_VECTOR_INDEX_PATH = f"{Path(__file__).parent.parent}/.index/3000-traditional-hanzi"
+_DEFAULT_LEXICAL_INDEX_PATH = f"{Path(__file__).parent.parent}/.index/3000-traditional-hanzi-lexical.json.gz"
+_DEFAULT_CHARACTER_PATH = f"{Path(__file__).parent.parent}/data/3000-traditional-hanzi.tsv"
 
-def generate_character_db(character_txt_path: str, persist_directory: Optional[str] = None):
-    persist_directory = persist_directory or f".chroma/{Path(character_txt_path).stem}"
-
-    loader = TextLoader(character_txt_path, encoding="utf-8")
-    char_documents = loader.load()
-
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=20, separators=["\n"])
-    splitted_docs = splitter.split_documents(char_documents)
-
-    db = Chroma.from_documents(splitted_docs, embedding=OpenAIEmbeddings(), persist_directory=persist_directory)
-    return db
-
-
-def get_character_list(topic, db_path: str = _DEFAULT_DOC_PATH) -> str:
-    db = Chroma(persist_directory=db_path, embedding_function=OpenAIEmbeddings())
-
-    prompt = ChatPromptTemplate.from_template(
-"""
+_SELECTION_PROMPT = """
 Please select up to 10 characters from the provided context that could be used in a conversation about the provided topic.
 
 <context>
@@ -41,10 +43,383 @@ Output format:
 漢子(pīnyīn) - English
 …
 """
+
+class TopicResult(NamedTuple):
+    topic: str
+    character_list: Optional[str]
+    error: Optional[str]
+
+
+class IndexStats(NamedTuple):
+    added: int
+    changed: int
+    deleted: int
+    skipped: int
+    seconds: float
+
+
+def load_character_documents(character_txt_path: str) -> list[Document]:
+    documents = {}
+    with open(character_txt_path, encoding="utf-8") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 3 or not columns[0]:
+                continue
+            char, pinyin, meaning = columns[:3]
+            vocabulary = columns[3] if len(columns) > 3 else ""
+            vocabulary_pinyin = columns[4] if len(columns) > 4 else ""
+
+            content = f"{char}({pinyin}) - {meaning}"
+            if vocabulary:
+                content += f"\n{vocabulary} ({vocabulary_pinyin})"
+            documents[char] = Document(id=char, page_content=content, metadata={
+                "char": char,
+                "pinyin": pinyin,
+                "meaning": meaning,
+                "vocabulary": vocabulary,
+                "vocabulary_pinyin": vocabulary_pinyin,
+                "content_hash": hashlib.sha1(line.rstrip("\n").encode("utf-8")).hexdigest(),
+            })
+    return list(documents.values())
+
+
+def generate_character_db(character_txt_path: str, persist_directory: Optional[str] = None,
+                          batch_size: int = 100, max_workers: int = 4,
+                          embeddings: Optional[Embeddings] = None) -> IndexStats:
+    start = time.perf_counter()
+    persist_directory = persist_directory or f".chroma/{Path(character_txt_path).stem}"
+
+    embeddings = embeddings or get_clients().embeddings()
+    db = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
+    existing = db.get(include=["metadatas"])
+    existing_hashes = {
+        doc_id: (metadata or {}).get("content_hash") for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+    }
+
+    documents = load_character_documents(character_txt_path)
+    outdated = [doc for doc in documents if existing_hashes.get(doc.id) != doc.metadata["content_hash"]]
+    # ids that are no longer in the file, including the text chunks of a database built before the per-row index
+    document_ids = {doc.id for doc in documents}
+    deleted = [doc_id for doc_id in existing_hashes if doc_id not in document_ids]
+
+    batches = [outdated[i:i + batch_size] for i in range(0, len(outdated), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        vectors = pool.map(lambda batch: embeddings.embed_documents([doc.page_content for doc in batch]), batches)
+        for batch, batch_vectors in zip(batches, vectors):
+            db._collection.upsert(
+                ids=[doc.id for doc in batch],
+                embeddings=batch_vectors,
+                metadatas=[doc.metadata for doc in batch],
+                documents=[doc.page_content for doc in batch],
+            )
+    if deleted:
+        db.delete(ids=deleted)
+
+    added = sum(1 for doc in outdated if doc.id not in existing_hashes)
+    return IndexStats(
+        added=added,
+        changed=len(outdated) - added,
+        deleted=len(deleted),
+        skipped=len(documents) - len(outdated),
+        seconds=time.perf_counter() - start,
     )
 
-    document_chain = create_stuff_documents_chain(llm=ChatOpenAI(), prompt=prompt)
-    retriever = db.as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    result = retrieval_chain.invoke({"input": topic})
-    return result["answer"]
+
+def _is_character_index(metadata: Optional[dict]) -> bool:
+    # databases built before the per-row index hold text chunks with only a source, the selection
+    # prompt would get whole chunks and direct selection has no characters to list
+    return metadata is not None and "char" in metadata
+
+
+class TopicCache:
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 1 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, str] = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+        if path and Path(path).exists():
+            with open(path, encoding="utf-8") as f:
+                for topic, character_list in json.load(f):
+                    self.entries[topic] = character_list
+                    self.size += self._entry_size(topic, character_list)
+
+    @staticmethod
+    def _key(topic: str) -> str:
+        return " ".join(topic.lower().split())
+
+    @staticmethod
+    def _entry_size(key: str, value: str) -> int:
+        return len(key.encode("utf-8")) + len(value.encode("utf-8"))
+
+    def get(self, topic: str) -> Optional[str]:
+        key = self._key(topic)
+        with self._lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, topic: str, character_list: str):
+        key = self._key(topic)
+        with self._lock:
+            if key in self.entries:
+                self.size -= self._entry_size(key, self.entries.pop(key))
+            self.entries[key] = character_list
+            self.size += self._entry_size(key, character_list)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                self.size -= self._entry_size(evicted_key, evicted_value)
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, mode="w", encoding="utf-8") as f:
+            json.dump(list(self.entries.items()), f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+class CharacterRetriever:
+    def __init__(self, db_path: str = _DEFAULT_DOC_PATH, cache_dir: Optional[str] = _DEFAULT_CACHE_DIR,
+                 topic_cache_bytes: int = 1 << 20, k: int = 30, backend: str = "chroma", mode: str = "vector",
+                 llm_selection: bool = True, vector_index_path: str = _DEFAULT_VECTOR_INDEX_PATH,
+                 character_txt_path: str = _DEFAULT_CHARACTER_PATH, lexical_index_path: str = _DEFAULT_LEXICAL_INDEX_PATH):
+        if backend not in ("chroma", "numpy"):
+            raise ValueError(f"Unknown retriever backend: {backend}")
+        if mode not in ("vector", "lexical", "hybrid"):
+            raise ValueError(f"Unknown retrieval mode: {mode}")
+        self.db_path = db_path
+        self.k = k
+        self.backend = backend
+        self.mode = mode
+        self.llm_selection = llm_selection
+        self.vector_index_path = vector_index_path
+        self.character_txt_path = character_txt_path
+        self.lexical_index_path = lexical_index_path
+        # lexical retrieval runs offline, the embedding client needs an api key
+        embeddings = get_clients().embeddings() if mode != "lexical" else None
+        topic_cache_path = None
+        if cache_dir:
+            if embeddings is not None:
+                # embeddings are keyed by model and text, so query vectors of repeated topics are never requested twice
+                embeddings = CacheBackedEmbeddings.from_bytes_store(
+                    embeddings,
+                    LocalFileStore(f"{cache_dir}/embeddings"),
+                    namespace=embeddings.model,
+                    query_embedding_cache=True,
+                )
+            variant = mode if llm_selection else f"{mode}-direct"
+            topic_cache_path = f"{cache_dir}/{Path(db_path).name}-{variant}-topics.json"
+        self.embeddings: Optional[Embeddings] = embeddings
+        self.topic_cache = TopicCache(topic_cache_path, max_bytes=topic_cache_bytes)
+        self._db = None
+        self._vector_retriever = None
+        self._lexical_retriever = None
+        self._retriever = None
+        self._document_chain = None
+        self._retrieval_chain = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self) -> Chroma:
+        with self._lock:
+            if self._db is None:
+                db = Chroma(persist_directory=self.db_path, embedding_function=self.embeddings)
+                existing = db.get(limit=1, include=["metadatas"])
+                if not _is_character_index(existing["metadatas"][0] if existing["ids"] else None):
+                    # the shipped database still holds the text chunks, it is rebuilt in place on first use.
+                    # the rows are embedded through the cache, a rebuild that was interrupted resumes cheaply
+                    generate_character_db(self.character_txt_path, self.db_path, embeddings=self.embeddings)
+                    db = Chroma(persist_directory=self.db_path, embedding_function=self.embeddings)
+                self._db = db
+            return self._db
+
+    @property
+    def vector_retriever(self) -> BaseRetriever:
+        if self._vector_retriever is None:
+            if self.backend == "numpy":
+                from tandem.vector_index import NumpyRetriever, NumpyVectorIndex, build_vector_index
+                index = NumpyVectorIndex(self.vector_index_path) if Path(self.vector_index_path).exists() else None
+                if index is None or not _is_character_index(index.document(0).metadata if len(index) else None):
+                    # missing, or exported from the chunk database
+                    build_vector_index(load_character_documents(self.character_txt_path), self.embeddings,
+                                       self.vector_index_path)
+                    index = NumpyVectorIndex(self.vector_index_path)
+                self._vector_retriever = NumpyRetriever(index=index, embeddings=self.embeddings, k=self.k)
+            else:
+                self._vector_retriever = self.db.as_retriever(search_kwargs={"k": self.k})
+        return self._vector_retriever
+
+    @property
+    def lexical_retriever(self) -> BaseRetriever:
+        if self._lexical_retriever is None:
+            from tandem.lexical_index import LexicalIndex, LexicalRetriever
+            index = LexicalIndex.load_or_build(self.lexical_index_path, self.character_txt_path, load_character_documents)
+            self._lexical_retriever = LexicalRetriever(index=index, k=self.k)
+        return self._lexical_retriever
+
+    @property
+    def retriever(self):
+        if self._retriever is None:
+            if self.mode == "lexical":
+                self._retriever = self.lexical_retriever
+            elif self.mode == "hybrid":
+                # reciprocal-rank fusion of both result lists, the lexical results alone if the embedding call fails
+                vector_retriever = self.vector_retriever.with_fallbacks([self.lexical_retriever])
+                self._retriever = EnsembleRetriever(retrievers=[self.lexical_retriever, vector_retriever],
+                                                    weights=[0.5, 0.5])
+            else:
+                self._retriever = self.vector_retriever
+        return self._retriever
+
+    @property
+    def document_chain(self):
+        if self._document_chain is None:
+            prompt = ChatPromptTemplate.from_template(_SELECTION_PROMPT)
+            # the selection only depends on the topic and the retrieved characters, so it is sampled at 0 and cached
+            llm = get_clients().chat_model(CachedChatOpenAI, temperature=0, cache=get_response_cache())
+            self._document_chain = create_stuff_documents_chain(llm=llm, prompt=prompt)
+        return self._document_chain
+
+    @property
+    def retrieval_chain(self):
+        if self._retrieval_chain is None:
+            self._retrieval_chain = create_retrieval_chain(self.retriever, self.document_chain)
+        return self._retrieval_chain
+
+    @staticmethod
+    def _format_documents(documents: list[Document]) -> str:
+        return "\n".join(
+            f"{doc.metadata['char']}({doc.metadata['pinyin']}) - {doc.metadata['meaning']}" for doc in documents[:10]
+        )
+
+    def _select_directly(self, topic: str) -> str:
+        return self._format_documents(self.retriever.invoke(topic))
+
+    def get_character_list(self, topic: str) -> str:
+        character_list = self.topic_cache.get(topic)
+        get_tracer().cache_access("topic", character_list is not None)
+        if character_list is None:
+            if self.llm_selection:
+                character_list = self.retrieval_chain.invoke({"input": topic}, config=get_tracer().run_config())["answer"]
+            else:
+                character_list = self._select_directly(topic)
+            self.topic_cache.put(topic, character_list)
+        return character_list
+
+    def _embed_topics(self, topics: list[str]) -> list[list[float]]:
+        # one request for all topics, embed_query would send one per topic
+        embeddings = self.embeddings
+        if not isinstance(embeddings, CacheBackedEmbeddings) or embeddings.query_embedding_store is None:
+            return embeddings.embed_documents(topics)
+        vectors = embeddings.query_embedding_store.mget(topics)
+        missing = [topic for topic, vector in zip(topics, vectors) if vector is None]
+        if missing:
+            # stored as query embeddings, a later get_character_list of the same topic finds them
+            embedded = dict(zip(missing, embeddings.underlying_embeddings.embed_documents(missing)))
+            embeddings.query_embedding_store.mset(list(embedded.items()))
+            vectors = [vector if vector is not None else embedded[topic] for topic, vector in zip(topics, vectors)]
+        return vectors
+
+    def _search_vectors(self, vectors: list[list[float]]) -> list[list[Document]]:
+        if self.backend == "numpy":
+            return self.vector_retriever.search_by_vectors(vectors)
+        # one query for all topics
+        results = self.db._collection.query(query_embeddings=vectors, n_results=self.k,
+                                            include=["documents", "metadatas"])
+        return [
+            [Document(id=doc_id, page_content=content, metadata=metadata)
+             for doc_id, content, metadata in zip(ids, contents, metadatas)]
+            for ids, contents, metadatas in zip(results["ids"], results["documents"], results["metadatas"])
+        ]
+
+    def _retrieve_lexical(self, topic: str):
+        # a failing topic gets its exception in its slot, the other topics are still answered
+        try:
+            return self.lexical_retriever.invoke(topic)
+        except Exception as e:
+            return e
+
+    def _retrieve_batch(self, topics: list[str]) -> list:
+        lexical = [self._retrieve_lexical(topic) for topic in topics] if self.mode != "vector" else None
+        if self.mode == "lexical":
+            return lexical
+        try:
+            vector = self._search_vectors(self._embed_topics(topics))
+        except Exception as e:
+            if self.mode == "vector":
+                return [e] * len(topics)
+            # like the single-topic hybrid retriever, the lexical results alone if the embedding call fails
+            return lexical
+        if self.mode == "vector":
+            return vector
+        return [vector_docs if isinstance(lexical_docs, Exception)
+                else self.retriever.weighted_reciprocal_rank([lexical_docs, vector_docs])
+                for lexical_docs, vector_docs in zip(lexical, vector)]
+
+    async def aget_character_lists(self, topics: list[str], max_concurrency: int = 8) -> list[TopicResult]:
+        results: dict[str, TopicResult] = {}
+        pending = []
+        for topic in dict.fromkeys(topics):
+            if not topic.strip():
+                # nothing to retrieve for, the selection would still answer with some list
+                results[topic] = TopicResult(topic, None, "empty topic")
+                continue
+            character_list = self.topic_cache.get(topic)
+            get_tracer().cache_access("topic", character_list is not None)
+            if character_list is not None:
+                results[topic] = TopicResult(topic, character_list, None)
+            else:
+                pending.append(topic)
+
+        if pending:
+            documents = await asyncio.to_thread(self._retrieve_batch, pending)
+            retrieved = []
+            for topic, topic_documents in zip(pending, documents):
+                if isinstance(topic_documents, Exception):
+                    results[topic] = TopicResult(topic, None, f"{type(topic_documents).__name__}: {topic_documents}")
+                else:
+                    retrieved.append((topic, topic_documents))
+
+            if self.llm_selection:
+                # every selection is its own prompt, at most max_concurrency of them in flight
+                answers = await self.document_chain.abatch(
+                    [{"input": topic, "context": topic_documents} for topic, topic_documents in retrieved],
+                    config={**get_tracer().run_config(), "max_concurrency": max_concurrency},
+                    return_exceptions=True,
+                )
+            else:
+                answers = [self._format_documents(topic_documents) for _, topic_documents in retrieved]
+            for (topic, _), answer in zip(retrieved, answers):
+                if isinstance(answer, Exception):
+                    results[topic] = TopicResult(topic, None, f"{type(answer).__name__}: {answer}")
+                else:
+                    self.topic_cache.put(topic, answer)
+                    results[topic] = TopicResult(topic, answer, None)
+        return [results[topic] for topic in topics]
+
+    def get_character_lists(self, topics: list[str], max_concurrency: int = 8) -> list[TopicResult]:
+        return asyncio.run(self.aget_character_lists(topics, max_concurrency))
+
+
+@lru_cache(maxsize=None)
+def get_character_retriever(db_path: str = _DEFAULT_DOC_PATH, backend: str = "chroma", mode: str = "vector",
+                            llm_selection: bool = True) -> CharacterRetriever:
+    return CharacterRetriever(db_path, backend=backend, mode=mode, llm_selection=llm_selection)
+
+
+def get_character_list(topic, db_path: str = _DEFAULT_DOC_PATH, backend: str = "chroma", mode: str = "vector",
+                       llm_selection: bool = True) -> str:
+    with get_tracer().span(STAGE_RETRIEVAL, topic=topic, mode=mode):
+        return get_character_retriever(db_path, backend, mode, llm_selection).get_character_list(topic)
+
+
+def get_character_lists(topics: list[str], db_path: str = _DEFAULT_DOC_PATH, backend: str = "chroma",
+                        mode: str = "vector", llm_selection: bool = True,
+                        max_concurrency: int = 8) -> list[TopicResult]:
+    with get_tracer().span(STAGE_RETRIEVAL, topics=len(topics), mode=mode):
+        retriever = get_character_retriever(db_path, backend, mode, llm_selection)
+        return retriever.get_character_lists(topics, max_concurrency)
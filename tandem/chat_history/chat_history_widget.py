@@ -1,7 +1,7 @@
 from typing import Optional
 
 from PySide6.QtWidgets import QAbstractItemView, QListView, QVBoxLayout, QWidget
-from PySide6.QtCore import QEasingCurve, QPropertyAnimation, Signal
+from PySide6.QtCore import QEasingCurve, QModelIndex, QPropertyAnimation, Signal
 from chat_history.history_model import HistoryModel
 from chat_history.history_item_delegate import HistoryItemDelegate
 
@@ -18,33 +18,88 @@ class ChatHistoryWidget(QWidget):
         self.listview.setModel(self.history_model)
         self.listview.setItemDelegate(self.item_delegate)
         self.listview.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.listview.setResizeMode(QListView.ResizeMode.Adjust)
+        # QListView re-lays out every row on insert, batching keeps that pass from blocking a frame
+        self.listview.setLayoutMode(QListView.LayoutMode.Batched)
+        self.listview.setBatchSize(200)
 
         self.vlayout = QVBoxLayout()
         self.vlayout.addWidget(self.listview)
         self.setLayout(self.vlayout)
 
-        self.history_model.rowsInserted.connect(self.animateScrollToBottom)
-        self.history_model.rowsRemoved.connect(self.animateScrollToBottom)
+        self.scroll_animation = QPropertyAnimation(self.listview.verticalScrollBar(), b"value", self)
+        self.scroll_animation.setEasingCurve(QEasingCurve.Type.InOutQuad)
+        self.scroll_animation.setDuration(500)
+        self._animate_to_bottom = False
+        # distance from the bottom to keep while older rows are prepended above the viewport
+        self._bottom_anchor: Optional[int] = None
+        self._restoring_anchor = False
+        # a resumed session opens at its latest message
+        self._stick_to_bottom = self.history_model.rowCount() > 0
 
-    def animateScrollToBottom(self):
-        if self.history_model.rowCount() > 0:
+        self.history_model.rowsInserted.connect(self._rows_inserted)
+        self.history_model.rowsRemoved.connect(self._rows_removed)
+        self.history_model.modelReset.connect(self.item_delegate.clear)
+        self.history_model.dataChanged.connect(self._data_changed)
+        self.listview.verticalScrollBar().rangeChanged.connect(self._scroll_range_changed)
+        self.listview.verticalScrollBar().valueChanged.connect(self._scroll_value_changed)
+        self.listview.doubleClicked.connect(lambda index: self.play_clicked.emit(index.row()))
+
+    def _rows_inserted(self, parent: QModelIndex, first: int, last: int):
+        self.item_delegate.rows_inserted(first, last)
+        if first == 0 and last < self.history_model.rowCount() - 1:
+            # older rows were paged in, the visible rows stay where they are
             bar = self.listview.verticalScrollBar()
-            current_value = bar.value()
+            self._bottom_anchor = bar.maximum() - bar.value()
+            return
+        self._bottom_anchor = None
+        self.animateScrollToBottom()
 
-            # force calculation of maximum
-            self.listview.scrollToBottom()
+    def _rows_removed(self, parent: QModelIndex, first: int, last: int):
+        self.item_delegate.clear()
+        self.animateScrollToBottom()
 
-            bar.setValue(current_value)
-            self.animateScrollTo(bar.maximum())
+    def _data_changed(self, top_left: QModelIndex, bottom_right: QModelIndex):
+        bar = self.listview.verticalScrollBar()
+        self._stick_to_bottom = self._stick_to_bottom or bar.value() == bar.maximum()
 
-    def animateScrollTo(self, y: int):
-        scroll_animation = QPropertyAnimation(
-            self.listview.verticalScrollBar(), b"value", self
-        )
+        # a streamed message grows in place, the view only re-layouts rows whose size hint changed
+        for row in range(top_left.row(), bottom_right.row() + 1):
+            self.item_delegate.invalidate(row)
+            self.item_delegate.sizeHintChanged.emit(self.history_model.index(row))
+
+    def _scroll_value_changed(self, value: int):
+        bar = self.listview.verticalScrollBar()
+        if self._restoring_anchor:
+            return
+        # the anchor holds until the user scrolls, batched layout grows the range in several steps
+        self._bottom_anchor = None
+        if value == bar.minimum() and bar.maximum() > bar.minimum():
+            self.history_model.fetch_older = True
+            if self.history_model.canFetchMore(QModelIndex()):
+                self.history_model.fetchMore(QModelIndex())
 
-        scroll_animation.setStartValue(self.listview.verticalScrollBar().value())
+    def _scroll_range_changed(self, minimum: int, maximum: int):
+        # the view lays out new rows lazily, so scrolling waits for the new maximum instead of forcing a layout
+        if self._bottom_anchor is not None:
+            self._restoring_anchor = True
+            self.listview.verticalScrollBar().setValue(maximum - self._bottom_anchor)
+            self._restoring_anchor = False
+        elif self.scroll_animation.state() == QPropertyAnimation.State.Running:
+            self.scroll_animation.setEndValue(maximum)
+        elif self._animate_to_bottom:
+            self.animateScrollTo(maximum)
+        elif self._stick_to_bottom:
+            self.listview.verticalScrollBar().setValue(maximum)
+        self._animate_to_bottom = False
+        self._stick_to_bottom = False
 
-        scroll_animation.setEndValue(y)
-        scroll_animation.setEasingCurve(QEasingCurve.Type.InOutQuad)
-        scroll_animation.setDuration(500)
-        scroll_animation.start()
+    def animateScrollToBottom(self):
+        if self.history_model.rowCount() > 0:
+            self._animate_to_bottom = True
+
+    def animateScrollTo(self, y: int):
+        self.scroll_animation.stop()
+        self.scroll_animation.setStartValue(self.listview.verticalScrollBar().value())
+        self.scroll_animation.setEndValue(y)
+        self.scroll_animation.start()
@@ -1,85 +1,192 @@
-from PySide6.QtCore import Qt, QModelIndex, QRect, QSize
-from PySide6.QtGui import QPainter, QStaticText
-from PySide6.QtWidgets import QApplication, QStyledItemDelegate, QStyleOptionViewItem, QListView
-from chat_history.history_model import HistoryItem
+import html
+from typing import Optional
+
+from PySide6.QtCore import Qt, QEvent, QModelIndex, QPoint, QPointF, QRect, QSize
+from PySide6.QtGui import QFontMetrics, QHelpEvent, QPainter, QStaticText, QTextLayout, QTextLine, QTransform
+from PySide6.QtWidgets import QAbstractItemView, QStyledItemDelegate, QStyleOptionViewItem, QListView, QToolTip
+from chat_history.history_model import AuthorRole, MessageRole, OutgoingRole, TimestampRole
+from tandem.dictionary import CharacterDictionary, get_character_dictionary
+from tandem.script_converter import get_default_converter
 
 
 _PAD = 8
 
 
+class _RowLayout:
+    __slots__ = ("text", "text_width", "text_height", "author_line", "author_width", "size_hint", "hit_layout")
+
+
+def _char_at_utf16(text: str, position: int) -> str:
+    # Qt counts UTF-16 code units, characters outside the BMP take two
+    return text.encode("utf-16-le")[2 * position:2 * position + 4].decode("utf-16-le", errors="ignore")[:1]
+
+
 class HistoryItemDelegate(QStyledItemDelegate):
     def __init__(self, parent: QListView = None):
         super(HistoryItemDelegate, self).__init__(parent)
         self.view = parent
+        # text layouts per row, valid for self._layout_width only
+        self._layouts: dict[int, _RowLayout] = {}
+        self._layout_width = -1
+        # opened on the first lookup, the file is memory-mapped so a lookup reads a few pages at most
+        self._dictionary: Optional[CharacterDictionary] = None
+        self._dictionary_failed = False
 
     def get_painted_message(self, index: QModelIndex):
-        item : HistoryItem = index.data()
-        message = "\n\n".join((item.traditional, item.pinyin, item.english)).rstrip("\n")
-        return message
+        return index.data(MessageRole)
 
-    def get_rects(self, option: QStyleOptionViewItem, index: QModelIndex):
-        message = self.get_painted_message(index)
-        option_rect = option.rect
-        font_metrics = QApplication.fontMetrics()
-        max_width = option_rect.width() - 2 * _PAD
+    def invalidate(self, row: int):
+        self._layouts.pop(row, None)
+
+    def rows_inserted(self, first: int, last: int):
+        count = last - first + 1
+        if any(row >= first for row in self._layouts):
+            self._layouts = {row + count if row >= first else row: layout for row, layout in self._layouts.items()}
 
-        msg_rect_no_wrap = font_metrics.boundingRect(message)
+    def clear(self):
+        self._layouts.clear()
 
-        text_width = min(msg_rect_no_wrap.width() + _PAD, max_width)
+    def _build_layout(self, index: QModelIndex, width: int) -> _RowLayout:
+        font = self.view.font()
+        font_metrics = QFontMetrics(font)
+        message = self.get_painted_message(index)
+        max_width = width - 2 * _PAD
+
+        natural_width = max(font_metrics.horizontalAdvance(line) for line in message.split("\n"))
+        text_width = max(min(natural_width + _PAD, max_width), 1)
+
+        layout = _RowLayout()
+        # QStaticText breaks plain text lines at the unicode line separator, not at \n
+        layout.text = QStaticText(message.replace("\n", "\u2028"))
+        layout.text.setTextFormat(Qt.TextFormat.PlainText)
+        layout.text.setTextWidth(text_width)
+        layout.text.prepare(QTransform(), font)
+        layout.text_width = text_width
+        layout.text_height = int(layout.text.size().height()) + 1
+        layout.hit_layout = None
+
+        author_line = f"{index.data(AuthorRole)} {index.data(TimestampRole)}"
+        layout.author_line = QStaticText(author_line)
+        layout.author_line.prepare(QTransform(), font)
+        layout.author_width = font_metrics.horizontalAdvance(author_line)
 
+        sender_height = font_metrics.height() + 2 * _PAD
+        layout.size_hint = QSize(text_width + 2 * _PAD, layout.text_height + 2 * _PAD + sender_height)
+        return layout
+
+    def get_layout(self, index: QModelIndex) -> _RowLayout:
+        width = self.view.viewport().width()
+        if width != self._layout_width:
+            self._layouts.clear()
+            self._layout_width = width
+
+        layout = self._layouts.get(index.row())
+        if layout is None:
+            layout = self._build_layout(index, width)
+            self._layouts[index.row()] = layout
+        return layout
+
+    @staticmethod
+    def _text_origin(option_rect: QRect, layout: _RowLayout, outgoing: bool) -> tuple[int, int]:
         x = option_rect.left() + _PAD
         y = option_rect.top() + _PAD
-        even_row = index.row() & 1 == 0
-        if even_row:
-            x = option_rect.left() + option_rect.width() - text_width - 2 * _PAD
-
-        msg_rect = font_metrics.boundingRect(
-            x, y, text_width, msg_rect_no_wrap.height(), Qt.TextFlag.TextWordWrap, message
-        )
-
-        return msg_rect
+        if outgoing:
+            x = option_rect.left() + option_rect.width() - layout.text_width - 2 * _PAD
+        return x, y
+
+    def _hit_layout(self, layout: _RowLayout) -> QTextLayout:
+        # QStaticText keeps no positions, the same lines are laid out again the way it does it
+        if layout.hit_layout is None:
+            text_layout = QTextLayout(layout.text.text(), self.view.font())
+            text_layout.setTextOption(layout.text.textOption())
+            text_layout.beginLayout()
+            height = 0.0
+            while True:
+                line = text_layout.createLine()
+                if not line.isValid():
+                    break
+                line.setLeadingIncluded(True)
+                line.setLineWidth(layout.text_width)
+                line.setPosition(QPointF(0.0, height))
+                height += line.height()
+            text_layout.endLayout()
+            layout.hit_layout = text_layout
+        return layout.hit_layout
+
+    def char_at(self, index: QModelIndex, option_rect: QRect, pos: QPoint) -> Optional[str]:
+        layout = self.get_layout(index)
+        x, y = self._text_origin(option_rect, layout, index.data(OutgoingRole))
+        point = QPointF(pos.x() - x, pos.y() - y)
+        if not (0 <= point.x() < layout.text_width and 0 <= point.y() < layout.text_height):
+            return None
+        text_layout = self._hit_layout(layout)
+        for line_idx in range(text_layout.lineCount()):
+            line = text_layout.lineAt(line_idx)
+            if line.y() <= point.y() < line.y() + line.height():
+                if point.x() >= line.naturalTextWidth():
+                    return None
+                position = line.xToCursor(point.x(), QTextLine.CursorPosition.CursorOnCharacter)
+                return _char_at_utf16(text_layout.text(), position) or None
+        return None
+
+    def lookup_text(self, char: str) -> Optional[str]:
+        if self._dictionary is None and not self._dictionary_failed:
+            try:
+                self._dictionary = get_character_dictionary()
+            except (OSError, ValueError):
+                self._dictionary_failed = True
+        if self._dictionary is None:
+            return None
+        # messages of the student may be in simplified characters, the dictionary is traditional
+        entry = self._dictionary.lookup(char) or self._dictionary.lookup(get_default_converter().to_traditional(char))
+        if entry is None:
+            return None
+        lines = [f"<b>{html.escape(entry.char)}</b> {html.escape(entry.pinyin)}", html.escape(entry.meaning)]
+        lines += [f"{html.escape(word)} {html.escape(pinyin)}" for word, pinyin in zip(entry.words, entry.words_pinyin)]
+        lines.append(f"<small>frequency rank {entry.frequency_rank}</small>")
+        return "<br>".join(lines)
+
+    def _show_lookup(self, index: QModelIndex, option_rect: QRect, pos: QPoint, global_pos: QPoint) -> bool:
+        char = self.char_at(index, option_rect, pos)
+        text = self.lookup_text(char) if char else None
+        if text is None:
+            return False
+        QToolTip.showText(global_pos, text, self.view.viewport())
+        return True
+
+    def helpEvent(self, event: QHelpEvent, view: QAbstractItemView, option: QStyleOptionViewItem,
+                  index: QModelIndex) -> bool:
+        if event.type() == QEvent.Type.ToolTip and index.isValid():
+            if not self._show_lookup(index, option.rect, event.pos(), event.globalPos()):
+                QToolTip.hideText()
+            return True
+        return super(HistoryItemDelegate, self).helpEvent(event, view, option, index)
+
+    def editorEvent(self, event: QEvent, model, option: QStyleOptionViewItem, index: QModelIndex) -> bool:
+        # a click shows the same lookup right away, the view still handles the click
+        if event.type() == QEvent.Type.MouseButtonRelease and event.button() == Qt.MouseButton.LeftButton:
+            self._show_lookup(index, option.rect, event.position().toPoint(), event.globalPosition().toPoint())
+        return super(HistoryItemDelegate, self).editorEvent(event, model, option, index)
 
     def paint(self, painter: QPainter, option: QStyleOptionViewItem, index: QModelIndex):
-        item : HistoryItem = index.data()
-        message = self.get_painted_message(index)
-
-        self.initStyleOption(option, index)
-        msg_rect = self.get_rects(option, index)
-        
-        even_row = index.row() & 1 == 0
-
-        painter.save()
+        layout = self.get_layout(index)
+        option_rect = option.rect
 
-        msg_rect = painter.boundingRect(msg_rect, Qt.TextFlag.TextWordWrap, message)
+        outgoing = index.data(OutgoingRole)
+        x, y = self._text_origin(option_rect, layout, outgoing)
 
-        bubble = QRect(
-            msg_rect.left() - _PAD,
-            msg_rect.top() - _PAD,
-            msg_rect.width() + 2 * _PAD,
-            msg_rect.height() + 2 * _PAD
-        )
+        bubble = QRect(x - _PAD, y - _PAD, layout.text_width + 2 * _PAD, layout.text_height + 2 * _PAD)
 
         author_line_top = bubble.bottom() + _PAD
-        author_line = f"{item.author} {item.timestamp_str()}"
         author_line_x = bubble.x()
-        if even_row:
-            author_line_width = painter.fontMetrics().boundingRect(author_line).width()
-            author_line_x = bubble.bottomRight().x() - author_line_width
+        if outgoing:
+            author_line_x = bubble.bottomRight().x() - layout.author_width
 
+        painter.save()
         painter.drawRoundedRect(bubble, 8, 8)
-        painter.drawText(msg_rect, Qt.TextFlag.TextWordWrap, message)
-        painter.drawStaticText(author_line_x, author_line_top, QStaticText(author_line))
+        painter.drawStaticText(x, y, layout.text)
+        painter.drawStaticText(author_line_x, author_line_top, layout.author_line)
         painter.restore()
 
     def sizeHint(self, option: QStyleOptionViewItem, index: QModelIndex):
-        option.rect.setWidth(self.view.width())
-        option.rect.setHeight(self.view.height())
-
-        msg_rect = self.get_rects(option, index)
-        bubble_size = QSize(msg_rect.width() + 2 * _PAD, msg_rect.height() + 2 * _PAD)
-
-        font_metrics = QApplication.fontMetrics()
-        sender_height = font_metrics.height() + 2 * _PAD
-
-        item_size = QSize(bubble_size.width(), bubble_size.height() + sender_height)
-        return item_size
+        return self.get_layout(index).size_hint
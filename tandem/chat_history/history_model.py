@@ -1,47 +1,109 @@
 from datetime import datetime
-from PySide6.QtCore import QAbstractListModel, QModelIndex, Qt, Slot
-from tandem.tandem_partner import TandemPartner
+from typing import TYPE_CHECKING, Optional
+
+from PySide6.QtCore import QAbstractListModel, QModelIndex, Qt, Signal, Slot
+from tandem.script_converter import parse_sections
+
+if TYPE_CHECKING:
+    # LangChain and OpenAI are imported in the background while the window is already shown
+    from langchain_core.messages import BaseMessage
+    from tandem.session_store import StoredMessage
+    from tandem.tandem_partner import TandemPartner
+
+
+MessageRole = Qt.ItemDataRole.UserRole + 1
+TraditionalRole = Qt.ItemDataRole.UserRole + 2
+PinyinRole = Qt.ItemDataRole.UserRole + 3
+EnglishRole = Qt.ItemDataRole.UserRole + 4
+AuthorRole = Qt.ItemDataRole.UserRole + 5
+TimestampRole = Qt.ItemDataRole.UserRole + 6
+OutgoingRole = Qt.ItemDataRole.UserRole + 7
 
 
 class HistoryItem:
-    def __init__(self, message: str, author: str, timestamp: int):
+    __slots__ = ("author", "timestamp", "timestamp_text", "outgoing", "traditional", "pinyin", "english", "message")
+
+    def __init__(self, message: str, author: str, timestamp: int, outgoing: bool = False,
+                 sections: Optional[tuple[str, str, str]] = None):
         self.author = author
         self.timestamp = timestamp
+        self.timestamp_text = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S")
+        self.outgoing = outgoing
+        self.update(message, sections)
 
-        self.traditional = ""
-        self.pinyin = ""
-        self.english = ""
-        parts = message.split('---')
-        if len(parts) > 0:
-            self.traditional = parts[0].strip()
-        if len(parts) > 1:
-            self.pinyin = parts[1].strip()
-        if len(parts) > 2:
-            self.english = parts[2].strip()
+    def update(self, message: str, sections: Optional[tuple[str, str, str]] = None):
+        self.traditional, self.pinyin, self.english = sections or parse_sections(message)
+        # the text painted into the bubble, empty sections are dropped at the end only
+        self.message = "\n\n".join((self.traditional, self.pinyin, self.english)).rstrip("\n")
 
     def timestamp_str(self):
-        return datetime.fromtimestamp(self.timestamp).strftime("%Y-%m-%dT%H:%M:%S")
+        return self.timestamp_text
+
+    @classmethod
+    def from_message(cls, message: "BaseMessage") -> "HistoryItem":
+        return cls(
+            message=message.content,
+            author=message.additional_kwargs["author"],
+            timestamp=message.additional_kwargs["timestamp"],
+            outgoing=message.type == "human"
+        )
+
+    @classmethod
+    def from_stored(cls, stored: "StoredMessage") -> "HistoryItem":
+        # stored rows carry their parsed sections, paging in does not re-parse
+        return cls(
+            message=stored.content,
+            author=stored.author,
+            timestamp=stored.timestamp,
+            outgoing=stored.role == "human",
+            sections=(stored.traditional, stored.pinyin, stored.english)
+        )
 
 
 class HistoryModel(QAbstractListModel):
     _HEADER = ("Message", "Author", "Timestamp")
+    response_failed = Signal(str)
 
-    def __init__(self, tandem: TandemPartner):
+    def __init__(self, tandem: "TandemPartner", page_size: int = 100):
         super(HistoryModel, self).__init__()
         self.tandem = tandem
-        self.response_worker = None
+        self.response_request = None
+        self.page_size = page_size
+        # parsed rows, the tail is kept in step with tandem.chat_history.messages,
+        # older rows of a resumed session are paged in from the session store in front of it
+        self.rows: list[HistoryItem] = [HistoryItem.from_message(message) for message in tandem.chat_history.messages]
+        self._oldest_stored_id = tandem.oldest_stored_id
+        # the view asks for more whenever the last row is visible, older pages are only
+        # fetched once the view has been scrolled to the top and sets this flag
+        self.fetch_older = False
+
+    def _append_rows(self, count: int):
+        for message in self.tandem.chat_history.messages[len(self.tandem.chat_history.messages) - count:]:
+            self.rows.append(HistoryItem.from_message(message))
 
     def add_message(self, author: str, message: str):
+        self.cancel_response()
         self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
-        self.insertRow(self.rowCount(), QModelIndex())
-        self.response_worker = self.tandem.invoke(author, message)
+        self.response_request = self.tandem.invoke(author, message)
+        self._append_rows(1)
         self.endInsertRows()
-        self.response_worker.response_received.connect(self.handle_response, Qt.ConnectionType.SingleShotConnection)
-        self.response_worker.start()
+        self.response_request.chunk_received.connect(self.handle_chunk)
+        self.response_request.response_received.connect(self.handle_response, Qt.ConnectionType.SingleShotConnection)
+        self.response_request.request_failed.connect(self.handle_failure, Qt.ConnectionType.SingleShotConnection)
+        self.tandem.submit(self.response_request)
+
+    def cancel_response(self):
+        # a new message makes the pending reply stale, what was streamed of it so far is kept
+        if self.response_request is None:
+            return
+        self.response_request.cancel()
+        self.response_request = None
+        if self.tandem.streamed_response_idx is not None:
+            self.tandem.handle_response(self.tandem.chat_history.messages[self.tandem.streamed_response_idx].content)
+            self._last_row_changed()
 
     def add_dummy_message(self, author: str, message: str):
         self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount() + 1)
-        self.insertRows(self.rowCount(), 2, QModelIndex())
         self.tandem.dummy_invoke(author, message)
         self.tandem.handle_response("""你好！要不要聊聊關於停車的話題？
 ---
@@ -49,28 +111,99 @@ Nǐ hǎo! Yào bù yào liáo liáo guān yú tíngchē de huàtí?
 ---
 Hello! Do you want to talk about the topic of parking? ihfasdlöfalksdf asjdfeeef
 Hello! Do you want to talk about the topic of parking? ihfasdlöfalksdf Hello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdfHello! Do you want to talk about the topic of parking? ihfasdlöfalksdf""")
+        self._append_rows(2)
         self.endInsertRows()
 
+    def _is_stale(self) -> bool:
+        # chunks of a cancelled request may already be queued for this thread
+        return self.sender() is not None and self.sender() is not self.response_request
+
+    @Slot(str)
+    def handle_chunk(self, chunk: str):
+        if self._is_stale():
+            return
+        if self.tandem.streamed_response_idx is None:
+            self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
+            self.tandem.begin_response()
+            self._append_rows(1)
+            self.endInsertRows()
+        self.tandem.handle_chunk(chunk)
+        self._last_row_changed()
+
     @Slot(str)
     def handle_response(self, response: str):
+        if self._is_stale():
+            return
+        self.response_request = None
+        if self.tandem.streamed_response_idx is not None:
+            self.tandem.handle_response(response)
+            self._last_row_changed()
+            return
+
         self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
         self.tandem.handle_response(response)
+        self._append_rows(1)
         self.endInsertRows()
 
+    @Slot(str)
+    def handle_failure(self, message: str):
+        if self._is_stale():
+            return
+        self.response_request = None
+        if self.tandem.streamed_response_idx is not None:
+            # like a cancelled reply, what was streamed before the error is kept
+            self.tandem.handle_response(self.tandem.chat_history.messages[self.tandem.streamed_response_idx].content)
+            self._last_row_changed()
+        else:
+            self.tandem.abort_turn()
+        self.response_failed.emit(message)
+
+    def _last_row_changed(self):
+        self.rows[-1].update(self.tandem.chat_history.messages[-1].content)
+        index = self.index(self.rowCount() - 1)
+        self.dataChanged.emit(index, index)
+
     def rowCount(self, parent = QModelIndex()) -> int:
-        return len(self.tandem.chat_history.messages)
+        return len(self.rows)
+
+    def canFetchMore(self, parent: QModelIndex = QModelIndex()) -> bool:
+        return self.fetch_older and self._oldest_stored_id is not None and not parent.isValid()
+
+    def fetchMore(self, parent: QModelIndex = QModelIndex()):
+        self.fetch_older = False
+        page = self.tandem.session_store.page(self.tandem.session_id, before_id=self._oldest_stored_id,
+                                              limit=self.page_size)
+        if not page:
+            self._oldest_stored_id = None
+            return
+        self._oldest_stored_id = page[0].id if len(page) == self.page_size else None
+        self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+        self.rows[:0] = [HistoryItem.from_stored(stored) for stored in page]
+        self.endInsertRows()
 
     def headerData(self, section: int, orientation: Qt.Orientation, role: int) -> tuple[str]:
         if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
             return HistoryModel._HEADER
         return None
 
-    def data(self, index: QModelIndex, role: int) -> HistoryItem:
+    def data(self, index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        item = self.rows[index.row()]
         if role == Qt.ItemDataRole.DisplayRole:
-            msg = self.tandem.chat_history.messages[index.row()]
-            item = HistoryItem(
-                message=msg.content,
-                author=msg.additional_kwargs["author"],
-                timestamp=msg.additional_kwargs["timestamp"]
-            )
             return item
+        if role == MessageRole:
+            return item.message
+        if role == TraditionalRole:
+            return item.traditional
+        if role == PinyinRole:
+            return item.pinyin
+        if role == EnglishRole:
+            return item.english
+        if role == AuthorRole:
+            return item.author
+        if role == TimestampRole:
+            return item.timestamp_text
+        if role == OutgoingRole:
+            return item.outgoing
+        return None
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import weakref
+from typing import NamedTuple, Optional
+
+import httpx
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from openai import AsyncOpenAI, OpenAI
+
+
+# the statuses the openai client retries itself, a conflict or timeout on their side is worth another attempt
+_RETRY_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+# errors before the request reached the server, or a pooled connection the server had already closed
+_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+# the openai defaults, replies are streamed for a long time but a connect should be quick
+_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+
+
+class ClientStats(NamedTuple):
+    requests: int
+    retries: int
+    throttled: int
+    waited_s: float
+
+
+def estimate_tokens(request: httpx.Request) -> int:
+    # about 4 bytes per token in English and 3 bytes per token for Chinese characters, the
+    # completion is counted with its limit when the request sets one
+    try:
+        content = request.content
+    except httpx.RequestNotRead:
+        return 0
+    tokens = len(content) // 4
+    try:
+        body = json.loads(content) if content else {}
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return tokens
+    if isinstance(body, dict):
+        tokens += body.get("max_completion_tokens") or body.get("max_tokens") or 0
+    return tokens
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = response.headers.get(header)
+        if value is not None:
+            try:
+                return float(value) * scale
+            except ValueError:
+                # an HTTP date, the jittered backoff is used instead
+                pass
+    return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+        # taken right away even if it is not there yet, later callers queue behind the deficit
+        self.available -= min(amount, self.capacity)
+        return max(0.0, -self.available / self.rate)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self.waited_s = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+            self.waited_s += wait
+            return wait
+
+    def acquire(self, tokens: int):
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int):
+        wait = self.reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        # the limit is shared by every model and session, a 429 holds back all of them
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RetryPolicy:
+    def __init__(self, limiter: RateLimiter, max_retries: int = 4, backoff_s: float = 0.5,
+                 max_backoff_s: float = 20.0):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def attempt(self):
+        with self._lock:
+            self.requests += 1
+
+    def should_retry(self, attempt: int, response: httpx.Response) -> bool:
+        return attempt < self.max_retries and response.status_code in _RETRY_STATUSES
+
+    def delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        # full jitter, requests that were throttled together do not come back together
+        delay = random.uniform(0, min(self.max_backoff_s, self.backoff_s * 2 ** attempt))
+        retry_after = _retry_after(response) if response is not None else None
+        with self._lock:
+            self.retries += 1
+            if response is not None and response.status_code == 429:
+                self.throttled += 1
+        if response is not None and response.status_code == 429:
+            self.limiter.pause(retry_after if retry_after is not None else delay)
+        return max(delay, retry_after or 0.0)
+
+    def stats(self) -> ClientStats:
+        with self._lock:
+            return ClientStats(self.requests, self.retries, self.throttled, self.limiter.waited_s)
+
+
+class RetryTransport(httpx.BaseTransport):
+    def __init__(self, policy: RetryPolicy, **transport_kwargs):
+        self.policy = policy
+        self.transport = httpx.HTTPTransport(limits=_LIMITS, **transport_kwargs)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        tokens = estimate_tokens(request)
+        attempt = 0
+        while True:
+            self.policy.limiter.acquire(tokens)
+            self.policy.attempt()
+            try:
+                response = self.transport.handle_request(request)
+            except _RETRY_ERRORS:
+                if attempt >= self.policy.max_retries:
+                    raise
+                delay = self.policy.delay(attempt)
+            else:
+                # only the status is checked, a stream that breaks off later is not replayed
+                if not self.policy.should_retry(attempt, response):
+                    return response
+                delay = self.policy.delay(attempt, response)
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRetryTransport(httpx.AsyncBaseTransport):
+    def __init__(self, policy: RetryPolicy, **transport_kwargs):
+        self.policy = policy
+        self.transport_kwargs = transport_kwargs
+        self._transports: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _transport(self) -> httpx.AsyncHTTPTransport:
+        # connections belong to the event loop that opened them, the server loop and every
+        # asyncio.run of a worker thread keep their own pool
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.get(loop)
+            if transport is None:
+                transport = httpx.AsyncHTTPTransport(limits=_LIMITS, **self.transport_kwargs)
+                self._transports[loop] = transport
+            return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        transport = self._transport()
+        tokens = estimate_tokens(request)
+        attempt = 0
+        while True:
+            await self.policy.limiter.aacquire(tokens)
+            self.policy.attempt()
+            try:
+                response = await transport.handle_async_request(request)
+            except _RETRY_ERRORS:
+                if attempt >= self.policy.max_retries:
+                    raise
+                delay = self.policy.delay(attempt)
+            else:
+                if not self.policy.should_retry(attempt, response):
+                    return response
+                delay = self.policy.delay(attempt, response)
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        # only the pool of the running loop, the others are closed with their loop
+        with self._lock:
+            transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+class ClientRegistry:
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 4, timeout: httpx.Timeout = _TIMEOUT):
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.policy = RetryPolicy(self.limiter, max_retries=max_retries)
+        self.timeout = timeout
+        self._async_transport = AsyncRetryTransport(self.policy)
+        # one keep-alive pool for chat, embeddings and speech instead of one per model object
+        self.http_client = httpx.Client(transport=RetryTransport(self.policy), timeout=timeout,
+                                        follow_redirects=True)
+        self.http_async_client = httpx.AsyncClient(transport=self._async_transport, timeout=timeout,
+                                                   follow_redirects=True)
+
+    # retries happen in the transport, where they count against the shared limits, the
+    # openai clients would otherwise retry every failed retry again
+    # the langchain models pass their own timeout to every request, None unless it is set, which
+    # would replace the timeout of the shared clients with none at all
+    def chat_model(self, cls: type[ChatOpenAI] = ChatOpenAI, **kwargs) -> ChatOpenAI:
+        kwargs.setdefault("timeout", self.timeout)
+        return cls(http_client=self.http_client, http_async_client=self.http_async_client, max_retries=0, **kwargs)
+
+    def embeddings(self, **kwargs) -> OpenAIEmbeddings:
+        kwargs.setdefault("timeout", self.timeout)
+        return OpenAIEmbeddings(http_client=self.http_client, http_async_client=self.http_async_client,
+                                max_retries=0, **kwargs)
+
+    def openai_client(self) -> OpenAI:
+        return OpenAI(http_client=self.http_client, max_retries=0)
+
+    def async_openai_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(http_client=self.http_async_client, max_retries=0)
+
+    def stats(self) -> ClientStats:
+        return self.policy.stats()
+
+    async def aclose(self):
+        await self._async_transport.aclose()
+
+    def close(self):
+        self.http_client.close()
+
+
+_clients: Optional[ClientRegistry] = None
+_clients_lock = threading.Lock()
+
+
+def get_clients() -> ClientRegistry:
+    global _clients
+    with _clients_lock:
+        if _clients is None:
+            _clients = ClientRegistry()
+        return _clients
+
+
+def configure_clients(requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                      **kwargs) -> ClientRegistry:
+    global _clients
+    # models created before keep the clients they were created with
+    with _clients_lock:
+        _clients = ClientRegistry(requests_per_minute, tokens_per_minute, **kwargs)
+        return _clients
@@ -1,11 +1,20 @@
 import asyncio
+from typing import Optional
+
 from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableGenerator
+from tandem.clients import get_clients
+from tandem.llm_cache import CachedChatOpenAI, get_response_cache
+from tandem.script_converter import SECTION_SEPARATOR, get_default_converter
+from tandem.tracing import STAGE_CONVERTER, STAGE_LOCAL_CONVERSION, STAGE_SUMMARY, STAGE_TANDEM, timed_atransform, \
+    timed_transform
 
 
 def get_contextualizer_chain():
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0)
+    llm = get_clients().chat_model(CachedChatOpenAI, model_name="gpt-3.5-turbo", temperature=0,
+                                   cache=get_response_cache())
     contextualizer_system_prompt = """Given a chat history and the latest user input which might reference context in the chat history, formulate a standalone input which 
 can be understood without the chat history. Do NOT answer the input, just reformulate it if needed and otherwise return it as is."""
     contextualizer_prompt = ChatPromptTemplate.from_messages(
@@ -21,7 +30,9 @@ can be understood without the chat history. Do NOT answer the input, just reform
 
 
 def get_simplified_traditional_converter_chain():
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0)
+    # the conversion of a reply is fully determined by the reply, repeated replies are served from the cache
+    llm = get_clients().chat_model(CachedChatOpenAI, model_name="gpt-3.5-turbo", temperature=0, stream_usage=True,
+                                   cache=get_response_cache())
     converter_system_prompt = """Given the provided input, replace all simplified Chinese characters with traditional Chinese characters and add a Pinyin transcription as well as an English translation. Use the below output format. Do NOT answer the input, just return the input with the described changes.    
     Output format:
 
@@ -38,25 +49,75 @@ def get_simplified_traditional_converter_chain():
         ]
     )
     converter_chain = converter_prompt | llm | StrOutputParser()
-    return converter_chain
+    return converter_chain.with_config(metadata={"stage": STAGE_CONVERTER})
+
+def get_local_converter_chain():
+    converter = get_default_converter()
+    return RunnableGenerator(timed_transform(STAGE_LOCAL_CONVERSION, converter.transform_stream),
+                             timed_atransform(STAGE_LOCAL_CONVERSION, converter.atransform_stream),
+                             name=STAGE_LOCAL_CONVERSION)
+
+
+def get_summarizer_chain():
+    llm = get_clients().chat_model(CachedChatOpenAI, model_name="gpt-3.5-turbo", temperature=0,
+                                   cache=get_response_cache())
+    summarizer_system_prompt = """You keep a running summary of a Chinese practice conversation between a student and their tandem partner Lang. Extend the existing summary with the new messages below. Keep the topics discussed, facts the student shared about themselves and open questions. Answer with the updated summary only, in at most 5 sentences.
+
+Existing summary:
+{summary}"""
+    summarizer_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", summarizer_system_prompt),
+            MessagesPlaceholder(variable_name="messages"),
+        ]
+    )
+    summarizer_chain = summarizer_prompt | llm | StrOutputParser()
+    return summarizer_chain.with_config(metadata={"stage": STAGE_SUMMARY})
 
-def get_tandem_chain(character_list: str):
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0.7)
+
+def get_tandem_system_message(character_list: str, with_translation: bool = False) -> str:
     tandem_system_message = f"""You are Lang, a tandem partner who is native in Chinese. The user intends to practice Chinese and the typical usage of characters through a casual conversation with you. In the provided context is a list of characters that your tandem partner intends to practice. Whenever it makes sense, incorporate one or more of the characters into your response. Also include a remark or question toward the user to continue the conversation. Keep your response within 1 - 3 sentences.
 
 <context>
 {character_list}
 </context>
 """
+    if with_translation:
+        tandem_system_message += f"""
+After your response, add a line containing only {SECTION_SEPARATOR} followed by an English translation of your response.
+"""
+    return tandem_system_message
 
-    tandem_prompt = ChatPromptTemplate.from_messages([("system", tandem_system_message), ("user", "{input}")])
+
+def get_tandem_llm() -> ChatOpenAI:
+    # usage is only reported for streamed replies when asked for, the sampled reply is never cached
+    return get_clients().chat_model(model_name="gpt-3.5-turbo", temperature=0.7, stream_usage=True)
+
+
+def get_tandem_chain(character_list: str, with_translation: bool = False, llm: Optional[ChatOpenAI] = None):
+    # connections are pooled by the shared clients, callers serving many conversations also share the model
+    llm = llm or get_tandem_llm()
+    tandem_system_message = get_tandem_system_message(character_list, with_translation)
+
+    tandem_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", tandem_system_message),
+            MessagesPlaceholder(variable_name="chat_history"),
+        ]
+    )
     tandem_chain = tandem_prompt | llm | StrOutputParser()
 
-    return tandem_chain
+    return tandem_chain.with_config(metadata={"stage": STAGE_TANDEM})
+
 
+def get_tandem_partner(character_list, local_conversion: bool = True, translate: bool = True,
+                       llm: Optional[ChatOpenAI] = None):
+    if local_conversion:
+        # script conversion and pinyin are computed in-process, the translation comes with the tandem reply
+        tandem = get_tandem_chain(character_list, with_translation=translate, llm=llm)
+        return tandem | get_local_converter_chain()
 
-def get_tandem_partner(character_list):
-    tandem = get_tandem_chain(character_list)
+    tandem = get_tandem_chain(character_list, llm=llm)
     converter = get_simplified_traditional_converter_chain()
 
     tandem_partner = {"input": tandem} | converter
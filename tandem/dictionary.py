@@ -0,0 +1,241 @@
+import mmap
+import os
+import shutil
+import struct
+import sys
+import time
+from array import array
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, TextIO
+
+
+_DEFAULT_RAW_PATH = f"{Path(__file__).parent.parent}/data/3000-traditional-hanzi_raw.tsv"
+_DEFAULT_DICTIONARY_PATH = f"{Path(__file__).parent.parent}/.index/3000-traditional-hanzi.dict"
+
+_MAGIC = b"TDIC"
+_FORMAT_VERSION = 1
+# magic, version, rows, buckets, size of the string table
+_HEADER = struct.Struct("<4sIIII")
+_U32 = struct.Struct("<I")
+# strings stored per row, the vocabulary words and their pinyin are space separated
+_FIELDS = 5
+_CHAR, _PINYIN, _MEANING, _WORDS, _WORDS_PINYIN = range(_FIELDS)
+
+# columns of the raw export
+_RAW_COLUMNS = 13
+_RAW_CHAR, _RAW_ORDER, _RAW_PINYIN, _RAW_MEANING, _RAW_WORDS, _RAW_WORDS_PINYIN, _RAW_FREQUENCY = 0, 1, 4, 6, 7, 8, 12
+
+
+class DictionaryEntry(NamedTuple):
+    char: str
+    pinyin: str
+    meaning: str
+    words: tuple[str, ...]
+    words_pinyin: tuple[str, ...]
+    order: int
+    frequency_rank: int
+
+
+class RowError(NamedTuple):
+    line: int
+    reason: str
+
+
+class DictionaryStats(NamedTuple):
+    rows: int
+    errors: list[RowError]
+    seconds: float
+
+
+def _fnv1a(data: bytes) -> int:
+    # python's hash() is salted per process, the index is written once and read by every run
+    value = 0x811c9dc5
+    for byte in data:
+        value = ((value ^ byte) * 0x01000193) & 0xffffffff
+    return value
+
+
+def parse_raw_row(line: str) -> DictionaryEntry:
+    columns = line.rstrip("\r\n").split("\t")
+    if len(columns) < _RAW_COLUMNS:
+        raise ValueError(f"expected at least {_RAW_COLUMNS} columns, got {len(columns)}")
+    char = columns[_RAW_CHAR]
+    if len(char) != 1:
+        raise ValueError(f"expected a single character, got {char!r}")
+    pinyin, meaning = columns[_RAW_PINYIN].strip(), columns[_RAW_MEANING].strip()
+    if not pinyin or not meaning:
+        raise ValueError(f"missing pinyin or meaning for {char}")
+    if not columns[_RAW_ORDER].isdigit() or not columns[_RAW_FREQUENCY].isdigit():
+        raise ValueError(f"order {columns[_RAW_ORDER]!r} and frequency rank {columns[_RAW_FREQUENCY]!r} "
+                         f"must be numbers")
+    words, words_pinyin = tuple(columns[_RAW_WORDS].split()), tuple(columns[_RAW_WORDS_PINYIN].split())
+    if len(words) != len(words_pinyin):
+        raise ValueError(f"{len(words)} vocabulary words but {len(words_pinyin)} pinyin readings")
+    return DictionaryEntry(char, pinyin, meaning, words, words_pinyin, int(columns[_RAW_ORDER]),
+                           int(columns[_RAW_FREQUENCY]))
+
+
+def read_raw_rows(f: TextIO) -> Iterator[tuple[int, DictionaryEntry | RowError]]:
+    for line_number, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, parse_raw_row(line)
+        except ValueError as e:
+            yield line_number, RowError(line_number, str(e))
+
+
+def build_dictionary(raw_path: str = _DEFAULT_RAW_PATH, dictionary_path: str = _DEFAULT_DICTIONARY_PATH,
+                     tsv_path: Optional[str] = None) -> DictionaryStats:
+    # rows are streamed, only the string offsets and the character index are kept in memory
+    start = time.perf_counter()
+    Path(dictionary_path).parent.mkdir(parents=True, exist_ok=True)
+    strings_path = f"{dictionary_path}.strings.tmp"
+    offsets = array("I", [0])
+    orders = array("I")
+    frequency_ranks = array("I")
+    rows: dict[str, int] = {}
+    errors = []
+    tsv_file = open(f"{tsv_path}.tmp", mode="w", encoding="utf-8") if tsv_path else None
+    try:
+        with open(raw_path, encoding="utf-8") as raw_file, open(strings_path, mode="wb") as strings_file:
+            for line_number, entry in read_raw_rows(raw_file):
+                if isinstance(entry, RowError):
+                    errors.append(entry)
+                    continue
+                if entry.char in rows:
+                    errors.append(RowError(line_number, f"duplicate character {entry.char}"))
+                    continue
+                rows[entry.char] = len(orders)
+                for value in (entry.char, entry.pinyin, entry.meaning, " ".join(entry.words),
+                              " ".join(entry.words_pinyin)):
+                    data = value.encode("utf-8")
+                    strings_file.write(data)
+                    offsets.append(offsets[-1] + len(data))
+                orders.append(entry.order)
+                frequency_ranks.append(entry.frequency_rank)
+                if tsv_file is not None:
+                    # the table read by the retrieval and vocabulary modules
+                    tsv_file.write(f"{entry.char}\t{entry.pinyin}\t{entry.meaning}\t{' '.join(entry.words)}\t"
+                                   f"{' '.join(entry.words_pinyin)}\n")
+
+        # open addressing at a load factor of at most 1/2, a lookup probes one or two buckets
+        bucket_count = 1
+        while bucket_count < 2 * len(rows):
+            bucket_count *= 2
+        buckets = array("I", [0]) * bucket_count
+        for char, row in rows.items():
+            bucket = _fnv1a(char.encode("utf-8")) & (bucket_count - 1)
+            while buckets[bucket]:
+                bucket = (bucket + 1) & (bucket_count - 1)
+            buckets[bucket] = row + 1
+
+        if sys.byteorder == "big":
+            # the file is little endian like the header
+            for values in (offsets, orders, frequency_ranks, buckets):
+                values.byteswap()
+        tmp_path = f"{dictionary_path}.tmp"
+        with open(tmp_path, mode="wb") as f, open(strings_path, mode="rb") as strings_file:
+            f.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, len(rows), bucket_count, offsets[-1]))
+            for values in (offsets, orders, frequency_ranks, buckets):
+                values.tofile(f)
+            shutil.copyfileobj(strings_file, f)
+        os.replace(tmp_path, dictionary_path)
+        if tsv_file is not None:
+            tsv_file.close()
+            os.replace(f"{tsv_path}.tmp", tsv_path)
+    finally:
+        if tsv_file is not None and not tsv_file.closed:
+            tsv_file.close()
+        if os.path.exists(strings_path):
+            os.remove(strings_path)
+    return DictionaryStats(len(rows), errors, time.perf_counter() - start)
+
+
+class CharacterDictionary:
+    def __init__(self, path: str = _DEFAULT_DICTIONARY_PATH):
+        self.path = path
+        with open(path, mode="rb") as f:
+            # pages are read on first access, opening the file reads nothing but the header
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.rows, self.bucket_count, strings_size = _HEADER.unpack_from(self._data, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a character dictionary")
+        if version != _FORMAT_VERSION:
+            raise ValueError(f"Unsupported character dictionary version {version} in {path}")
+        self._offsets = _HEADER.size
+        self._orders = self._offsets + 4 * (self.rows * _FIELDS + 1)
+        self._frequency_ranks = self._orders + 4 * self.rows
+        self._buckets = self._frequency_ranks + 4 * self.rows
+        self._strings = self._buckets + 4 * self.bucket_count
+        if self._strings + strings_size != len(self._data):
+            raise ValueError(f"{path} is truncated")
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __contains__(self, char: str) -> bool:
+        return self.row(char) is not None
+
+    def _u32(self, section: int, idx: int) -> int:
+        return _U32.unpack_from(self._data, section + 4 * idx)[0]
+
+    def _string_bytes(self, row: int, field: int) -> bytes:
+        start = self._u32(self._offsets, row * _FIELDS + field)
+        end = self._u32(self._offsets, row * _FIELDS + field + 1)
+        return self._data[self._strings + start:self._strings + end]
+
+    def _string(self, row: int, field: int) -> str:
+        return self._string_bytes(row, field).decode("utf-8")
+
+    def row(self, char: str) -> Optional[int]:
+        if not self.bucket_count:
+            return None
+        key = char.encode("utf-8")
+        bucket = _fnv1a(key) & (self.bucket_count - 1)
+        while True:
+            row = self._u32(self._buckets, bucket)
+            if not row:
+                return None
+            if self._string_bytes(row - 1, _CHAR) == key:
+                return row - 1
+            bucket = (bucket + 1) & (self.bucket_count - 1)
+
+    def entry(self, row: int) -> DictionaryEntry:
+        return DictionaryEntry(
+            self._string(row, _CHAR),
+            self._string(row, _PINYIN),
+            self._string(row, _MEANING),
+            tuple(self._string(row, _WORDS).split()),
+            tuple(self._string(row, _WORDS_PINYIN).split()),
+            self._u32(self._orders, row),
+            self._u32(self._frequency_ranks, row),
+        )
+
+    def lookup(self, char: str) -> Optional[DictionaryEntry]:
+        row = self.row(char)
+        return self.entry(row) if row is not None else None
+
+    def pinyin(self, char: str) -> Optional[str]:
+        row = self.row(char)
+        return self._string(row, _PINYIN) if row is not None else None
+
+    def meaning(self, char: str) -> Optional[str]:
+        row = self.row(char)
+        return self._string(row, _MEANING) if row is not None else None
+
+    def frequency_rank(self, char: str) -> Optional[int]:
+        row = self.row(char)
+        return self._u32(self._frequency_ranks, row) if row is not None else None
+
+    def close(self):
+        self._data.close()
+
+
+@lru_cache(maxsize=1)
+def get_character_dictionary() -> CharacterDictionary:
+    raw, path = Path(_DEFAULT_RAW_PATH), Path(_DEFAULT_DICTIONARY_PATH)
+    if not path.exists() or path.stat().st_mtime < raw.stat().st_mtime:
+        build_dictionary(str(raw), str(path))
+    return CharacterDictionary(str(path))
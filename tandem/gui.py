@@ -1,17 +1,150 @@
+import time
+_PROCESS_START = time.perf_counter()
+
 import argparse
 import os
 import platform
 import signal
+import statistics
 import sys
-from typing import Optional
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Optional
 
 from PySide6 import QtCore, QtGui, QtMultimedia, QtWidgets
 from PySide6.QtGui import QFont
 
 from tandem.chat_history.chat_history_widget import ChatHistoryWidget
-from tandem.chat_history.history_model import HistoryModel
-from tandem.char_retrieval_chain import get_character_list
-from tandem.tandem_partner import TandemPartner
+from tandem.chat_history.history_model import HistoryModel, TraditionalRole
+
+from tandem.topic_switcher import TopicSwitcher
+
+if TYPE_CHECKING:
+    # LangChain, OpenAI and Chroma take seconds to import, PartnerLoader imports them after the window is shown
+    from tandem.tandem_partner import TandemPartner
+
+
+_DUMMY_CHARACTER_LIST = """停(tíng) - stop, suspend, delay; suitable
+救(jiù) - save, rescue, relieve; help, aid
+外(wài) - out, outside, external; foreign
+進(jìn) - advance, make progress, enter
+客(kè) - guest, traveller; customer
+集(jí) - assemble, collect together
+越(yuè) - exceed, go beyond; the more ...
+落(luò) - fall, drop; net income, surplus
+待(dài) - treat, entertain, receive; wait
+旅(lǚ) - travel, journey, trip"""
+
+_SUGGESTED_TOPICS = ["traveling", "cooking dinner", "the weather", "going to school", "sports", "shopping for clothes",
+                     "visiting a doctor", "family", "music", "working in an office"]
+
+
+class StartupProfile:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.phases: list[tuple[str, float, float]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, start - _PROCESS_START, time.perf_counter() - start))
+
+    def mark(self, name: str):
+        self.phases.append((name, time.perf_counter() - _PROCESS_START, 0.0))
+
+    def report(self):
+        if not self.enabled:
+            return
+        print("startup profile (ms since process start, duration):")
+        for name, start, seconds in sorted(self.phases, key=lambda phase: phase[1]):
+            print(f"  {start * 1000:8.1f}  {seconds * 1000:8.1f}  {name}")
+
+
+class PartnerLoader(QtCore.QThread):
+    loaded = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+    # turn records of the tracer, the loader outlives startup only to forward these
+    turn_traced = QtCore.Signal(dict)
+
+    def __init__(self, args: argparse.Namespace, topic: Optional[str], profile: StartupProfile):
+        super(PartnerLoader, self).__init__()
+        self.args = args
+        self.topic = topic
+        self.profile = profile
+
+    def run(self):
+        try:
+            with self.profile.phase("import tandem.session_store"):
+                from tandem.session_store import SessionStore
+            with self.profile.phase("import tandem.tandem_partner"):
+                from tandem.tandem_partner import TandemPartner
+            if self.args.trace_dir or self.args.trace_overlay:
+                from tandem.tracing import configure_tracing
+                tracer = configure_tracing(
+                    log_path=f"{self.args.trace_dir}/trace.jsonl" if self.args.trace_dir else None,
+                    metrics_path=f"{self.args.trace_dir}/metrics.prom" if self.args.trace_dir else None
+                )
+                if self.args.trace_overlay:
+                    tracer.listeners.append(self.turn_traced.emit)
+            if self.args.requests_per_minute or self.args.tokens_per_minute:
+                from tandem.clients import configure_clients
+                configure_clients(self.args.requests_per_minute, self.args.tokens_per_minute)
+
+            session_store = None
+            session = None
+            if DUMMY_RUN:
+                character_list = _DUMMY_CHARACTER_LIST
+            elif self.args.resume is not None:
+                session_store = SessionStore(self.args.session_db)
+                session = session_store.get_session(self.args.resume or None)
+                if session is None:
+                    self.failed.emit(f"No stored conversation to resume in {self.args.session_db}")
+                    return
+                character_list = session.character_list
+            elif self.args.review:
+                session_store = SessionStore(self.args.session_db)
+                with self.profile.phase("schedule characters"):
+                    from tandem.vocabulary import CharacterScheduler, VocabularyStore
+                    # the characters come from the practice history, no retrieval call is needed
+                    character_list = CharacterScheduler(VocabularyStore(self.args.session_db)).next_character_list()
+                # a review has no topic, it is neither offered again in the topic dialog nor prefetched
+                session = session_store.get_session(session_store.create_session(None, character_list))
+            else:
+                session_store = SessionStore(self.args.session_db)
+                with self.profile.phase("import tandem.char_retrieval_chain"):
+                    from tandem.char_retrieval_chain import get_character_list
+                with self.profile.phase(f"character retrieval for {self.topic!r}"):
+                    character_list = get_character_list(topic=self.topic, mode=self.args.retrieval,
+                                                        llm_selection=not self.args.direct_selection)
+                session = session_store.get_session(session_store.create_session(self.topic, character_list))
+
+            vocabulary = None
+            if not DUMMY_RUN:
+                from tandem.vocabulary import VocabularyStore, VocabularyTracker
+                with self.profile.phase("build vocabulary matcher"):
+                    vocabulary = VocabularyTracker(VocabularyStore(self.args.session_db))
+
+            with self.profile.phase("create TandemPartner"):
+                tandem = TandemPartner("Lang", character_list,
+                                       local_conversion=not self.args.llm_conversion,
+                                       translate=not self.args.no_translation, streaming=not self.args.no_stream,
+                                       session_store=session_store, session_id=session.id if session else None,
+                                       prefetch_speech=not DUMMY_RUN, vocabulary=vocabulary)
+            # the partner and its executors were created on this thread, their signals are handled on the GUI thread
+            tandem.moveToThread(QtWidgets.QApplication.instance().thread())
+            self.loaded.emit(tandem)
+        except Exception as e:
+            self.failed.emit(f"{type(e).__name__}: {e}")
+
+
+def retrieve_character_list(args: argparse.Namespace, topic: str) -> str:
+    if DUMMY_RUN:
+        return _DUMMY_CHARACTER_LIST
+    # runs on a retrieval thread, the import is not paid for on the GUI thread
+    from tandem.char_retrieval_chain import get_character_list
+    return get_character_list(topic=topic, mode=args.retrieval, llm_selection=not args.direct_selection)
 
 
 class Separator(QtWidgets.QFrame):
@@ -23,7 +156,7 @@ class Separator(QtWidgets.QFrame):
 
 
 class ChatWindow(QtWidgets.QMainWindow):
-    def __init__(self, tandem):
+    def __init__(self):
         super(ChatWindow, self).__init__()
 
         self.setWindowTitle("Conversation with Lang")
@@ -31,28 +164,42 @@ class ChatWindow(QtWidgets.QMainWindow):
         height = 720
         self.setGeometry(0, 0, width, height)
 
-        self.tandem_partner: TandemPartner = tandem
+        # set by attach_partner once the characters for the topic are known
+        self.tandem_partner: Optional["TandemPartner"] = None
+        self.history_model: Optional[HistoryModel] = None
+        self.chat_history_widget: Optional[ChatHistoryWidget] = None
+        self.topic_switcher: Optional[TopicSwitcher] = None
+        self.topics: list[str] = []
 
-        self.topic_label = QtWidgets.QLabel(self.tandem_partner.character_list)
-
-        self.history_model = HistoryModel(tandem)
-        self.chat_history_widget = ChatHistoryWidget(self.history_model, self)
+        self.topic_label = QtWidgets.QLabel("Choosing characters for the conversation…")
+        self.change_topic_button = QtWidgets.QPushButton("Change topic…")
+        self.change_topic_button.setEnabled(False)
+        self.loading_label = QtWidgets.QLabel("Loading…")
+        self.loading_label.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
 
         self.media_player = QtMultimedia.QMediaPlayer()
         self.audio_output = QtMultimedia.QAudioOutput()
         self.audio_output.setVolume(50)
         self.media_player.setAudioOutput(self.audio_output)
+        # the source currently played, QMediaPlayer does not take ownership of it
+        self.speech_device = None
 
         self.message_input = QtWidgets.QLineEdit()
         self.message_input.setFont(QtGui.QFont("TW-MOE-Std-Kai", pointSize=18))
         self.message_input.setAlignment(QtCore.Qt.AlignmentFlag.AlignRight)
         self.message_input.setPlaceholderText("Type a message…")
         self.send_button = QtWidgets.QPushButton("Send")
+        self.message_input.setEnabled(False)
+        self.send_button.setEnabled(False)
+
+        topic_layout = QtWidgets.QHBoxLayout()
+        topic_layout.addWidget(self.topic_label, stretch=1)
+        topic_layout.addWidget(self.change_topic_button, alignment=QtCore.Qt.AlignmentFlag.AlignTop)
 
         self.vlayout = QtWidgets.QVBoxLayout()
-        self.vlayout.addWidget(self.topic_label)
+        self.vlayout.addLayout(topic_layout)
         self.vlayout.addWidget(Separator())
-        self.vlayout.addWidget(self.chat_history_widget)
+        self.vlayout.addWidget(self.loading_label, stretch=1)
         self.vlayout.addWidget(Separator())
         self.vlayout.addWidget(self.message_input)
         self.vlayout.addWidget(self.send_button)
@@ -64,12 +211,87 @@ class ChatWindow(QtWidgets.QMainWindow):
         self.message_input.textChanged.connect(self._message_input_changed)
         self.message_input.returnPressed.connect(self._send_button_clicked)
         self.send_button.clicked.connect(self._send_button_clicked)
+        self.change_topic_button.clicked.connect(self._change_topic_clicked)
+
+    def attach_partner(self, tandem: "TandemPartner"):
+        self.tandem_partner = tandem
+        self.topic_label.setText(tandem.character_list)
+
+        self.history_model = HistoryModel(tandem)
+        self.history_model.response_failed.connect(self._response_failed)
+        # emitted on a speech thread, shown once the GUI thread gets to it
+        tandem.speech.synthesis_failed.connect(self._speech_failed)
+        self.chat_history_widget = ChatHistoryWidget(self.history_model, self)
         self.chat_history_widget.play_clicked.connect(self._play_text2speech)
+        self.vlayout.replaceWidget(self.loading_label, self.chat_history_widget)
+        self.vlayout.setStretchFactor(self.chat_history_widget, 1)
+        self.loading_label.deleteLater()
+
+        self.message_input.setEnabled(True)
+        self.send_button.setEnabled(True)
+        self.message_input.setFocus()
+
+    def attach_topic_switcher(self, switcher: TopicSwitcher, topics: list[str]):
+        self.topic_switcher = switcher
+        self.topics = topics
+        switcher.topic_ready.connect(self._topic_ready)
+        switcher.topic_failed.connect(self._topic_failed)
+        self.change_topic_button.setEnabled(True)
+
+    def _change_topic_clicked(self):
+        topic = open_topic_dialog(self, self.topics)
+        if not topic:
+            return
+        self.statusBar().showMessage(f"Choosing characters for {topic!r}…")
+        self.topic_switcher.switch(topic)
+
+    @QtCore.Slot(str, str)
+    def _topic_ready(self, topic: str, character_list: str):
+        # the chain is swapped between turns, a reply that is still streaming finishes on the old topic
+        self.tandem_partner.set_character_list(topic, character_list)
+        self.topic_label.setText(character_list)
+        self.setWindowTitle(f"Conversation with Lang: {topic}")
+        self.statusBar().showMessage(f"Topic changed to {topic!r}", 5000)
+
+    @QtCore.Slot(str, str)
+    def _topic_failed(self, topic: str, message: str):
+        self.statusBar().showMessage(f"Could not change the topic to {topic!r}: {message}")
+
+    @QtCore.Slot(str)
+    def _response_failed(self, message: str):
+        self.statusBar().showMessage(f"{self.tandem_partner.name} could not reply: {message}")
+
+    @QtCore.Slot(str, str)
+    def _speech_failed(self, text: str, message: str):
+        self.statusBar().showMessage(f"Could not synthesize speech for {text[:20]!r}: {message}")
+
+    @QtCore.Slot(dict)
+    def show_turn_trace(self, record: dict):
+        stages = "  ".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in record["stages_s"].items())
+        first_token = record["first_token_s"]
+        first_token = f"{first_token * 1000:.0f} ms" if first_token is not None else "-"
+        cache = "  ".join(f"{access} {count}" for access, count in sorted(record["cache"].items()))
+        self.statusBar().showMessage(
+            f"turn {record['turn']}: {record['total_s'] * 1000:.0f} ms  first token {first_token}  {stages}  "
+            f"tokens {record['prompt_tokens']}+{record['completion_tokens']}" + (f"  cache {cache}" if cache else "")
+        )
+
+    def show_loading_error(self, message: str):
+        self.topic_label.setText("Could not start the conversation")
+        self.loading_label.setText(message)
 
     def showEvent(self, event):
         super(ChatWindow, self).showEvent(event)
         self.message_input.setFocus()
 
+    def closeEvent(self, event):
+        if self.tandem_partner is not None:
+            self.history_model.cancel_response()
+            self.tandem_partner.shutdown()
+        if self.topic_switcher is not None:
+            self.topic_switcher.shutdown()
+        super(ChatWindow, self).closeEvent(event)
+
     def _message_input_changed(self, text):
         self.send_button.setEnabled = len(text) > 0
 
@@ -82,17 +304,78 @@ class ChatWindow(QtWidgets.QMainWindow):
             self.history_model.add_message("Student", message)
 
     @QtCore.Slot(int)
-    def _play_text2speech(self, message_idx: int):
-        self.tandem_partner.text2speech(message_idx, f"_audio/{message_idx}.mp3")
-        self.media_player.setSource(QtCore.QUrl.fromLocalFile(f"_audio/{message_idx}.mp3"))
+    def _play_text2speech(self, row: int):
+        text = self.history_model.index(row).data(TraditionalRole)
+        # playback starts with the first synthesized chunk instead of the complete file
+        self.media_player.stop()
+        try:
+            self.speech_device = self.tandem_partner.speech.stream(text)
+        except OSError as e:
+            # a cached file that can no longer be read, synthesis errors arrive through synthesis_failed
+            self.statusBar().showMessage(f"Could not play the reply: {e}")
+            return
+        self.media_player.setSourceDevice(self.speech_device, QtCore.QUrl("speech.mp3"))
         self.media_player.play()
 
-def open_topic_dialog():
-    topic, ok = QtWidgets.QInputDialog.getText(
-        None,
-        "Choose a topic for conversation",
-        "topic"
-    )
+def _frame_stats(frame_times: list[float]) -> str:
+    frame_times = sorted(frame_times)
+    p95 = frame_times[int(0.95 * (len(frame_times) - 1))]
+    return f"p50 {statistics.median(frame_times) * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms, max {frame_times[-1] * 1000:.2f} ms"
+
+
+def run_stress_test(window: ChatWindow, message_count: int):
+    app = QtWidgets.QApplication.instance()
+    model = window.history_model
+    viewport = window.chat_history_widget.listview.viewport()
+    scroll_bar = window.chat_history_widget.listview.verticalScrollBar()
+
+    start = time.perf_counter()
+    for i in range(message_count // 2):
+        model.add_dummy_message("Student", f"Stress test message {i}")
+    app.processEvents()
+    print(f"loaded {model.rowCount()} messages in {time.perf_counter() - start:.2f} s")
+
+    append_times = []
+    for i in range(100):
+        start = time.perf_counter()
+        model.add_dummy_message("Student", f"Appended message {i}")
+        app.processEvents()
+        viewport.repaint()
+        append_times.append(time.perf_counter() - start)
+    print(f"append frame times: {_frame_stats(append_times)}")
+
+    # let the batched layout finish so the whole history can be scrolled
+    previous_maximum = -1
+    while scroll_bar.maximum() != previous_maximum:
+        previous_maximum = scroll_bar.maximum()
+        for _ in range(10):
+            app.processEvents()
+    scroll_times = []
+    step = max(scroll_bar.maximum() // 500, 1)
+    for value in range(scroll_bar.maximum(), 0, -step):
+        start = time.perf_counter()
+        scroll_bar.setValue(value)
+        viewport.repaint()
+        scroll_times.append(time.perf_counter() - start)
+    print(f"scroll frame times: {_frame_stats(scroll_times)}")
+
+
+def open_topic_dialog(parent: Optional[QtWidgets.QWidget] = None, topics: Optional[list[str]] = None):
+    if topics:
+        # recent and suggested topics to pick from, any other topic can be typed in
+        topic, ok = QtWidgets.QInputDialog.getItem(
+            parent,
+            "Choose a topic for conversation",
+            "topic",
+            topics,
+            editable=True
+        )
+    else:
+        topic, ok = QtWidgets.QInputDialog.getText(
+            parent,
+            "Choose a topic for conversation",
+            "topic"
+        )
     return topic if ok else None
 
 
@@ -103,38 +386,77 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--dummy", action="store_true")
     parser.add_argument("--choose-topic", action="store_true")
+    parser.add_argument("--stress", type=int, metavar="N",
+                        help="load N dummy messages and print append and scroll frame times")
+    parser.add_argument("--llm-conversion", action="store_true",
+                        help="convert replies to traditional characters and pinyin with a second LLM call")
+    parser.add_argument("--no-translation", action="store_true", help="do not request an English translation")
+    parser.add_argument("--no-stream", action="store_true", help="show replies only once they are complete")
+    parser.add_argument("--retrieval", choices=("vector", "lexical", "hybrid"), default="vector",
+                        help="how characters for the topic are looked up")
+    parser.add_argument("--direct-selection", action="store_true",
+                        help="use the top retrieved characters instead of letting the LLM select them")
+    parser.add_argument("--session-db", default=".cache/sessions.sqlite3", help="where conversations are stored")
+    parser.add_argument("--prefetch-topics", action="store_true",
+                        help="retrieve characters for recent topics in the background so switching to them is instant")
+    parser.add_argument("--review", action="store_true",
+                        help="practice characters that are due according to earlier conversations instead of a topic")
+    parser.add_argument("--resume", type=int, nargs="?", const=0, metavar="ID",
+                        help="continue a stored conversation, the latest one if no ID is given")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print how long imports and the startup phases took")
+    parser.add_argument("--requests-per-minute", type=float, help="requests to the OpenAI API allowed per minute")
+    parser.add_argument("--tokens-per-minute", type=float,
+                        help="estimated tokens sent to the OpenAI API per minute")
+    parser.add_argument("--trace-dir", help="write per-turn traces (trace.jsonl) and metrics (metrics.prom) here")
+    parser.add_argument("--trace-overlay", action="store_true", help="show the last turn's timings in the status bar")
     args = parser.parse_args()
-    DUMMY_RUN = args.dummy
+    DUMMY_RUN = args.dummy or args.stress is not None
+    profile = StartupProfile(enabled=args.profile_startup)
+
+    from dotenv import load_dotenv
+    if not load_dotenv(override=True) and not DUMMY_RUN and "OPENAI_API_KEY" not in os.environ:
+        raise ValueError("Failed to load OPENAI_API_KEY")
 
     app = QtWidgets.QApplication(sys.argv)
     app.setApplicationName('Tandem Partner')
     app.setFont(QFont(QFont().defaultFamily(), 18))
 
-    if DUMMY_RUN:
-        character_list = """停(tíng) - stop, suspend, delay; suitable
-救(jiù) - save, rescue, relieve; help, aid
-外(wài) - out, outside, external; foreign
-進(jìn) - advance, make progress, enter
-客(kè) - guest, traveller; customer
-集(jí) - assemble, collect together
-越(yuè) - exceed, go beyond; the more ...
-落(luò) - fall, drop; net income, surplus
-待(dài) - treat, entertain, receive; wait
-旅(lǚ) - travel, journey, trip"""
-    else:
-        if args.choose_topic:
-            topic = open_topic_dialog()
-            if not topic:
-                QtCore.QCoreApplication.exit()
+    with profile.phase("build window"):
+        window = ChatWindow()
+        window.show()
+    app.processEvents()
+    profile.mark("window shown")
 
-            character_list = get_character_list(topic=topic)
-        else:
-            character_list = get_character_list(topic="traveling")
+    topic = None
+    if not DUMMY_RUN and args.resume is None and not args.review:
+        topic = open_topic_dialog() if args.choose_topic else "traveling"
+        if not topic:
+            sys.exit(0)
+
+    def partner_loaded(tandem: "TandemPartner"):
+        with profile.phase("attach partner"):
+            window.attach_partner(tandem)
+        profile.mark("ready for input")
 
-    tandem = TandemPartner("Lang", character_list)
+        recent_topics = tandem.session_store.recent_topics() if tandem.session_store is not None else []
+        switcher = TopicSwitcher(lambda new_topic: retrieve_character_list(args, new_topic), parent=window)
+        if topic:
+            switcher.character_lists[topic] = tandem.character_list
+        if args.prefetch_topics:
+            # speculative, a topic that is never picked costs one retrieval
+            for recent_topic in recent_topics[:3]:
+                switcher.prefetch(recent_topic)
+        window.attach_topic_switcher(switcher, list(dict.fromkeys(recent_topics + _SUGGESTED_TOPICS)))
+        profile.report()
+        if args.stress is not None:
+            QtCore.QTimer.singleShot(0, lambda: run_stress_test(window, args.stress))
 
-    window = ChatWindow(tandem)
-    window.show()
+    loader = PartnerLoader(args, topic, profile)
+    loader.loaded.connect(partner_loaded)
+    loader.failed.connect(window.show_loading_error)
+    loader.turn_traced.connect(window.show_turn_trace)
+    loader.start()
 
     signal.signal(signal.SIGINT, signal.SIG_DFL)
-    sys.exit(app.exec())
\ No newline at end of file
+    sys.exit(app.exec())
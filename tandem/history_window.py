@@ -0,0 +1,113 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Optional
+
+import tiktoken
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage
+from langchain_core.runnables import Runnable
+from tandem.script_converter import parse_sections
+from tandem.tracing import get_tracer
+
+
+# per-message overhead of the chat format, see the OpenAI token counting cookbook
+_TOKENS_PER_MESSAGE = 4
+
+
+@lru_cache(maxsize=None)
+def _encoding_for_model(model_name: str) -> Optional[tiktoken.Encoding]:
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except Exception:
+        # tiktoken downloads its encodings on first use, offline the count is estimated.
+        # the failure is cached too, every new window would otherwise wait for the download to fail
+        return None
+
+
+class HistoryWindow:
+    def __init__(self, chat_history: BaseChatMessageHistory, summarizer: Optional[Runnable] = None,
+                 max_tokens: int = 1500, recent_turns: int = 4, fixed_tokens: int = 0,
+                 model_name: str = "gpt-3.5-turbo", executor: Optional[ThreadPoolExecutor] = None,
+                 on_summary: Optional[Callable[[str, int], None]] = None):
+        self.chat_history = chat_history
+        self.summarizer = summarizer
+        self.max_tokens = max_tokens
+        self.recent_turns = recent_turns
+        self.fixed_tokens = fixed_tokens
+        self.summary = ""
+        self.summarized_count = 0
+        # called from the summary thread with the new summary and the number of messages it covers
+        self.on_summary = on_summary
+        self.prompt_token_counts: list[int] = []
+        self._encoding = _encoding_for_model(model_name)
+        self._lock = threading.Lock()
+        self._summary_pending = False
+        # windows of many conversations can share one executor, a window only shuts down its own
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+
+    def count_tokens(self, text: str) -> int:
+        if self._encoding is None:
+            return len(text.encode("utf-8")) // 3 + 1
+        return len(self._encoding.encode(text))
+
+    def _prompt_message(self, message: BaseMessage) -> BaseMessage:
+        if isinstance(message, AIMessage):
+            # only the Chinese section goes back to the model, pinyin and translation are derived from it
+            return AIMessage(content=parse_sections(message.content)[0])
+        return message
+
+    def build(self) -> list[BaseMessage]:
+        with self._lock:
+            summary = self.summary
+            start = self.summarized_count
+        summary_message = SystemMessage(content=f"Summary of the earlier conversation:\n{summary}") if summary else None
+
+        window = [self._prompt_message(message) for message in self.chat_history.messages[start:]]
+        token_counts = [self.count_tokens(message.content) + _TOKENS_PER_MESSAGE for message in window]
+        total = self.fixed_tokens + sum(token_counts)
+        if summary_message:
+            total += self.count_tokens(summary_message.content) + _TOKENS_PER_MESSAGE
+
+        # turns older than the budget allows are dropped until the background summary has folded them in
+        while len(window) > 1 and total > self.max_tokens:
+            window.pop(0)
+            total -= token_counts.pop(0)
+
+        self.prompt_token_counts.append(total)
+        return [summary_message, *window] if summary_message else window
+
+    def schedule_summary(self):
+        if self.summarizer is None:
+            return
+        with self._lock:
+            end = len(self.chat_history.messages) - 2 * self.recent_turns
+            if self._summary_pending or end <= self.summarized_count:
+                return
+            self._summary_pending = True
+        self._executor.submit(self._summarize, end)
+
+    def _summarize(self, end: int):
+        with self._lock:
+            summary = self.summary
+            start = self.summarized_count
+        messages = [self._prompt_message(message) for message in self.chat_history.messages[start:end]]
+        try:
+            summary = self.summarizer.invoke({"summary": summary or "(none)", "messages": messages},
+                                             config=get_tracer().run_config())
+        except Exception:
+            with self._lock:
+                self._summary_pending = False
+            return
+
+        with self._lock:
+            self.summary = summary
+            self.summarized_count = end
+            self._summary_pending = False
+        if self.on_summary is not None:
+            self.on_summary(summary, end)
+
+    def shutdown(self):
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
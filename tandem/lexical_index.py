@@ -0,0 +1,114 @@
+import gzip
+import json
+import math
+import re
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+
+_FORMAT_VERSION = 1
+_WORD = re.compile(r"[a-z]+|[㐀-鿿]")
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "of", "on", "or", "the",
+    "to", "with", "one", "who", "that", "this", "about", "talk", "conversation", "topic",
+}
+_SUFFIXES = ("ings", "ing", "ers", "er", "ies", "ed", "ly", "s")
+
+
+def _stem(word: str) -> str:
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            if suffix == "ies":
+                word += "y"
+            break
+    # travelling -> travell -> travel
+    if len(word) > 4 and word[-1] == word[-2] and word[-1] not in "aeiou":
+        word = word[:-1]
+    return word
+
+
+def tokenize(text: str) -> list[str]:
+    return [_stem(token) for token in _WORD.findall(text.lower()) if token not in _STOPWORDS]
+
+
+class LexicalIndex:
+    def __init__(self, documents: list[dict], doc_lengths: list[int], postings: dict[str, tuple[list[int], list[int]]],
+                 k1: float = 1.5, b: float = 0.75):
+        self.documents = documents
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.avg_length = sum(doc_lengths) / max(len(doc_lengths), 1)
+
+    @classmethod
+    def build(cls, documents: list[Document]) -> "LexicalIndex":
+        postings = defaultdict(lambda: ([], []))
+        doc_lengths = []
+        for doc_idx, doc in enumerate(documents):
+            # the English meaning is weighted double since it describes the character itself
+            tokens = tokenize(doc.metadata["meaning"]) * 2 + tokenize(doc.metadata["vocabulary"])
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings[term][0].append(doc_idx)
+                postings[term][1].append(tf)
+        serialized = [{"id": doc.id, "page_content": doc.page_content, "metadata": doc.metadata} for doc in documents]
+        return cls(serialized, doc_lengths, dict(postings))
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        with gzip.open(path, mode="rt", encoding="utf-8") as f:
+            data = json.load(f)
+        if data["version"] != _FORMAT_VERSION:
+            raise ValueError(f"Unsupported lexical index version {data['version']} in {path}")
+        postings = {term: (doc_ids, tfs) for term, (doc_ids, tfs) in data["postings"].items()}
+        return cls(data["documents"], data["doc_lengths"], postings)
+
+    @classmethod
+    def load_or_build(cls, path: str, source_path: str, documents_loader) -> "LexicalIndex":
+        if Path(path).exists() and Path(path).stat().st_mtime >= Path(source_path).stat().st_mtime:
+            return cls.load(path)
+        index = cls.build(documents_loader(source_path))
+        index.save(path)
+        return index
+
+    def save(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "version": _FORMAT_VERSION,
+            "documents": self.documents,
+            "doc_lengths": self.doc_lengths,
+            "postings": self.postings,
+        }
+        with gzip.open(path, mode="wt", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+    def search(self, query: str, k: int) -> list[tuple[int, float]]:
+        scores = defaultdict(float)
+        n_docs = len(self.doc_lengths)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            doc_ids, tfs = self.postings[term]
+            idf = math.log(1 + (n_docs - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            for doc_idx, tf in zip(doc_ids, tfs):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_idx] / self.avg_length)
+                scores[doc_idx] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+    def document(self, doc_idx: int) -> Document:
+        data = self.documents[doc_idx]
+        return Document(id=data["id"], page_content=data["page_content"], metadata=data["metadata"])
+
+
+class LexicalRetriever(BaseRetriever):
+    index: LexicalIndex
+    k: int = 30
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        return [self.index.document(doc_idx) for doc_idx, _ in self.index.search(query, self.k)]
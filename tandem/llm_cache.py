@@ -0,0 +1,257 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, NamedTuple, Optional, Sequence
+
+from langchain_core._api import LangChainBetaWarning
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+from langchain_core.load import dumps, loads
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_openai import ChatOpenAI
+from tandem.tracing import get_tracer
+
+
+_DEFAULT_CACHE_PATH = f"{Path(__file__).parent.parent}/.cache/llm-responses.sqlite3"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    generations TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS responses_by_last_used ON responses(last_used);
+"""
+
+
+class CacheStats(NamedTuple):
+    memory_hits: int
+    disk_hits: int
+    misses: int
+    skipped: int
+
+
+def _model_params(llm_string: str) -> Optional[dict]:
+    # serialized model, then the call parameters, see BaseChatModel._get_llm_string
+    try:
+        return json.loads(llm_string.rsplit("---", 1)[0]).get("kwargs", {})
+    except (json.JSONDecodeError, AttributeError):
+        return None
+
+
+def is_deterministic(llm_string: str) -> bool:
+    params = _model_params(llm_string)
+    # the tandem chain samples at 0.7 on purpose, caching it would repeat the same reply to the same message
+    return params is not None and params.get("temperature") == 0 and params.get("n", 1) == 1
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: " ".join(v.split()) if k == "content" and isinstance(v, str) else _normalize(v)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def normalize_prompt(prompt: str) -> str:
+    # serialized messages, whitespace around and inside the content does not change the answer
+    try:
+        return json.dumps(_normalize(json.loads(prompt)), ensure_ascii=False, sort_keys=True)
+    except json.JSONDecodeError:
+        return " ".join(prompt.split())
+
+
+def _load_generations(data: str) -> RETURN_VAL_TYPE:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", LangChainBetaWarning)
+        return [loads(generation) for generation in json.loads(data)]
+
+
+class ResponseCache(BaseCache):
+    def __init__(self, path: Optional[str] = _DEFAULT_CACHE_PATH, memory_entries: int = 256):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.memory: OrderedDict[str, RETURN_VAL_TYPE] = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self.connection = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(_SCHEMA)
+
+    @staticmethod
+    def key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\0{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, value: RETURN_VAL_TYPE):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if not is_deterministic(llm_string):
+            with self._lock:
+                self.skipped += 1
+            return None
+        key = self.key(prompt, llm_string)
+        with self._lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+            elif self.connection is not None:
+                row = self.connection.execute("SELECT generations FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value = _load_generations(row[0])
+                    self._remember(key, value)
+                    self.disk_hits += 1
+            if value is None:
+                self.misses += 1
+            elif self.connection is not None:
+                with self.connection:
+                    self.connection.execute("UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?",
+                                            (time.time(), key))
+        get_tracer().cache_access("llm", value is not None)
+        return value
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE):
+        if not is_deterministic(llm_string):
+            return
+        key = self.key(prompt, llm_string)
+        with self._lock:
+            self._remember(key, return_val)
+            if self.connection is None:
+                return
+            now = time.time()
+            params = _model_params(llm_string)
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, prompt, generations, created, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, params.get("model_name", ""), prompt,
+                     json.dumps([dumps(generation) for generation in return_val]), now, now)
+                )
+
+    def clear(self, **kwargs: Any):
+        with self._lock:
+            self.memory.clear()
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute("DELETE FROM responses")
+
+    def prune(self, max_age_s: Optional[float] = None, max_entries: Optional[int] = None) -> int:
+        if self.connection is None:
+            return 0
+        with self._lock, self.connection:
+            deleted = 0
+            if max_age_s is not None:
+                deleted += self.connection.execute("DELETE FROM responses WHERE last_used < ?",
+                                                   (time.time() - max_age_s,)).rowcount
+            if max_entries is not None:
+                # the least recently used responses go first
+                deleted += self.connection.execute(
+                    "DELETE FROM responses WHERE key NOT IN "
+                    "(SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)", (max_entries,)
+                ).rowcount
+            self.memory.clear()
+        return deleted
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self.memory_hits, self.disk_hits, self.misses, self.skipped)
+
+    def summary(self) -> list[tuple[str, int, int, int]]:
+        # model, entries, stored bytes, hits
+        if self.connection is None:
+            return []
+        with self._lock:
+            return self.connection.execute(
+                "SELECT model, COUNT(*), SUM(LENGTH(prompt) + LENGTH(generations)), SUM(hits) "
+                "FROM responses GROUP BY model ORDER BY model"
+            ).fetchall()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class CachedChatOpenAI(ChatOpenAI):
+    # langchain only consults the cache for invoke, streamed calls of a cached model are served here
+    def _cache_key(self, messages: list[BaseMessage], stop: Optional[list[str]], **kwargs: Any):
+        return dumps(messages), self._get_llm_string(stop=stop, **kwargs)
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        if not isinstance(self.cache, ResponseCache):
+            yield from super(CachedChatOpenAI, self)._stream(messages, stop, run_manager, **kwargs)
+            return
+        prompt, llm_string = self._cache_key(messages, stop, **kwargs)
+        cached = self.cache.lookup(prompt, llm_string)
+        if cached is not None:
+            yield ChatGenerationChunk(message=AIMessageChunk(content=cached[0].text))
+            return
+        chunks = []
+        for chunk in super(CachedChatOpenAI, self)._stream(messages, stop, run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        self.cache.update(prompt, llm_string, generate_from_stream(iter(chunks)).generations)
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        if not isinstance(self.cache, ResponseCache):
+            async for chunk in super(CachedChatOpenAI, self)._astream(messages, stop, run_manager, **kwargs):
+                yield chunk
+            return
+        prompt, llm_string = self._cache_key(messages, stop, **kwargs)
+        cached = await self.cache.alookup(prompt, llm_string)
+        if cached is not None:
+            yield ChatGenerationChunk(message=AIMessageChunk(content=cached[0].text))
+            return
+        chunks = []
+        async for chunk in super(CachedChatOpenAI, self)._astream(messages, stop, run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        await self.cache.aupdate(prompt, llm_string, (await agenerate_from_stream(_aiter(chunks))).generations)
+
+
+async def _aiter(items: Sequence):
+    for item in items:
+        yield item
+
+
+_response_cache: Optional[ResponseCache] = None
+_configured = False
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _response_cache, _configured
+    if not _configured:
+        _response_cache = ResponseCache()
+        _configured = True
+    return _response_cache
+
+
+def configure_response_cache(path: Optional[str] = _DEFAULT_CACHE_PATH, enabled: bool = True,
+                             **kwargs) -> Optional[ResponseCache]:
+    global _response_cache, _configured
+    # a cache without a path stays in memory, a disabled one lets every call through
+    _response_cache = ResponseCache(path, **kwargs) if enabled else None
+    _configured = True
+    return _response_cache
@@ -1,24 +1,136 @@
+import argparse
+import asyncio
+import json
+import time
+
+from dotenv import load_dotenv
 from langchain.memory import ChatMessageHistory
 from tandem.char_retrieval_chain import get_character_list
-from tandem.conversation_chain import get_tandem_partner
+from tandem.conversation_chain import get_summarizer_chain, get_tandem_partner, get_tandem_system_message
+from tandem.history_window import HistoryWindow
+from tandem.tracing import configure_tracing, get_tracer
 
 def run_conversation_loop(conversation_chain):
     chat_history = ChatMessageHistory()
+    history_window = HistoryWindow(chat_history, get_summarizer_chain())
     while True:
         message = input("[Student]: ")
         terminate = "Bye!" in message
         chat_history.add_user_message(message)
-        response = conversation_chain.invoke({'input': chat_history})
+        response = conversation_chain.invoke({'chat_history': history_window.build()})
         chat_history.add_ai_message(response)
+        history_window.schedule_summary()
         print(f"[Lang]:\n{response}")
         if terminate:
             print("\nTandem session ended.")
             break
 
+
+def load_scripts(path: str) -> list[dict]:
+    # one conversation per line: {"id": ..., "topic": ... or "character_list": ..., "messages": [...]}
+    scripts = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            messages = record.get("messages") if isinstance(record, dict) else None
+            if not isinstance(messages, list) or not messages or not all(isinstance(m, str) for m in messages):
+                raise ValueError(f"{path}:{line_no}: expected a scripted conversation with a non-empty "
+                                 f"\"messages\" list of strings")
+            scripts.append({
+                "id": record.get("id", line_no),
+                "topic": record.get("topic") or "household chores",
+                "character_list": record.get("character_list"),
+                "messages": messages,
+            })
+    return scripts
+
+
+async def run_scripted_session(script: dict, character_lists: dict, semaphore: asyncio.Semaphore) -> dict:
+    start = time.perf_counter()
+    character_list = script["character_list"]
+    turns = []
+    prompt_tokens = []
+    error = None
+    async with semaphore:
+        try:
+            if character_list is None:
+                topic = script["topic"]
+                # sessions on the same topic share one retrieval
+                if topic not in character_lists:
+                    character_lists[topic] = asyncio.create_task(asyncio.to_thread(get_character_list, topic=topic))
+                character_list = await character_lists[topic]
+            chain = get_tandem_partner(character_list)
+
+            chat_history = ChatMessageHistory()
+            history_window = HistoryWindow(chat_history, get_summarizer_chain())
+            # the system prompt counts against the budget, like in TandemPartner, the chain converts locally
+            history_window.fixed_tokens = history_window.count_tokens(
+                get_tandem_system_message(character_list, with_translation=True))
+            prompt_tokens = history_window.prompt_token_counts
+            try:
+                # turns of one session depend on each other, only sessions run concurrently
+                for message in script["messages"]:
+                    chat_history.add_user_message(message)
+                    turn_start = time.perf_counter()
+                    turn_trace = get_tracer().start_turn()
+                    with get_tracer().activate(turn_trace):
+                        response = await chain.ainvoke({'chat_history': history_window.build()},
+                                                       config=get_tracer().run_config(turn_trace))
+                    get_tracer().finish_turn(turn_trace)
+                    turns.append({"message": message, "response": response,
+                                  "latency_s": time.perf_counter() - turn_start})
+                    chat_history.add_ai_message(response)
+                    history_window.schedule_summary()
+            finally:
+                history_window.shutdown()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+    return {"id": script["id"], "topic": script["topic"], "character_list": character_list, "turns": turns,
+            "error": error, "prompt_tokens": prompt_tokens, "session_s": time.perf_counter() - start}
+
+
+async def run_batch(input_path: str, output_path: str, concurrency: int):
+    scripts = load_scripts(input_path)
+    semaphore = asyncio.Semaphore(concurrency)
+    character_lists = {}
+    start = time.perf_counter()
+    session_seconds = []
+    with open(output_path, "w", encoding="utf-8") as f:
+        tasks = [asyncio.create_task(run_scripted_session(script, character_lists, semaphore)) for script in scripts]
+        # transcripts are written as sessions finish, an interrupted run keeps what is done
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            session_seconds.append(result["session_s"])
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            f.flush()
+            status = f"failed: {result['error']}" if result["error"] else f"{len(result['turns'])} turns"
+            print(f"session {result['id']}: {status} in {result['session_s']:.1f} s")
+    print(f"{len(scripts)} sessions in {time.perf_counter() - start:.1f} s wall time, "
+          f"{sum(session_seconds):.1f} s summed, slowest {max(session_seconds, default=0):.1f} s")
+
+
 if __name__ == '__main__':
-    topic = input('Conversation topic (default: "household chores"): ') or "household chores"
-    character_list = get_character_list(topic=topic)
-    print("character list:",character_list)
-    tandem_partner = get_tandem_partner(character_list)
+    parser = argparse.ArgumentParser(description="Talk to the tandem partner, or replay scripted conversations")
+    parser.add_argument("--batch", metavar="JSONL",
+                        help="run the conversations in this file headless, one JSON object per line with an id, "
+                             "a topic or character_list and a list of messages")
+    parser.add_argument("--output", default="batch-transcripts.jsonl", help="where batch transcripts are written")
+    parser.add_argument("--concurrency", type=int, default=8, help="sessions running at the same time")
+    parser.add_argument("--trace-dir", help="write per-turn traces (trace.jsonl) and metrics (metrics.prom) here")
+    args = parser.parse_args()
+    load_dotenv(override=True)
+    if args.trace_dir:
+        configure_tracing(log_path=f"{args.trace_dir}/trace.jsonl", metrics_path=f"{args.trace_dir}/metrics.prom")
+
+    if args.batch:
+        asyncio.run(run_batch(args.batch, args.output, args.concurrency))
+    else:
+        topic = input('Conversation topic (default: "household chores"): ') or "household chores"
+        character_list = get_character_list(topic=topic)
+        print("character list:",character_list)
+        tandem_partner = get_tandem_partner(character_list)
 
-    run_conversation_loop(tandem_partner)
+        run_conversation_loop(tandem_partner)
@@ -0,0 +1,112 @@
+import threading
+from collections import deque
+from typing import Optional
+
+from langchain_core.runnables import Runnable
+from PySide6.QtCore import QObject, QThreadPool, Signal, Slot
+from tandem.tracing import TurnTrace, get_tracer
+
+
+class ChainRequest(QObject):
+    chunk_received = Signal(str)
+    response_received = Signal(str)
+    request_failed = Signal(str)
+    cancelled = Signal()
+
+    def __init__(self, chain: Runnable, chain_input: dict, streaming: bool = True, config: Optional[dict] = None,
+                 turn_trace: Optional[TurnTrace] = None):
+        super(ChainRequest, self).__init__()
+        self.chain = chain
+        self.chain_input = chain_input
+        self.streaming = streaming
+        self.config = config
+        self.turn_trace = turn_trace
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def run(self):
+        if self.is_cancelled():
+            self.cancelled.emit()
+            return
+        try:
+            # caches and timed stages consulted by the chain count for the turn
+            with get_tracer().activate(self.turn_trace):
+                if not self.streaming:
+                    # a blocking call cannot be interrupted, its result is dropped instead
+                    response = self.chain.invoke(self.chain_input, config=self.config)
+                else:
+                    response = ""
+                    stream = self.chain.stream(self.chain_input, config=self.config)
+                    for chunk in stream:
+                        if self.is_cancelled():
+                            # closing the generator closes the HTTP response
+                            stream.close()
+                            break
+                        response += chunk
+                        self.chunk_received.emit(chunk)
+        except Exception as e:
+            self.request_failed.emit(str(e))
+            return
+        if self.is_cancelled():
+            self.cancelled.emit()
+        else:
+            self.response_received.emit(response)
+
+
+class RequestExecutor(QObject):
+    # emitted on the pool thread, delivered on the thread that owns the executor
+    _request_done = Signal(object)
+
+    def __init__(self, max_concurrency: int = 1, max_pending: int = 4, parent: Optional[QObject] = None):
+        super(RequestExecutor, self).__init__(parent)
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_concurrency)
+        # pool threads live as long as the executor, a turn does not pay for a new thread
+        self.pool.setExpiryTimeout(-1)
+        self.pending: deque[ChainRequest] = deque()
+        self.running: list[ChainRequest] = []
+        self._request_done.connect(self._finished)
+
+    def submit(self, request: ChainRequest) -> ChainRequest:
+        while len(self.pending) >= self.max_pending:
+            # backpressure, the oldest waiting request is the stalest one
+            dropped = self.pending.popleft()
+            dropped.cancel()
+            dropped.cancelled.emit()
+        self.pending.append(request)
+        self._dispatch()
+        return request
+
+    def _dispatch(self):
+        while self.pending and len(self.running) < self.max_concurrency:
+            request = self.pending.popleft()
+            self.running.append(request)
+            self.pool.start(lambda request=request: self._run(request))
+
+    def _run(self, request: ChainRequest):
+        try:
+            request.run()
+        finally:
+            self._request_done.emit(request)
+
+    @Slot(object)
+    def _finished(self, request: ChainRequest):
+        self.running.remove(request)
+        self._dispatch()
+
+    def cancel_all(self):
+        for request in [*self.pending, *self.running]:
+            request.cancel()
+        while self.pending:
+            self.pending.popleft().cancelled.emit()
+
+    def shutdown(self, timeout_ms: Optional[int] = 2000):
+        self.cancel_all()
+        self.pool.waitForDone(-1 if timeout_ms is None else timeout_ms)
@@ -0,0 +1,251 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Iterator, Optional
+
+
+_DATA_DIR = Path(__file__).parent.parent / "data"
+_DEFAULT_CHARACTER_PATH = _DATA_DIR / "3000-traditional-hanzi.tsv"
+_DEFAULT_SIMPLIFIED_TRADITIONAL_PATH = _DATA_DIR / "simplified-traditional.tsv"
+_DEFAULT_PINYIN_FALLBACK_PATH = _DATA_DIR / "pinyin-fallback.tsv"
+
+SECTION_SEPARATOR = "---"
+
+_PUNCTUATION = {
+    "，": ",", "。": ".", "！": "!", "？": "?", "：": ":", "；": ";", "、": ",",
+    "“": "\"", "”": "\"", "「": "\"", "」": "\"", "『": "\"", "』": "\"",
+    "（": "(", "）": ")", "《": "\"", "》": "\"", "…": "...", "～": "~", "—": "-",
+}
+_ASCII_PUNCTUATION = set(",.!?:;\"()")
+_SENTENCE_END = {".", "!", "?"}
+
+
+def parse_sections(message: str) -> tuple[str, str, str]:
+    parts = message.split(SECTION_SEPARATOR)
+    traditional = parts[0].strip() if len(parts) > 0 else ""
+    pinyin = parts[1].strip() if len(parts) > 1 else ""
+    english = parts[2].strip() if len(parts) > 2 else ""
+    return traditional, pinyin, english
+
+
+def _is_cjk(char: str) -> bool:
+    return "㐀" <= char <= "鿿" or "豈" <= char <= "﫿"
+
+
+def _read_table(path: Path) -> dict[str, str]:
+    table = {}
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) >= 2 and columns[0]:
+                table[columns[0]] = columns[1]
+    return table
+
+
+class ScriptConverter:
+    def __init__(self, simplified_traditional: dict[str, str], pinyin: dict[str, str],
+                 ranks: Optional[dict[str, int]] = None):
+        self.simplified_traditional = simplified_traditional
+        self.pinyin = pinyin
+        # frequency rank of single characters, the more common one stands alone when two splits tie
+        self.ranks = ranks or {}
+        self._max_phrase_length = max((len(k) for k in simplified_traditional), default=1)
+        self._max_pinyin_length = max((len(k) for k in pinyin), default=1)
+
+    @classmethod
+    def from_files(cls,
+                   character_tsv_path: Path = _DEFAULT_CHARACTER_PATH,
+                   simplified_traditional_path: Path = _DEFAULT_SIMPLIFIED_TRADITIONAL_PATH,
+                   pinyin_fallback_path: Optional[Path] = _DEFAULT_PINYIN_FALLBACK_PATH) -> "ScriptConverter":
+        pinyin = {}
+        ranks = {}
+        with open(character_tsv_path, encoding="utf8") as f:
+            for line in f:
+                columns = line.rstrip("\n").split("\t")
+                if len(columns) < 2:
+                    continue
+                pinyin[columns[0]] = columns[1]
+                # the list is ordered by frequency
+                ranks.setdefault(columns[0], len(ranks) + 1)
+                # vocabulary words give the correct reading of polyphonic characters, e.g. 銀行 yínháng
+                if len(columns) >= 5:
+                    for word, word_pinyin in zip(columns[3].split(), columns[4].split()):
+                        pinyin[word] = word_pinyin
+        if pinyin_fallback_path is not None:
+            pinyin.update(_read_table(pinyin_fallback_path))
+
+        simplified_traditional = _read_table(simplified_traditional_path)
+        for simplified, traditional in simplified_traditional.items():
+            if len(simplified) == 1 and traditional in ranks:
+                ranks.setdefault(simplified, ranks[traditional])
+        return cls(simplified_traditional, pinyin, ranks)
+
+    def _match_lengths(self, text: str, start: int, table: dict[str, str], max_length: int) -> list[int]:
+        # a single character is always a word, with or without an entry
+        lengths = [length for length in range(min(max_length, len(text) - start), 1, -1)
+                   if text[start:start + length] in table]
+        return lengths + [1]
+
+    def _match(self, text: str, start: int, table: dict[str, str], max_length: int) -> tuple[str, Optional[str]]:
+        # the longest match splits 我們的話題 into 的話 題, so the first word is chosen together
+        # with the word after it: longest pair, then fewer words, then the more common single
+        # characters (的 話題 over 的話 題), then the longer first word
+        best_key, best_length = None, 1
+        for first in self._match_lengths(text, start, table, max_length):
+            following = start + first
+            seconds = [0]
+            if following < len(text) and _is_cjk(text[following]):
+                seconds = self._match_lengths(text, following, table, max_length)
+            for second in seconds:
+                words = [word for word in (text[start:following], text[following:following + second]) if word]
+                rarity = sum(self.ranks.get(word, len(self.ranks) + 1) for word in words if len(word) == 1)
+                key = (first + second, -len(words), -rarity, first)
+                if best_key is None or key > best_key:
+                    best_key, best_length = key, first
+        source = text[start:start + best_length]
+        return source, table.get(source)
+
+    def to_traditional(self, text: str) -> str:
+        result = []
+        i = 0
+        while i < len(text):
+            if not _is_cjk(text[i]):
+                result.append(text[i])
+                i += 1
+                continue
+            source, target = self._match(text, i, self.simplified_traditional, self._max_phrase_length)
+            result.append(target if target is not None else source)
+            i += len(source)
+        return "".join(result)
+
+    def to_pinyin(self, text: str) -> str:
+        result = []
+        capitalize = True
+        attach_next = True
+        quote_open = False
+
+        def append_word(word):
+            nonlocal capitalize, attach_next
+            if not attach_next:
+                result.append(" ")
+            if capitalize:
+                word = word[:1].upper() + word[1:]
+                capitalize = False
+            result.append(word)
+            attach_next = False
+
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if _is_cjk(char):
+                source, syllables = self._match(text, i, self.pinyin, self._max_pinyin_length)
+                append_word(syllables if syllables is not None else source)
+                i += len(source)
+            elif char in _PUNCTUATION or char in _ASCII_PUNCTUATION:
+                mark = _PUNCTUATION.get(char, char)
+                opening = mark == "(" or (mark == "\"" and not quote_open)
+                if mark == "\"":
+                    quote_open = not quote_open
+                if opening and not attach_next:
+                    result.append(" ")
+                result.append(mark)
+                attach_next = opening
+                capitalize = capitalize or mark in _SENTENCE_END
+                i += 1
+            elif char == "\n":
+                result.append("\n")
+                capitalize = True
+                attach_next = True
+                i += 1
+            elif char.isspace():
+                i += 1
+            else:
+                end = i
+                while end < len(text) and not _is_cjk(text[end]) and not text[end].isspace() \
+                        and text[end] not in _PUNCTUATION and text[end] not in _ASCII_PUNCTUATION:
+                    end += 1
+                append_word(text[i:end])
+                i = end
+        return "".join(result).strip()
+
+    def convert_response(self, message: str) -> str:
+        parts = message.split(SECTION_SEPARATOR, 1)
+        traditional = self.to_traditional(parts[0].strip())
+        sections = [traditional, self.to_pinyin(traditional)]
+        if len(parts) > 1 and parts[1].strip():
+            sections.append(parts[1].strip())
+        return f"\n{SECTION_SEPARATOR}\n".join(sections)
+
+    def transform_stream(self, chunks: Iterator[str]) -> Iterator[str]:
+        # Streaming variant of convert_response, the yielded deltas add up to the same text.
+        stream = _ResponseStream(self)
+        for chunk in chunks:
+            yield from stream.feed(chunk)
+        yield from stream.finish()
+
+    async def atransform_stream(self, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        stream = _ResponseStream(self)
+        async for chunk in chunks:
+            for delta in stream.feed(chunk):
+                yield delta
+        for delta in stream.finish():
+            yield delta
+
+
+class _ResponseStream:
+    # Characters are yielded once no longer phrase can change their conversion, the pinyin
+    # section follows when the Chinese part is complete and the translation is passed through.
+    def __init__(self, converter: ScriptConverter):
+        self.converter = converter
+        self.raw = ""
+        self.emitted = 0
+        # a word is chosen by looking at the word after it, so two phrases can still change it
+        self.holdback = max(2 * converter._max_phrase_length - 1, len(SECTION_SEPARATOR)) - 1
+        self.in_translation = False
+        self.translation_started = False
+        self.pending = ""
+
+    def feed(self, chunk: str) -> Iterator[str]:
+        if self.in_translation:
+            yield from self._translation(chunk)
+            return
+        self.raw += chunk
+        separator_idx = self.raw.find(SECTION_SEPARATOR)
+        if separator_idx >= 0:
+            yield from self._chinese_done(self.raw[:separator_idx])
+            self.in_translation = True
+            yield from self._translation(self.raw[separator_idx + len(SECTION_SEPARATOR):].lstrip())
+            return
+        chinese = self.raw.lstrip()
+        stable_end = len(chinese[:max(len(chinese) - self.holdback, 0)].rstrip())
+        if stable_end > self.emitted:
+            yield self.converter.to_traditional(chinese)[self.emitted:stable_end]
+            self.emitted = stable_end
+
+    def finish(self) -> Iterator[str]:
+        # trailing whitespace of the translation is dropped, like convert_response strips it
+        if not self.in_translation:
+            yield from self._chinese_done(self.raw)
+
+    def _chinese_done(self, chinese: str) -> Iterator[str]:
+        traditional = self.converter.to_traditional(chinese.strip())
+        if len(traditional) > self.emitted:
+            yield traditional[self.emitted:]
+        yield f"\n{SECTION_SEPARATOR}\n{self.converter.to_pinyin(traditional)}"
+
+    def _translation(self, chunk: str) -> Iterator[str]:
+        if not self.translation_started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                return
+            self.translation_started = True
+            yield f"\n{SECTION_SEPARATOR}\n"
+        text = self.pending + chunk
+        stripped = text.rstrip()
+        self.pending = text[len(stripped):]
+        if stripped:
+            yield stripped
+
+
+@lru_cache(maxsize=1)
+def get_default_converter() -> ScriptConverter:
+    return ScriptConverter.from_files()
@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import WSMsgType, web
+from dotenv import load_dotenv
+from langchain.memory import ChatMessageHistory
+from langchain_core.messages import AIMessage
+from langchain_openai import ChatOpenAI
+from openai import AsyncOpenAI
+from tandem.audio_cache import AudioCache
+from tandem.clients import configure_clients, get_clients
+from tandem.char_retrieval_chain import get_character_list, get_character_retriever
+from tandem.conversation_chain import get_summarizer_chain, get_tandem_llm, get_tandem_partner
+from tandem.history_window import HistoryWindow
+from tandem.script_converter import parse_sections
+from tandem.tracing import STAGE_TTS, configure_tracing, get_tracer
+
+
+# chain, prompt template and window of a session, measured with tracemalloc for a session without messages
+_SESSION_OVERHEAD_BYTES = 10 * 1024
+
+
+class ServerSession:
+    def __init__(self, session_id: str, topic: Optional[str], character_list: str, llm: ChatOpenAI,
+                 summarizer, executor: ThreadPoolExecutor, local_conversion: bool = True, translate: bool = True):
+        self.id = session_id
+        self.topic = topic
+        self.character_list = character_list
+        self.chat_history = ChatMessageHistory()
+        self.history_window = HistoryWindow(self.chat_history, summarizer, executor=executor)
+        self.chain = get_tandem_partner(character_list, local_conversion=local_conversion, translate=translate,
+                                        llm=llm)
+        self.last_used = time.monotonic()
+        # turns of one conversation depend on each other, a second message waits for the running reply
+        self.lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self.lock.locked()
+
+    def size(self) -> int:
+        text = sum(len(message.content.encode("utf-8")) for message in self.chat_history.messages)
+        return _SESSION_OVERHEAD_BYTES + text + len(self.character_list.encode("utf-8")) \
+            + len(self.history_window.summary.encode("utf-8"))
+
+    def to_dict(self, with_messages: bool = False) -> dict:
+        result = {"id": self.id, "topic": self.topic, "character_list": self.character_list,
+                  "message_count": len(self.chat_history.messages)}
+        if with_messages:
+            result["summary"] = self.history_window.summary
+            result["messages"] = [{"role": message.type, "content": message.content}
+                                  for message in self.chat_history.messages]
+        return result
+
+    async def reply(self, message: str, on_chunk: Optional[Callable[[str], Awaitable[None]]] = None) -> tuple[int, str]:
+        async with self.lock:
+            self.last_used = time.monotonic()
+            self.chat_history.add_user_message(message)
+            tracer = get_tracer()
+            turn_trace = tracer.start_turn()
+            response = ""
+            try:
+                with tracer.activate(turn_trace):
+                    async for chunk in self.chain.astream({"chat_history": self.history_window.build()},
+                                                          config=tracer.run_config(turn_trace)):
+                        if not response:
+                            tracer.first_chunk(turn_trace)
+                        response += chunk
+                        if on_chunk is not None:
+                            await on_chunk(chunk)
+            except BaseException:
+                # a failed or abandoned turn leaves no unanswered message behind
+                self.chat_history.messages.pop()
+                raise
+            self.chat_history.add_ai_message(response)
+            tracer.finish_turn(turn_trace)
+            self.history_window.schedule_summary()
+            self.last_used = time.monotonic()
+            return len(self.chat_history.messages) - 1, response
+
+    def close(self):
+        self.history_window.shutdown()
+
+
+class SessionManager:
+    def __init__(self, max_sessions: int = 1000, max_bytes: int = 64 * 1024 * 1024, idle_seconds: float = 1800,
+                 local_conversion: bool = True, translate: bool = True, summary_workers: int = 4):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.local_conversion = local_conversion
+        self.translate = translate
+        # one model and one summarizer for all sessions, they share the HTTP connection pool
+        self.llm = get_tandem_llm()
+        self.summarizer = get_summarizer_chain()
+        self.executor = ThreadPoolExecutor(max_workers=summary_workers, thread_name_prefix="history-summary")
+        self.sessions: OrderedDict[str, ServerSession] = OrderedDict()
+        self.evicted = 0
+
+    def create(self, topic: Optional[str], character_list: str) -> ServerSession:
+        session = ServerSession(uuid.uuid4().hex, topic, character_list, self.llm, self.summarizer, self.executor,
+                                local_conversion=self.local_conversion, translate=self.translate)
+        self.sessions[session.id] = session
+        self.evict()
+        return session
+
+    def get(self, session_id: str) -> Optional[ServerSession]:
+        session = self.sessions.get(session_id)
+        if session is not None:
+            # the order of the dict is the LRU order
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+        return session
+
+    def remove(self, session_id: str) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def total_bytes(self) -> int:
+        return sum(session.size() for session in self.sessions.values())
+
+    def evict(self) -> list[str]:
+        now = time.monotonic()
+        evicted = [session.id for session in self.sessions.values()
+                   if not session.busy and now - session.last_used > self.idle_seconds]
+        for session_id in evicted:
+            self.remove(session_id)
+
+        # over a cap the least recently used idle sessions go first, a session answering a message stays
+        total = self.total_bytes()
+        for session in list(self.sessions.values()):
+            if len(self.sessions) <= self.max_sessions and total <= self.max_bytes:
+                break
+            if session.busy:
+                continue
+            total -= session.size()
+            self.remove(session.id)
+            evicted.append(session.id)
+        self.evicted += len(evicted)
+        return evicted
+
+    async def run_eviction(self, interval: float = 30.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.evict()
+
+    def close(self):
+        for session_id in list(self.sessions):
+            self.remove(session_id)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TandemServer:
+    def __init__(self, manager: SessionManager, retrieval_mode: str = "vector", backend: str = "chroma",
+                 llm_selection: bool = True, preload_index: bool = True, voice: str = "nova", tts_model: str = "tts-1",
+                 eviction_interval: float = 30.0):
+        self.manager = manager
+        self.retrieval_mode = retrieval_mode
+        self.backend = backend
+        self.llm_selection = llm_selection
+        self.preload_index = preload_index
+        self.voice = voice
+        self.tts_model = tts_model
+        self.eviction_interval = eviction_interval
+        self.openai_client: Optional[AsyncOpenAI] = None
+        self.audio_cache = AudioCache()
+        self._character_lists: dict[str, asyncio.Task] = {}
+        self._eviction_task: Optional[asyncio.Task] = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.post("/sessions", self.create_session),
+            web.get("/sessions/{id}", self.get_session),
+            web.delete("/sessions/{id}", self.delete_session),
+            web.post("/sessions/{id}/messages", self.post_message),
+            web.get("/sessions/{id}/ws", self.websocket),
+            web.get("/sessions/{id}/messages/{index}/speech", self.speech),
+            web.get("/metrics", self.metrics),
+        ])
+        app.on_startup.append(self._startup)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def _startup(self, app: web.Application):
+        self.openai_client = get_clients().async_openai_client()
+        if self.preload_index:
+            # the index is loaded once before the first request, not by whichever session asks first
+            retriever = get_character_retriever(backend=self.backend, mode=self.retrieval_mode,
+                                                llm_selection=self.llm_selection)
+            await asyncio.to_thread(lambda: retriever.retriever)
+        self._eviction_task = asyncio.create_task(self.manager.run_eviction(self.eviction_interval))
+
+    async def _cleanup(self, app: web.Application):
+        if self._eviction_task is not None:
+            self._eviction_task.cancel()
+        self.manager.close()
+        # the http client is shared with the models, only this loop's connections are closed
+        await get_clients().aclose()
+
+    async def _character_list(self, topic: str) -> str:
+        # sessions created for the same topic at the same time share one retrieval
+        task = self._character_lists.get(topic)
+        if task is None:
+            task = asyncio.create_task(asyncio.to_thread(
+                get_character_list, topic, backend=self.backend, mode=self.retrieval_mode,
+                llm_selection=self.llm_selection))
+            self._character_lists[topic] = task
+            task.add_done_callback(lambda _: self._character_lists.pop(topic, None))
+        return await task
+
+    def _session(self, request: web.Request) -> ServerSession:
+        session = self.manager.get(request.match_info["id"])
+        if session is None:
+            raise web.HTTPNotFound(text=json.dumps({"error": "unknown or expired session"}),
+                                   content_type="application/json")
+        return session
+
+    @staticmethod
+    async def _json_body(request: web.Request) -> dict:
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text=json.dumps({"error": "body is not JSON"}), content_type="application/json")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text=json.dumps({"error": "body is not a JSON object"}),
+                                     content_type="application/json")
+        return body
+
+    async def create_session(self, request: web.Request) -> web.Response:
+        body = await self._json_body(request)
+        topic = body.get("topic")
+        character_list = body.get("character_list")
+        if not topic and not character_list:
+            raise web.HTTPBadRequest(text=json.dumps({"error": "topic or character_list is required"}),
+                                     content_type="application/json")
+        if not character_list:
+            character_list = await self._character_list(topic)
+        session = self.manager.create(topic, character_list)
+        return web.json_response(session.to_dict(), status=201, dumps=_dumps)
+
+    async def get_session(self, request: web.Request) -> web.Response:
+        return web.json_response(self._session(request).to_dict(with_messages=True), dumps=_dumps)
+
+    async def delete_session(self, request: web.Request) -> web.Response:
+        if not self.manager.remove(request.match_info["id"]):
+            raise web.HTTPNotFound()
+        return web.Response(status=204)
+
+    async def post_message(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        message = (await self._json_body(request)).get("message")
+        if not message:
+            raise web.HTTPBadRequest(text=json.dumps({"error": "message is required"}), content_type="application/json")
+        index, response = await session.reply(message)
+        self.manager.evict()
+        return web.json_response({"index": index, "response": response}, dumps=_dumps)
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        session = self._session(request)
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        async def send_chunk(chunk: str):
+            await ws.send_json({"type": "chunk", "text": chunk}, dumps=_dumps)
+
+        async for frame in ws:
+            if frame.type != WSMsgType.TEXT:
+                continue
+            try:
+                message = json.loads(frame.data).get("message")
+            except (json.JSONDecodeError, AttributeError):
+                message = None
+            if not message:
+                await ws.send_json({"type": "error", "error": "message is required"})
+                continue
+            if self.manager.get(session.id) is None:
+                await ws.send_json({"type": "error", "error": "session expired"})
+                break
+            try:
+                index, response = await session.reply(message, on_chunk=send_chunk)
+            except Exception as e:
+                await ws.send_json({"type": "error", "error": f"{type(e).__name__}: {e}"})
+                continue
+            await ws.send_json({"type": "done", "index": index, "response": response}, dumps=_dumps)
+            self.manager.evict()
+        return ws
+
+    async def speech(self, request: web.Request) -> web.StreamResponse:
+        session = self._session(request)
+        try:
+            message = session.chat_history.messages[int(request.match_info["index"])]
+        except (IndexError, ValueError):
+            raise web.HTTPNotFound()
+        if not isinstance(message, AIMessage):
+            raise web.HTTPBadRequest(text=json.dumps({"error": "only replies of the partner are spoken"}),
+                                     content_type="application/json")
+        text = parse_sections(message.content)[0]
+        key = self.audio_cache.key(text, self.voice, self.tts_model)
+        path = self.audio_cache.get(key)
+        get_tracer().cache_access("audio", path is not None)
+        if path is not None:
+            return web.FileResponse(path, headers={"Content-Type": "audio/mpeg"})
+
+        response = web.StreamResponse(headers={"Content-Type": "audio/mpeg"})
+        partial = self.audio_cache.partial_path(key, writer=uuid.uuid4().hex)
+        try:
+            # the client hears the first chunk while the rest is still synthesized and written to the cache
+            with get_tracer().span(STAGE_TTS, characters=len(text)), open(partial, "wb") as f:
+                async with self.openai_client.audio.speech.with_streaming_response.create(
+                        model=self.tts_model, voice=self.voice, input=text, response_format="mp3") as speech:
+                    await response.prepare(request)
+                    async for chunk in speech.iter_bytes(4096):
+                        f.write(chunk)
+                        await response.write(chunk)
+            await asyncio.to_thread(self.audio_cache.commit, key, partial)
+        finally:
+            partial.unlink(missing_ok=True)
+        await response.write_eof()
+        return response
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        text = get_tracer().metrics_text()
+        text += "# TYPE tandem_server_sessions gauge\n"
+        text += f"tandem_server_sessions {len(self.manager.sessions)}\n"
+        text += "# TYPE tandem_server_session_bytes gauge\n"
+        text += f"tandem_server_session_bytes {self.manager.total_bytes()}\n"
+        text += "# TYPE tandem_server_evicted_sessions_total counter\n"
+        text += f"tandem_server_evicted_sessions_total {self.manager.evicted}\n"
+        stats = get_clients().stats()
+        text += "# TYPE tandem_openai_requests_total counter\n"
+        text += f"tandem_openai_requests_total {stats.requests}\n"
+        text += "# TYPE tandem_openai_retries_total counter\n"
+        text += f"tandem_openai_retries_total {stats.retries}\n"
+        text += "# TYPE tandem_openai_throttled_total counter\n"
+        text += f"tandem_openai_throttled_total {stats.throttled}\n"
+        text += "# TYPE tandem_openai_rate_limit_wait_seconds_total counter\n"
+        text += f"tandem_openai_rate_limit_wait_seconds_total {stats.waited_s:.6f}\n"
+        return web.Response(text=text, content_type="text/plain")
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False)
+
+
+def make_app(args: argparse.Namespace) -> web.Application:
+    manager = SessionManager(max_sessions=args.max_sessions, max_bytes=args.max_memory_mb * 1024 * 1024,
+                             idle_seconds=args.idle_seconds, local_conversion=not args.llm_conversion,
+                             translate=not args.no_translation)
+    server = TandemServer(manager, retrieval_mode=args.retrieval, backend=args.backend,
+                          llm_selection=not args.direct_selection, preload_index=not args.no_preload_index)
+    return server.app()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Serve tandem conversations of many learners over HTTP and WebSocket")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-sessions", type=int, default=1000, help="sessions kept before the idlest is evicted")
+    parser.add_argument("--max-memory-mb", type=int, default=64, help="estimated size of all sessions kept")
+    parser.add_argument("--idle-seconds", type=float, default=1800, help="sessions unused this long are evicted")
+    parser.add_argument("--llm-conversion", action="store_true",
+                        help="convert replies to traditional characters and pinyin with a second LLM call")
+    parser.add_argument("--no-translation", action="store_true", help="do not request an English translation")
+    parser.add_argument("--retrieval", choices=("vector", "lexical", "hybrid"), default="vector",
+                        help="how characters for the topic are looked up")
+    parser.add_argument("--backend", choices=("chroma", "numpy"), default="chroma",
+                        help="vector index used by vector and hybrid retrieval")
+    parser.add_argument("--direct-selection", action="store_true",
+                        help="use the top retrieved characters instead of letting the LLM select them")
+    parser.add_argument("--no-preload-index", action="store_true",
+                        help="load the character index on the first topic instead of at startup")
+    parser.add_argument("--requests-per-minute", type=float,
+                        help="requests to the OpenAI API allowed per minute, shared by all sessions")
+    parser.add_argument("--tokens-per-minute", type=float,
+                        help="estimated tokens sent to the OpenAI API per minute, shared by all sessions")
+    parser.add_argument("--trace-dir", help="write per-turn traces (trace.jsonl) and metrics (metrics.prom) here")
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    load_dotenv(override=True)
+    configure_clients(args.requests_per_minute, args.tokens_per_minute)
+    if args.trace_dir:
+        configure_tracing(log_path=f"{args.trace_dir}/trace.jsonl", metrics_path=f"{args.trace_dir}/metrics.prom")
+    web.run_app(make_app(args), host=args.host, port=args.port)
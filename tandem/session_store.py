@@ -0,0 +1,147 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from tandem.script_converter import parse_sections
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    topic TEXT,
+    character_list TEXT NOT NULL,
+    summary TEXT NOT NULL DEFAULT '',
+    created REAL NOT NULL,
+    summarized_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    role TEXT NOT NULL,
+    author TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    content TEXT NOT NULL,
+    traditional TEXT NOT NULL,
+    pinyin TEXT NOT NULL,
+    english TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_session ON messages(session_id, id);
+"""
+
+
+class Session(NamedTuple):
+    id: int
+    topic: Optional[str]
+    character_list: str
+    summary: str
+    created: float
+    # the last message folded into the summary, later messages are not part of it
+    summarized_id: Optional[int]
+
+
+class StoredMessage(NamedTuple):
+    id: int
+    role: str
+    author: str
+    timestamp: float
+    content: str
+    traditional: str
+    pinyin: str
+    english: str
+
+    def to_message(self) -> BaseMessage:
+        message_type = HumanMessage if self.role == "human" else AIMessage
+        return message_type(content=self.content, id=str(self.id),
+                            additional_kwargs={"author": self.author, "timestamp": self.timestamp})
+
+
+class SessionStore:
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def create_session(self, topic: Optional[str], character_list: str) -> int:
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO sessions (topic, character_list, created) VALUES (?, ?, ?)",
+                (topic, character_list, time.time())
+            )
+            return cursor.lastrowid
+
+    def get_session(self, session_id: Optional[int] = None) -> Optional[Session]:
+        with self._lock:
+            if session_id is None:
+                row = self.connection.execute(
+                    "SELECT id, topic, character_list, summary, created, summarized_id FROM sessions ORDER BY id DESC LIMIT 1"
+                ).fetchone()
+            else:
+                row = self.connection.execute(
+                    "SELECT id, topic, character_list, summary, created, summarized_id FROM sessions WHERE id = ?",
+                    (session_id,)
+                ).fetchone()
+        return Session(*row) if row else None
+
+    def append_turn(self, session_id: int, messages: list[BaseMessage]) -> list[int]:
+        rows = []
+        for message in messages:
+            traditional, pinyin, english = parse_sections(message.content)
+            rows.append((
+                session_id, message.type, message.additional_kwargs["author"], message.additional_kwargs["timestamp"],
+                message.content, traditional, pinyin, english
+            ))
+        # the whole turn is written in one transaction, a crash never leaves a question without its answer
+        with self._lock, self.connection:
+            return [
+                self.connection.execute(
+                    "INSERT INTO messages (session_id, role, author, timestamp, content, traditional, pinyin, english) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    row
+                ).lastrowid
+                for row in rows
+            ]
+
+    def update_summary(self, session_id: int, summary: str, summarized_id: int):
+        with self._lock, self.connection:
+            self.connection.execute("UPDATE sessions SET summary = ?, summarized_id = ? WHERE id = ?",
+                                    (summary, summarized_id, session_id))
+
+    def update_topic(self, session_id: int, topic: Optional[str], character_list: str):
+        # a resumed session continues with the characters of its last topic
+        with self._lock, self.connection:
+            self.connection.execute("UPDATE sessions SET topic = ?, character_list = ? WHERE id = ?",
+                                    (topic, character_list, session_id))
+
+    def recent_topics(self, limit: int = 5) -> list[str]:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT topic FROM sessions WHERE topic IS NOT NULL GROUP BY topic ORDER BY MAX(id) DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def page(self, session_id: int, before_id: Optional[int] = None, limit: int = 100,
+             after_id: Optional[int] = None) -> list[StoredMessage]:
+        # walks the (session_id, id) index backwards, the cost does not depend on the length of the session
+        query = "SELECT id, role, author, timestamp, content, traditional, pinyin, english FROM messages " \
+                "WHERE session_id = ?"
+        params: tuple = (session_id,)
+        if before_id is not None:
+            query += " AND id < ?"
+            params += (before_id,)
+        if after_id is not None:
+            query += " AND id > ?"
+            params += (after_id,)
+        query += " ORDER BY id DESC LIMIT ?"
+        with self._lock:
+            rows = self.connection.execute(query, params + (limit,)).fetchall()
+        return [StoredMessage(*row) for row in reversed(rows)]
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
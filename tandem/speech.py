@@ -0,0 +1,171 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from openai import OpenAI
+from PySide6.QtCore import QIODevice, QObject, Signal
+from tandem.audio_cache import AudioCache
+from tandem.tracing import STAGE_TTS, get_tracer
+
+
+class StreamingAudioDevice(QIODevice):
+    # a sequential source for QMediaPlayer that grows while the speech is still being synthesized
+    def __init__(self):
+        super(StreamingAudioDevice, self).__init__()
+        self._buffer = bytearray()
+        self._finished = False
+        self._condition = threading.Condition()
+        self.open(QIODevice.OpenModeFlag.ReadOnly)
+
+    def feed(self, data: bytes):
+        with self._condition:
+            self._buffer += data
+            self._condition.notify_all()
+        self.readyRead.emit()
+
+    def finish(self):
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+        self.readChannelFinished.emit()
+
+    def isSequential(self) -> bool:
+        return True
+
+    def bytesAvailable(self) -> int:
+        with self._condition:
+            return len(self._buffer) + super(StreamingAudioDevice, self).bytesAvailable()
+
+    def atEnd(self) -> bool:
+        with self._condition:
+            return self._finished and not self._buffer
+
+    def waitForReadyRead(self, msecs: int) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: self._buffer or self._finished,
+                                            None if msecs < 0 else msecs / 1000) and bool(self._buffer)
+
+    def readData(self, maxlen: int) -> bytes:
+        with self._condition:
+            data = bytes(self._buffer[:maxlen])
+            del self._buffer[:maxlen]
+            if not data and self._finished:
+                # end of stream for QIODevice
+                return None
+            return data
+
+    def writeData(self, data: bytes) -> int:
+        return -1
+
+
+class _SpeechJob:
+    __slots__ = ("key", "text", "data", "devices", "finished", "future")
+
+    def __init__(self, key: str, text: str):
+        self.key = key
+        self.text = text
+        # bytes received so far, replayed into devices that attach while the job is running
+        self.data = bytearray()
+        self.devices: list[StreamingAudioDevice] = []
+        self.finished = False
+        self.future: Optional[Future] = None
+
+
+class SpeechSynthesizer(QObject):
+    # text, path of the cached audio
+    audio_ready = Signal(str, str)
+    # text, error message
+    synthesis_failed = Signal(str, str)
+
+    def __init__(self, client: OpenAI, cache: AudioCache, voice: str = "nova", model: str = "tts-1",
+                 max_workers: int = 2, chunk_size: int = 4096, parent: Optional[QObject] = None):
+        super(SpeechSynthesizer, self).__init__(parent)
+        self.client = client
+        self.cache = cache
+        self.voice = voice
+        self.model = model
+        self.chunk_size = chunk_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speech")
+        self._pending: dict[str, _SpeechJob] = {}
+        self._lock = threading.Lock()
+
+    def cached(self, text: str) -> Optional[Path]:
+        return self.cache.get(self.cache.key(text, self.voice, self.model))
+
+    def _job(self, text: str) -> _SpeechJob:
+        key = self.cache.key(text, self.voice, self.model)
+        with self._lock:
+            # a prefetch and a click on the same reply share one synthesis
+            job = self._pending.get(key)
+            if job is None:
+                job = _SpeechJob(key, text)
+                self._pending[key] = job
+                job.future = self._executor.submit(self._synthesize, job)
+        return job
+
+    def request(self, text: str) -> Future:
+        return self._job(text).future
+
+    def stream(self, text: str) -> StreamingAudioDevice:
+        device = StreamingAudioDevice()
+        path = self.cached(text)
+        if path is not None:
+            device.feed(path.read_bytes())
+            device.finish()
+            return device
+        job = self._job(text)
+        with self._lock:
+            device.feed(bytes(job.data))
+            if not job.finished:
+                job.devices.append(device)
+        if job.finished:
+            device.finish()
+        return device
+
+    def prefetch(self, text: str):
+        if text and self.cached(text) is None:
+            self.request(text)
+
+    def _receive(self, job: _SpeechJob, chunk: bytes):
+        with self._lock:
+            job.data += chunk
+            devices = list(job.devices)
+        for device in devices:
+            device.feed(chunk)
+
+    def _synthesize(self, job: _SpeechJob) -> Optional[Path]:
+        partial = None
+        try:
+            path = self.cache.get(job.key)
+            get_tracer().cache_access("audio", path is not None)
+            if path is None:
+                partial = self.cache.partial_path(job.key)
+                # chunks go to the players and through to the cache file as they arrive
+                with get_tracer().span(STAGE_TTS, characters=len(job.text)), \
+                        self.client.audio.speech.with_streaming_response.create(
+                            model=self.model, voice=self.voice, input=job.text, response_format="mp3") as response, \
+                        open(partial, "wb") as f:
+                    for chunk in response.iter_bytes(self.chunk_size):
+                        f.write(chunk)
+                        self._receive(job, chunk)
+                path = self.cache.commit(job.key, partial)
+            else:
+                self._receive(job, path.read_bytes())
+        except Exception as e:
+            if partial is not None:
+                partial.unlink(missing_ok=True)
+            self.synthesis_failed.emit(job.text, str(e))
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(job.key, None)
+                job.finished = True
+                devices = list(job.devices)
+            for device in devices:
+                device.finish()
+        self.audio_ready.emit(job.text, str(path))
+        return path
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
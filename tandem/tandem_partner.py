@@ -1,63 +1,96 @@
 from datetime import datetime
-from dotenv import load_dotenv
-if not load_dotenv(override=True):
-    raise ValueError("Failed to load OPENAI_API_KEY")
-
-from pathlib import Path
+from typing import Optional
 
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.messages import HumanMessage, AIMessage
-from openai import OpenAI
-from PySide6.QtCore import QObject, QThread, Signal, Slot
-from tandem.conversation_chain import get_tandem_chain, get_simplified_traditional_converter_chain
-
-
-class ResponseWorker(QThread):
-    response_received = Signal(str)
-
-    def __init__(self, chain, message):
-        super(ResponseWorker, self).__init__()
-        self.chain = chain
-        self.message = message
-
-    def run(self):
-        response = self.chain.invoke({"input": self.message})
-        self.response_received.emit(response)
+from PySide6.QtCore import QObject, Signal, Slot
+from tandem.clients import get_clients
+from tandem.conversation_chain import get_summarizer_chain, get_tandem_llm, get_tandem_partner, \
+    get_tandem_system_message
+from tandem.history_window import HistoryWindow
+from tandem.request_executor import ChainRequest, RequestExecutor
+from tandem.script_converter import parse_sections
+from tandem.session_store import SessionStore
+from tandem.speech import AudioCache, SpeechSynthesizer
+from tandem.tracing import get_tracer
+from tandem.vocabulary import VocabularyTracker
 
 
 class Response:
     def __init__(self, msg, idx):
         self.idx = idx
-        self.traditional = ""
-        self.pinyin = ""
-        self.english = ""
-        parts = msg.split('---')
-        if len(parts) > 0:
-            self.traditional = parts[0].strip()
-        if len(parts) > 1:
-            self.pinyin = parts[1].strip()
-        if len(parts) > 2:
-            self.english = parts[2].strip()
+        self.traditional, self.pinyin, self.english = parse_sections(msg)
 
 
 class TandemPartner(QObject):
     response_signal = Signal(Response)
 
-    def __init__(self, name: str, character_list: str):
+    def __init__(self, name: str, character_list: str, local_conversion: bool = True, translate: bool = True,
+                 streaming: bool = True, history_tokens: int = 1500, recent_turns: int = 4,
+                 session_store: Optional[SessionStore] = None, session_id: Optional[int] = None,
+                 prefetch_speech: bool = True, vocabulary: Optional[VocabularyTracker] = None,
+                 resume_messages: int = 100):
         super(TandemPartner, self).__init__()
-        tandem_chain = get_tandem_chain(character_list)
-        converter_chain = get_simplified_traditional_converter_chain()
-
         self.name = name
         self.character_list = character_list
-        self.chain = {"input": tandem_chain} | converter_chain
-        self.worker = None
+        self.local_conversion = local_conversion
+        self.translate = translate
+        # kept across topic changes, a new chain reuses the open connections of the model
+        self.llm = get_tandem_llm()
+        self.chain = get_tandem_partner(character_list, local_conversion=local_conversion, translate=translate,
+                                        llm=self.llm)
+        self.streaming = streaming
+        self.streamed_response_idx = None
+        self.turn_trace = None
+        self.executor = RequestExecutor(max_concurrency=1, parent=self)
         self.chat_history = ChatMessageHistory()
         self.history_length = 0
-        self.openai_client = OpenAI()
-    
+        self.history_window = HistoryWindow(self.chat_history, get_summarizer_chain(), max_tokens=history_tokens,
+                                            recent_turns=recent_turns, on_summary=self._save_summary)
+        self.history_window.fixed_tokens = self._system_message_tokens(character_list)
+        self.openai_client = get_clients().openai_client()
+        self.speech = SpeechSynthesizer(self.openai_client, AudioCache(), parent=self)
+        self.prefetch_speech = prefetch_speech
+        self.vocabulary = vocabulary
+
+        self.session_store = session_store
+        self.session_id = session_id
+        self.unsaved_messages = []
+        # id of the oldest stored message in chat_history, older ones stay in the store
+        self.oldest_stored_id = None
+        if session_store is not None and session_id is not None:
+            # turns of a resumed session that the summary covers are only represented by it. without a
+            # summary only the latest page is loaded, older rows are paged in when the view scrolls up
+            session = session_store.get_session(session_id)
+            self.history_window.summary = session.summary
+            recent = session_store.page(session_id, limit=resume_messages, after_id=session.summarized_id)
+            for stored in recent:
+                self.chat_history.add_message(stored.to_message())
+                self.history_length += 1
+            if recent:
+                self.oldest_stored_id = recent[0].id
+            elif session.summarized_id is not None:
+                self.oldest_stored_id = session.summarized_id + 1
+
+    def _system_message_tokens(self, character_list: str) -> int:
+        system_message = get_tandem_system_message(character_list,
+                                                   with_translation=self.local_conversion and self.translate)
+        return self.history_window.count_tokens(system_message)
+
+    def set_character_list(self, topic: Optional[str], character_list: str):
+        # a running reply keeps the chain it was started with, the next invoke picks up the new one.
+        # the chat history is shared by both chains, the conversation continues on the new topic
+        chain = get_tandem_partner(character_list, local_conversion=self.local_conversion, translate=self.translate,
+                                   llm=self.llm)
+        self.history_window.fixed_tokens = self._system_message_tokens(character_list)
+        self.character_list = character_list
+        self.chain = chain
+        if self.session_store is not None and self.session_id is not None:
+            self.session_store.update_topic(self.session_id, topic, character_list)
+
     def _add_user_message(self, message: HumanMessage):
         self.chat_history.add_user_message(message)
+        self.unsaved_messages.append(message)
         self.history_length += 1
 
     def _add_ai_message(self, message: AIMessage) -> int:
@@ -66,13 +99,49 @@ class TandemPartner(QObject):
         self.history_length += 1
         return message_idx
 
-    def invoke(self, author: str, message: str) -> ResponseWorker:
+    def _save_turn(self, response: AIMessage):
+        if self.session_store is not None and self.session_id is not None:
+            messages = [*self.unsaved_messages, response]
+            for message, message_id in zip(messages, self.session_store.append_turn(self.session_id, messages)):
+                message.id = str(message_id)
+        if self.vocabulary is not None:
+            self.vocabulary.record_turn([message.content for message in self.unsaved_messages], response.content)
+        self.unsaved_messages = []
+
+    def _save_summary(self, summary: str, summarized_count: int):
+        # runs on the summary thread once the turns it covers are stored
+        last_message = self.chat_history.messages[summarized_count - 1]
+        if self.session_store is not None and self.session_id is not None and last_message.id is not None:
+            self.session_store.update_summary(self.session_id, summary, int(last_message.id))
+
+    def invoke(self, author: str, message: str) -> ChainRequest:
         message = HumanMessage(content=message, additional_kwargs={
             "author": author,
             "timestamp": datetime.now().timestamp()
         })
         self._add_user_message(message)
-        return ResponseWorker(self.chain, self.chat_history)
+        tracer = get_tracer()
+        self.turn_trace = tracer.start_turn()
+        with tracer.span("history_window", self.turn_trace):
+            messages = self.history_window.build()
+        # the request is submitted by the caller once its signals are connected
+        return ChainRequest(self.chain, {"chat_history": messages}, streaming=self.streaming,
+                            config=tracer.run_config(self.turn_trace), turn_trace=self.turn_trace)
+
+    def submit(self, request: ChainRequest) -> ChainRequest:
+        return self.executor.submit(request)
+
+    def cancel_requests(self):
+        self.executor.cancel_all()
+
+    def shutdown(self):
+        self.executor.shutdown()
+        self.speech.shutdown()
+        self.history_window.shutdown()
+
+    @property
+    def prompt_token_counts(self) -> list[int]:
+        return self.history_window.prompt_token_counts
 
     @Slot(str)
     def dummy_invoke(self, author: str, message: str):
@@ -82,18 +151,39 @@ class TandemPartner(QObject):
         })
         self._add_user_message(message)
 
-    @Slot(str)
-    def handle_response(self, response: str):
-        response = AIMessage(content=response, additional_kwargs={
+    def begin_response(self) -> int:
+        self.streamed_response_idx = self._add_ai_message(AIMessage(content="", additional_kwargs={
             "author": self.name,
             "timestamp": datetime.now().timestamp()
-        })
-        self._add_ai_message(response)
-
-    def text2speech(self, history_index: int, output_path: str):
-        Path(output_path).parent.mkdir(exist_ok=True, parents=True)
-        if not Path(output_path).exists():
-            message = self.chat_history.messages[history_index]
-            chinese = Response(message.content, history_index).traditional
-            response = self.openai_client.audio.speech.create(model="tts-1", voice="nova", input=chinese, response_format="mp3")
-            response.stream_to_file(output_path)
+        }))
+        return self.streamed_response_idx
+
+    @Slot(str)
+    def handle_chunk(self, chunk: str):
+        get_tracer().first_chunk(self.turn_trace)
+        self.chat_history.messages[self.streamed_response_idx].content += chunk
+
+    def abort_turn(self):
+        # the request failed before any reply, the message is stored with the next turn
+        get_tracer().finish_turn(self.turn_trace)
+        self.turn_trace = None
+
+    @Slot(str)
+    def handle_response(self, response: str):
+        if self.streamed_response_idx is not None:
+            response_message = self.chat_history.messages[self.streamed_response_idx]
+            response_message.content = response
+            self.streamed_response_idx = None
+        else:
+            response_message = AIMessage(content=response, additional_kwargs={
+                "author": self.name,
+                "timestamp": datetime.now().timestamp()
+            })
+            self._add_ai_message(response_message)
+        self._save_turn(response_message)
+        get_tracer().finish_turn(self.turn_trace)
+        self.turn_trace = None
+        self.history_window.schedule_summary()
+        # the reply is usually played right after it arrived, synthesize it while it is being read
+        if self.prefetch_speech:
+            self.speech.prefetch(parse_sections(response_message.content)[0])
@@ -0,0 +1,61 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from PySide6.QtCore import QObject, Signal, Slot
+
+
+class TopicSwitcher(QObject):
+    # topic, character list
+    topic_ready = Signal(str, str)
+    # topic, error message
+    topic_failed = Signal(str, str)
+    # emitted on the retrieval thread, delivered on the thread that owns the switcher
+    _retrieved = Signal(str, object)
+
+    def __init__(self, retrieve: Callable[[str], str], max_workers: int = 2, parent: Optional[QObject] = None):
+        super(TopicSwitcher, self).__init__(parent)
+        self.retrieve = retrieve
+        self.character_lists: dict[str, str] = {}
+        # the topic the user asked for last, earlier requests still loading are only cached
+        self.requested: Optional[str] = None
+        self._pending: dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="topic-retrieval")
+        self._retrieved.connect(self._finished)
+
+    def prefetch(self, topic: str):
+        if topic in self.character_lists or topic in self._pending:
+            return
+        self._pending[topic] = self._executor.submit(self._run, topic)
+
+    def switch(self, topic: str):
+        self.requested = topic
+        character_list = self.character_lists.get(topic)
+        if character_list is not None:
+            # a prefetched topic is applied right away, the next turn already uses it
+            self.requested = None
+            self.topic_ready.emit(topic, character_list)
+        else:
+            self.prefetch(topic)
+
+    def _run(self, topic: str):
+        try:
+            result = self.retrieve(topic)
+        except Exception as e:
+            result = e
+        self._retrieved.emit(topic, result)
+
+    @Slot(str, object)
+    def _finished(self, topic: str, result):
+        self._pending.pop(topic, None)
+        if isinstance(result, Exception):
+            if topic == self.requested:
+                self.requested = None
+                self.topic_failed.emit(topic, f"{type(result).__name__}: {result}")
+            return
+        self.character_lists[topic] = result
+        if topic == self.requested:
+            self.requested = None
+            self.topic_ready.emit(topic, result)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,367 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+
+# stage names, set as run metadata in conversation_chain and inherited by the models inside a chain
+STAGE_TANDEM = "tandem"
+STAGE_CONVERTER = "converter"
+STAGE_LOCAL_CONVERSION = "local_conversion"
+STAGE_SUMMARY = "summary"
+STAGE_RETRIEVAL = "retrieval"
+STAGE_TTS = "tts"
+
+_NULL_SPAN = nullcontext()
+_active_turn: ContextVar[Optional["TurnTrace"]] = ContextVar("tandem_active_turn", default=None)
+
+
+class TurnTrace:
+    def __init__(self, turn_id: int):
+        self.turn_id = turn_id
+        self.started = time.perf_counter()
+        self.timestamp = time.time()
+        self.stages: dict[str, float] = defaultdict(float)
+        self.first_token_s: Optional[float] = None
+        self.first_chunk_s: Optional[float] = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cache = Counter()
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def to_record(self) -> dict:
+        return {
+            "type": "turn",
+            "turn": self.turn_id,
+            "timestamp": self.timestamp,
+            "total_s": time.perf_counter() - self.started,
+            "stages_s": dict(self.stages),
+            "first_token_s": self.first_token_s,
+            "first_chunk_s": self.first_chunk_s,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache": dict(self.cache),
+        }
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    def __init__(self, tracer: "Tracer", turn: Optional[TurnTrace] = None):
+        self.tracer = tracer
+        self.turn = turn
+        self._runs: dict[UUID, tuple[str, float]] = {}
+        self._first_token_seen: set[UUID] = set()
+
+    def _start(self, run_id: UUID, metadata: Optional[dict]):
+        stage = (metadata or {}).get("stage")
+        if stage is not None:
+            self._runs[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id: UUID) -> Optional[str]:
+        stage, start = self._runs.pop(run_id, (None, 0.0))
+        if stage is not None:
+            seconds = time.perf_counter() - start
+            self.tracer.add_stage(stage, seconds, self.turn)
+            if self.turn is None:
+                self.tracer.record({"type": "stage", "stage": stage, "seconds": seconds})
+        self._first_token_seen.discard(run_id)
+        return stage
+
+    def on_chat_model_start(self, serialized: dict, messages: list, *, run_id: UUID,
+                            metadata: Optional[dict] = None, **kwargs: Any):
+        self._start(run_id, metadata)
+
+    def on_llm_start(self, serialized: dict, prompts: list[str], *, run_id: UUID,
+                     metadata: Optional[dict] = None, **kwargs: Any):
+        self._start(run_id, metadata)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        if run_id in self._first_token_seen or self.turn is None:
+            return
+        self._first_token_seen.add(run_id)
+        stage = self._runs.get(run_id, (None, 0.0))[0]
+        if stage == STAGE_TANDEM and self.turn.first_token_s is None:
+            self.turn.first_token_s = time.perf_counter() - self.turn.started
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        stage = self._end(run_id)
+        prompt_tokens, completion_tokens = _token_usage(response)
+        self.tracer.add_tokens(stage or "llm", prompt_tokens, completion_tokens, self.turn)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+
+
+class _UpstreamTimer:
+    # the time a transform spends waiting for its input, the model stream it consumes
+    def __init__(self):
+        self.waited = 0.0
+
+    def wrap(self, chunks: Iterator) -> Iterator:
+        chunks = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.waited += time.perf_counter() - start
+            yield chunk
+
+    async def awrap(self, chunks: AsyncIterator) -> AsyncIterator:
+        chunks = aiter(chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = await anext(chunks)
+            except StopAsyncIteration:
+                return
+            finally:
+                self.waited += time.perf_counter() - start
+            yield chunk
+
+
+def timed_transform(stage: str, transform: Callable[[Iterator], Iterator]) -> Callable[[Iterator], Iterator]:
+    # a transform runs for as long as the stream it consumes, only its own work is counted for the stage
+    def timed(chunks: Iterator) -> Iterator:
+        upstream = _UpstreamTimer()
+        outputs = transform(upstream.wrap(chunks))
+        seconds = 0.0
+        try:
+            while True:
+                start, waited = time.perf_counter(), upstream.waited
+                try:
+                    output = next(outputs)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start - (upstream.waited - waited)
+                yield output
+        finally:
+            get_tracer().stage_done(stage, seconds)
+
+    return timed
+
+
+def timed_atransform(stage: str, transform: Callable[[AsyncIterator], AsyncIterator]
+                     ) -> Callable[[AsyncIterator], AsyncIterator]:
+    async def timed(chunks: AsyncIterator) -> AsyncIterator:
+        upstream = _UpstreamTimer()
+        outputs = transform(upstream.awrap(chunks))
+        seconds = 0.0
+        try:
+            while True:
+                start, waited = time.perf_counter(), upstream.waited
+                try:
+                    output = await anext(outputs)
+                except StopAsyncIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start - (upstream.waited - waited)
+                yield output
+        finally:
+            get_tracer().stage_done(stage, seconds)
+
+    return timed
+
+
+def _token_usage(response: LLMResult) -> tuple[int, int]:
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    # streamed responses report usage on the message when stream_usage is set
+    for generations in response.generations:
+        for generation in generations:
+            usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage_metadata:
+                return usage_metadata.get("input_tokens", 0), usage_metadata.get("output_tokens", 0)
+    return 0, 0
+
+
+class Tracer:
+    def __init__(self, log_path: Optional[str] = None, metrics_path: Optional[str] = None,
+                 max_log_bytes: int = 10 * 1024 * 1024, log_backups: int = 3):
+        self.metrics_path = metrics_path
+        self.listeners: list[Callable[[dict], None]] = []
+        self._turn_count = 0
+        self._lock = threading.Lock()
+        self._stage_seconds: dict[str, float] = defaultdict(float)
+        self._stage_counts = Counter()
+        self._first_token = [0.0, 0]
+        self._tokens = Counter()
+        self._cache = Counter()
+
+        self._logger = None
+        if log_path is not None:
+            Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+            self._logger = logging.getLogger(f"tandem.tracing.{id(self)}")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            handler = RotatingFileHandler(log_path, maxBytes=max_log_bytes, backupCount=log_backups,
+                                          encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+
+    @property
+    def enabled(self) -> bool:
+        return self._logger is not None or self.metrics_path is not None or bool(self.listeners)
+
+    def start_turn(self) -> Optional[TurnTrace]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._turn_count += 1
+            return TurnTrace(self._turn_count)
+
+    def run_config(self, turn: Optional[TurnTrace] = None) -> dict:
+        if not self.enabled:
+            return {}
+        return {"callbacks": [TracingCallbackHandler(self, turn)]}
+
+    @contextmanager
+    def activate(self, turn: Optional[TurnTrace]):
+        # stages and cache accesses of the code run inside belong to this turn, the context is
+        # inherited by the threads and tasks langchain runs a chain on
+        token = _active_turn.set(turn)
+        try:
+            yield
+        finally:
+            _active_turn.reset(token)
+
+    @contextmanager
+    def _span(self, stage: str, turn: Optional[TurnTrace], fields: dict):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_stage(stage, seconds, turn)
+            if turn is None:
+                self.record({"type": "stage", "stage": stage, "seconds": seconds, **fields})
+
+    def span(self, stage: str, turn: Optional[TurnTrace] = None, **fields):
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(stage, turn, fields)
+
+    def add_stage(self, stage: str, seconds: float, turn: Optional[TurnTrace] = None):
+        if turn is not None:
+            turn.add_stage(stage, seconds)
+        with self._lock:
+            self._stage_seconds[stage] += seconds
+            self._stage_counts[stage] += 1
+
+    def stage_done(self, stage: str, seconds: float):
+        # a stage timed outside the callbacks, counted for the turn the running chain belongs to
+        if not self.enabled:
+            return
+        turn = _active_turn.get()
+        self.add_stage(stage, seconds, turn)
+        if turn is None:
+            self.record({"type": "stage", "stage": stage, "seconds": seconds})
+
+    def add_tokens(self, stage: str, prompt_tokens: int, completion_tokens: int, turn: Optional[TurnTrace] = None):
+        if turn is not None:
+            turn.add_tokens(prompt_tokens, completion_tokens)
+        with self._lock:
+            self._tokens[(stage, "prompt")] += prompt_tokens
+            self._tokens[(stage, "completion")] += completion_tokens
+
+    def cache_access(self, cache: str, hit: bool):
+        if not self.enabled:
+            return
+        result = "hit" if hit else "miss"
+        # lookups made while a turn's chain runs, e.g. the llm cache of the converter chain
+        turn = _active_turn.get()
+        if turn is not None:
+            turn.cache[f"{cache}_{result}"] += 1
+        with self._lock:
+            self._cache[(cache, result)] += 1
+
+    def first_chunk(self, turn: Optional[TurnTrace]):
+        if turn is not None and turn.first_chunk_s is None:
+            turn.first_chunk_s = time.perf_counter() - turn.started
+
+    def finish_turn(self, turn: Optional[TurnTrace]):
+        if turn is None:
+            return
+        record = turn.to_record()
+        if turn.first_token_s is not None:
+            with self._lock:
+                self._first_token[0] += turn.first_token_s
+                self._first_token[1] += 1
+        self.record(record)
+        self.write_metrics()
+        for listener in self.listeners:
+            listener(record)
+
+    def record(self, record: dict):
+        if self._logger is not None:
+            self._logger.info(json.dumps(record, ensure_ascii=False))
+
+    def metrics_text(self) -> str:
+        with self._lock:
+            lines = [
+                "# TYPE tandem_turns_total counter",
+                f"tandem_turns_total {self._turn_count}",
+                "# TYPE tandem_stage_seconds summary",
+            ]
+            for stage in sorted(self._stage_seconds):
+                lines.append(f'tandem_stage_seconds_sum{{stage="{stage}"}} {self._stage_seconds[stage]:.6f}')
+                lines.append(f'tandem_stage_seconds_count{{stage="{stage}"}} {self._stage_counts[stage]}')
+            lines += [
+                "# TYPE tandem_time_to_first_token_seconds summary",
+                f"tandem_time_to_first_token_seconds_sum {self._first_token[0]:.6f}",
+                f"tandem_time_to_first_token_seconds_count {self._first_token[1]}",
+                "# TYPE tandem_tokens_total counter",
+            ]
+            for (stage, kind), count in sorted(self._tokens.items()):
+                lines.append(f'tandem_tokens_total{{stage="{stage}",kind="{kind}"}} {count}')
+            lines.append("# TYPE tandem_cache_requests_total counter")
+            for (cache, result), count in sorted(self._cache.items()):
+                lines.append(f'tandem_cache_requests_total{{cache="{cache}",result="{result}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self):
+        if self.metrics_path is None:
+            return
+        Path(self.metrics_path).parent.mkdir(parents=True, exist_ok=True)
+        # scrapers read the snapshot file, it is replaced instead of rewritten in place
+        partial = f"{self.metrics_path}.part"
+        with open(partial, "w", encoding="utf-8") as f:
+            f.write(self.metrics_text())
+        os.replace(partial, self.metrics_path)
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def configure_tracing(log_path: Optional[str] = None, metrics_path: Optional[str] = None, **kwargs) -> Tracer:
+    global _tracer
+    _tracer = Tracer(log_path, metrics_path, **kwargs)
+    return _tracer
@@ -0,0 +1,84 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+
+_MATRIX_FILE = "embeddings.npy"
+_ROWS_FILE = "rows.jsonl"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _write_index(index_dir: str, embeddings, ids: list[str], contents: list[str], metadatas: list[dict]) -> int:
+    matrix = _normalize(np.asarray(embeddings, dtype=np.float32))
+    Path(index_dir).mkdir(parents=True, exist_ok=True)
+    np.save(f"{index_dir}/{_MATRIX_FILE}", matrix)
+    with open(f"{index_dir}/{_ROWS_FILE}", mode="w", encoding="utf-8") as f:
+        for doc_id, content, metadata in zip(ids, contents, metadatas):
+            f.write(json.dumps({"id": doc_id, "page_content": content, "metadata": metadata or {}}, ensure_ascii=False))
+            f.write("\n")
+    return len(matrix)
+
+
+def export_chroma_embeddings(chroma_path: str, index_dir: str) -> int:
+    from langchain_community.vectorstores import Chroma
+
+    data = Chroma(persist_directory=chroma_path).get(include=["embeddings", "documents", "metadatas"])
+    return _write_index(index_dir, data["embeddings"], data["ids"], data["documents"], data["metadatas"])
+
+
+def build_vector_index(documents: list[Document], embeddings: Embeddings, index_dir: str) -> int:
+    # builds the index without a Chroma database in between
+    vectors = embeddings.embed_documents([doc.page_content for doc in documents])
+    return _write_index(index_dir, vectors, [doc.id for doc in documents], [doc.page_content for doc in documents],
+                        [doc.metadata for doc in documents])
+
+
+class NumpyVectorIndex:
+    def __init__(self, index_dir: str):
+        # rows are normalized on export, so the cosine similarity is a plain dot product
+        self.matrix = np.load(f"{index_dir}/{_MATRIX_FILE}", mmap_mode="r")
+        with open(f"{index_dir}/{_ROWS_FILE}", encoding="utf-8") as f:
+            self.rows = [json.loads(line) for line in f]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def search(self, query_vectors, k: int) -> list[list[tuple[int, float]]]:
+        queries = _normalize(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        scores = queries @ self.matrix.T
+        k = min(k, scores.shape[1])
+        if k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return [list(zip(rows.tolist(), row_scores.tolist())) for rows, row_scores in zip(top, top_scores)]
+
+    def document(self, row: int) -> Document:
+        data = self.rows[row]
+        return Document(id=data["id"], page_content=data["page_content"], metadata=data["metadata"])
+
+
+class NumpyRetriever(BaseRetriever):
+    index: NumpyVectorIndex
+    embeddings: Embeddings
+    k: int = 30
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        return self.search_by_vectors([self.embeddings.embed_query(query)])[0]
+
+    def search_by_vectors(self, query_vectors) -> list[list[Document]]:
+        return [[self.index.document(row) for row, _ in hits] for hits in self.index.search(query_vectors, self.k)]
@@ -0,0 +1,195 @@
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+
+from tandem.script_converter import get_default_converter, parse_sections
+
+
+_DEFAULT_CHARACTER_PATH = Path(__file__).parent.parent / "data" / "3000-traditional-hanzi.tsv"
+_DAY = 24 * 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vocabulary (
+    item TEXT PRIMARY KEY,
+    exposures INTEGER NOT NULL DEFAULT 0,
+    productions INTEGER NOT NULL DEFAULT 0,
+    last_seen REAL NOT NULL,
+    interval REAL NOT NULL DEFAULT 0,
+    due REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vocabulary_by_due ON vocabulary(due);
+"""
+
+
+class CharacterEntry(NamedTuple):
+    char: str
+    pinyin: str
+    meaning: str
+    words: tuple[str, ...]
+
+
+class ItemStats(NamedTuple):
+    item: str
+    exposures: int
+    productions: int
+    last_seen: float
+    interval: float
+    due: float
+
+
+def read_character_table(path: Path = _DEFAULT_CHARACTER_PATH) -> list[CharacterEntry]:
+    # new characters are introduced in the order of the table, the learning order of the source list
+    entries = []
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 3 or not columns[0]:
+                continue
+            words = tuple(columns[3].split()) if len(columns) > 3 else ()
+            entries.append(CharacterEntry(columns[0], columns[1], columns[2], words))
+    return entries
+
+
+class VocabularyMatcher:
+    # Aho-Corasick automaton over the characters and their vocabulary words, a scan visits every
+    # character of the text once and reports overlapping matches, e.g. 門口, 門 and 口 in 門口
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[tuple[str, ...]] = [()]
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def _add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        if pattern not in self._output[state]:
+            self._output[state] += (pattern,)
+
+    def _link(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                # a state also ends every pattern that ends in its fallback state
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def scan(self, text: str) -> Counter:
+        counts = Counter()
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern in output[state]:
+                counts[pattern] += 1
+        return counts
+
+
+@lru_cache(maxsize=1)
+def get_character_table() -> tuple[CharacterEntry, ...]:
+    return tuple(read_character_table())
+
+
+@lru_cache(maxsize=1)
+def get_vocabulary_matcher() -> VocabularyMatcher:
+    entries = get_character_table()
+    return VocabularyMatcher([entry.char for entry in entries] + [word for entry in entries for word in entry.words])
+
+
+class VocabularyStore:
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def record(self, exposures: Counter, productions: Counter, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        with self._lock, self.connection:
+            for item in exposures.keys() | productions.keys():
+                # a first exposure introduces the item, it is due for practice right away
+                self.connection.execute(
+                    "INSERT INTO vocabulary (item, last_seen, due) VALUES (?, ?, ?) ON CONFLICT(item) DO NOTHING",
+                    (item, now, now)
+                )
+                self.connection.execute(
+                    "UPDATE vocabulary SET exposures = exposures + ?, productions = productions + ?, last_seen = ? "
+                    "WHERE item = ?", (exposures[item], productions[item], now, item)
+                )
+                if productions[item]:
+                    # using a due item doubles its interval, using it again before it is due changes nothing
+                    self.connection.execute(
+                        "UPDATE vocabulary SET interval = MAX(1.0, interval * 2), "
+                        "due = ? + MAX(1.0, interval * 2) * ? WHERE item = ? AND due <= ?", (now, _DAY, item, now)
+                    )
+
+    def stats(self) -> dict[str, ItemStats]:
+        with self._lock:
+            rows = self.connection.execute("SELECT * FROM vocabulary").fetchall()
+        return {row[0]: ItemStats(*row) for row in rows}
+
+    def due(self, now: Optional[float] = None, limit: int = 100) -> list[ItemStats]:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT * FROM vocabulary WHERE due <= ? ORDER BY due LIMIT ?",
+                (time.time() if now is None else now, limit)
+            ).fetchall()
+        return [ItemStats(*row) for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+class VocabularyTracker:
+    def __init__(self, store: VocabularyStore, matcher: Optional[VocabularyMatcher] = None):
+        self.store = store
+        self.matcher = matcher or get_vocabulary_matcher()
+        self.converter = get_default_converter()
+
+    def record_turn(self, student_messages: list[str], response: str):
+        # the student may type simplified characters, the table is traditional
+        produced = Counter()
+        for message in student_messages:
+            produced += self.matcher.scan(self.converter.to_traditional(message))
+        exposed = self.matcher.scan(parse_sections(response)[0])
+        self.store.record(exposed, produced)
+
+
+class CharacterScheduler:
+    def __init__(self, store: VocabularyStore, entries: Optional[Iterable[CharacterEntry]] = None):
+        self.store = store
+        self.entries = {entry.char: entry for entry in (entries or get_character_table())}
+
+    def next_characters(self, size: int = 10, new: int = 4, now: Optional[float] = None) -> list[CharacterEntry]:
+        # due characters first, most overdue first, then unseen ones in table order
+        due = [self.entries[stats.item] for stats in self.store.due(now, limit=size * 10) if stats.item in self.entries]
+        known = self.store.stats()
+        unseen = [entry for char, entry in self.entries.items() if char not in known]
+        review_count = min(len(due), max(size - new, size - len(unseen)))
+        return due[:review_count] + unseen[:size - review_count]
+
+    def next_character_list(self, size: int = 10, new: int = 4, now: Optional[float] = None) -> str:
+        # the format of the retrieval chain, so the tandem prompt is the same either way
+        return "\n".join(f"{entry.char}({entry.pinyin}) - {entry.meaning}"
+                         for entry in self.next_characters(size, new, now))